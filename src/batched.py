@@ -0,0 +1,815 @@
+"""
+* Replica-batched engine
+* B independent highways (replicas) advanced together with array operations
+* State is kept in padded (replica x car) arrays, cars ordered from front (index 0) to back
+* Same car model as Car / Highway, written for whole arrays
+
+* Pending actions are not kept as a list per car. Each (car, action) keeps how many
+* queued entries are still active, bucketed by the sub-step in which they expire.
+* An active entry fires with probability 0.1 per sub-step, so an action fires with
+* probability 1 - 0.9^k when k entries are active. A firing runs the action 100 times,
+* which saturates accelerate and decelerate at their limits.
+
+* run: python batched.py --replicas 8 --frames 1200 --precision 10 --seed 42
+"""
+
+import argparse
+import os
+from datetime import datetime
+from typing import Dict, List, Optional, Sequence
+
+import numpy as np
+import pandas as pd
+from tqdm import tqdm
+
+from car import (
+    ACCELERATE,
+    DECELERATE,
+    DEFAULT_ATTENTION,
+    INCREASE_ATTENTION,
+    RECENT_SAMPLES,
+    STOP,
+)
+from inflow import DriverPopulation, GapArrivals, PoissonArrivals
+import kernel
+from variance import random_streams
+
+ACTION_COUNT = 6
+
+# Per car fields: name -> dtype
+CAR_FIELDS = {
+    "id": np.int64,
+    "x": float,
+    "v": float,
+    "a": float,
+    "vmax": float,
+    "vd": float,
+    "amax": float,
+    "brake": float,
+    "throttle": float,
+    "stopping_acc": float,
+    "car_length": float,
+    "tr": float,
+    "random_behavior": bool,
+    "attached": bool,
+    "crashed": bool,
+    "registered": bool,
+    "crash_frame": np.int64,
+    "stopping": bool,
+    "increased_attention": bool,
+    "decreased_attention": bool,
+    "time_ellapsed": np.int64,
+    "init_frame": np.int64,
+    "samples": np.int64,
+    "v_sum": float,
+    "a_sum": float,
+}
+
+AGP_COLUMNS = [
+    "frame",
+    "current_car_count",
+    "historic_car_count",
+    "current_crash_count",
+    "historic_crash_count",
+    "avg_v",
+    "avg_a",
+    "avg_t_d",
+]
+CARS_COLUMNS = ["frame", "car_id", "car_x", "car_v", "car_a", "car_t_d", "f_car_id", "b_car_id"]
+EXITS_COLUMNS = ["frame", "car_id", "avg_v", "avg_a", "t_d", "init_frame"]
+CRASHES_COLUMNS = ["frame", "car_id", "car_x", "car_v", "car_a", "car_t_d", "f_car_id", "b_car_id"]
+
+
+def first_car_parameters(rng: np.random.Generator, max_v: float) -> Dict:
+    """Parameters of the first car of simulation.py, it has its own distribution"""
+    return {
+        "v": int(rng.uniform(50, 80)),
+        "vmax": int(rng.normal(140, 20)),
+        "vd": int(rng.normal(max_v, 10)),
+        "a": max(0, int(rng.normal(2, 1))),
+        "amax": rng.uniform(1.5, 3),
+        "break_max": rng.uniform(2, 4),
+        "acc_throttle": rng.normal(0.1, 0.01),
+        "acc_stopping": rng.normal(0.3, 0.01),
+        "length": rng.normal(4.5, 0.5),
+        "tr": rng.normal(0.732, 0.163),
+        "has_random_behavior": False,
+    }
+
+
+class BatchedHighway:
+    """B independent highways advanced with one set of array operations per sub-step
+
+    Args:
+        replicas (int): Number of replicas
+        length (float): Length of each highway in meters
+        precision (int, optional): Sub-steps per frame. Defaults to 1.
+        crash_remove_delay (int, optional): Sub-steps until a crashed car is towed. Defaults to 5000.
+        seed (int, optional): Seed. Defaults to 42.
+        replica_seeds (Optional[Sequence[int]], optional): Seed of the drivers, arrivals and
+            entrance of each replica, the streams of simulation.py with that seed, so replica b
+            pairs with the run of seed replica_seeds[b]. Defaults to None (spawned from `seed`).
+        max_v (float, optional): Speed limit in km/h. Defaults to 100.
+        smart_car_probability (float, optional): Share of smart cars. Defaults to 0.
+        inflow (str, optional): "gap" or "poisson". Defaults to "gap".
+        arrival_rate (float, optional): Poisson arrivals in cars per hour. Defaults to 1800.
+        first_car (bool, optional): Start with a car at 100 m like simulation.py. Defaults to True.
+        log (bool, optional): Keep the rows of the four logs. Defaults to False.
+        capacity (int, optional): Initial cars per replica, grows as needed. Defaults to 64.
+        backend (str, optional): "numpy", "kernel" (compiled loops of kernel.py) or "auto"
+            (the kernel when numba is installed). Defaults to "auto".
+    """
+
+    INCREASED_ATTENTION_FACTOR = 0.5
+    DECREASED_ATTENTION_FACTOR = 1.8
+    MAX_REACTION_TIME = 2.0
+    MIN_GAP = 80
+
+    def __init__(
+        self,
+        replicas: int,
+        length: float,
+        precision: int = 1,
+        crash_remove_delay: int = 5000,
+        seed: int = 42,
+        replica_seeds: Optional[Sequence[int]] = None,
+        max_v: float = 100,
+        smart_car_probability: float = 0,
+        inflow: str = "gap",
+        arrival_rate: float = 1800,
+        first_car: bool = True,
+        log: bool = False,
+        capacity: int = 64,
+        backend: str = "auto",
+    ):
+        if backend == "auto":
+            backend = "kernel" if kernel.NUMBA_AVAILABLE else "numpy"
+        if backend not in ("numpy", "kernel"):
+            raise ValueError(f"Unknown backend: {backend}")
+        if replica_seeds is not None and len(replica_seeds) != replicas:
+            raise ValueError(f"{len(replica_seeds)} replica seeds for {replicas} replicas")
+        self.backend = backend
+
+        self.replicas = replicas
+        self.length = length
+        self.precision = precision
+        self.crash_remove_delay = crash_remove_delay
+        self.seed = seed
+        self.max_v = max_v
+        self.log = log
+
+        self.time = 0
+
+        # Independent streams per replica, plus one for the vectorized dynamics
+        children = np.random.SeedSequence(seed).spawn(replicas + 1)
+        self.rng = np.random.default_rng(children[0])
+        self.populations = []
+        self.arrivals = []
+        self.entrance_rngs = []
+        for b, child in enumerate(children[1:]):
+            if replica_seeds is not None:
+                streams = random_streams(replica_seeds[b])
+                population_rng, arrivals_rng, entrance_rng = (
+                    streams["population"],
+                    streams["arrivals"],
+                    streams["entrance"],
+                )
+            else:
+                population_rng, arrivals_rng, entrance_rng = (
+                    np.random.default_rng(stream) for stream in child.spawn(3)
+                )
+            self.populations.append(
+                DriverPopulation(
+                    population_rng,
+                    max_v=max_v,
+                    smart_car_probability=smart_car_probability,
+                )
+            )
+            if inflow == "poisson":
+                self.arrivals.append(PoissonArrivals(arrivals_rng, arrival_rate))
+            else:
+                self.arrivals.append(GapArrivals())
+            self.entrance_rngs.append(entrance_rng)
+
+        self.queued = np.zeros(replicas, dtype=np.int64)
+        self.escape_probability = 1 - (1 - np.exp(-1)) ** (1 / precision)
+
+        # Action buckets must cover the longest delay
+        self.delay_slots = (
+            int(np.ceil(self.MAX_REACTION_TIME * self.DECREASED_ATTENTION_FACTOR * precision))
+            + 16
+        )
+
+        self.capacity = 0
+        self.n = np.zeros(replicas, dtype=np.int64)
+        self.allocate(capacity)
+
+        self.spawned = np.zeros(replicas, dtype=np.int64)
+        self.historic_crash_count = np.zeros(replicas, dtype=np.int64)
+        self.v_total = np.zeros(replicas)
+        self.a_total = np.zeros(replicas)
+        self.samples_total = np.zeros(replicas, dtype=np.int64)
+        self.trip_total = np.zeros(replicas)
+        self.trip_count = np.zeros(replicas, dtype=np.int64)
+
+        self.agp_rows = [[] for _ in range(replicas)]
+        self.cars_rows = [[] for _ in range(replicas)]
+        self.exits_rows = [[] for _ in range(replicas)]
+        self.crashes_rows = [[] for _ in range(replicas)]
+
+        if first_car:
+            for b in range(replicas):
+                self.add_first_car(b)
+
+    # Storage
+
+    def allocate(self, capacity: int):
+        """Creates or grows the per car arrays to `capacity` cars per replica"""
+        B = self.replicas
+        old = self.capacity
+
+        def grow(array, shape, dtype):
+            new = np.zeros(shape, dtype=dtype)
+            if array is not None:
+                new[:, :old] = array
+            return new
+
+        for name, dtype in CAR_FIELDS.items():
+            setattr(self, name, grow(getattr(self, name, None), (B, capacity), dtype))
+
+        self.recent_v = grow(getattr(self, "recent_v", None), (B, capacity, RECENT_SAMPLES), float)
+        self.recent_a = grow(getattr(self, "recent_a", None), (B, capacity, RECENT_SAMPLES), float)
+        self.pending = grow(
+            getattr(self, "pending", None),
+            (B, capacity, ACTION_COUNT, self.delay_slots),
+            np.int16,
+        )
+        self.active = grow(getattr(self, "active", None), (B, capacity, ACTION_COUNT), np.int32)
+        self.enqueued_at = grow(
+            getattr(self, "enqueued_at", None), (B, capacity, ACTION_COUNT), np.int64
+        )
+
+        self.capacity = capacity
+
+    def valid(self) -> np.ndarray:
+        return np.arange(self.capacity)[None, :] < self.n[:, None]
+
+    def compact(self, removed: np.ndarray):
+        """Drops the removed cars keeping the order of the rest"""
+        rows = np.flatnonzero(removed.any(axis=1))
+        if len(rows) == 0:
+            return
+
+        keep = self.valid()[rows] & ~removed[rows]
+        order = np.argsort(~keep, axis=1, kind="stable")
+        counts = keep.sum(axis=1)
+        cleared = np.arange(self.capacity)[None, :] >= counts[:, None]
+
+        for name in CAR_FIELDS:
+            array = getattr(self, name)
+            values = np.take_along_axis(array[rows], order, axis=1)
+            values[cleared] = 0
+            array[rows] = values
+
+        for name in ("recent_v", "recent_a", "pending", "active", "enqueued_at"):
+            array = getattr(self, name)
+            index = order.reshape(order.shape + (1,) * (array.ndim - 2))
+            values = np.take_along_axis(array[rows], index, axis=1)
+            values[cleared] = 0
+            array[rows] = values
+
+        self.n[rows] = counts
+
+    def place_car(self, b: int, parameters: Dict, x: float, attached: bool, frame: int):
+        if self.n[b] == self.capacity:
+            self.allocate(self.capacity * 2)
+
+        i = self.n[b]
+        self.n[b] += 1
+        self.spawned[b] += 1
+
+        vmax = parameters["vmax"] / 3.6
+        self.id[b, i] = self.spawned[b]
+        self.x[b, i] = x
+        self.v[b, i] = parameters["v"] / 3.6
+        self.a[b, i] = parameters["a"]
+        self.vmax[b, i] = vmax
+        self.vd[b, i] = min(parameters["vd"] / 3.6, vmax)
+        self.amax[b, i] = parameters["amax"]
+        self.brake[b, i] = parameters["break_max"]
+        self.throttle[b, i] = parameters["acc_throttle"]
+        self.stopping_acc[b, i] = parameters["acc_stopping"]
+        self.car_length[b, i] = parameters["length"]
+        self.tr[b, i] = min(parameters["tr"], self.MAX_REACTION_TIME)
+        self.random_behavior[b, i] = parameters["has_random_behavior"]
+        # Like Highway.add_car, only cars placed ahead of the entrance get the
+        # highway reference that crashes_upfront, slugish_behavior and the
+        # induced crash of custom_behavior need
+        self.attached[b, i] = attached
+        self.init_frame[b, i] = frame
+        self.crash_frame[b, i] = -1
+
+    def add_first_car(self, b: int):
+        """The first car of simulation.py, placed at 100 m"""
+        parameters = first_car_parameters(self.entrance_rngs[b], self.max_v)
+        self.place_car(b, parameters, x=100, attached=True, frame=0)
+
+    # Actions
+
+    def reaction_delay(self) -> np.ndarray:
+        factor = np.where(
+            self.increased_attention,
+            self.INCREASED_ATTENTION_FACTOR,
+            np.where(self.decreased_attention, self.DECREASED_ATTENTION_FACTOR, 1.0),
+        )
+        return self.tr * self.precision * factor
+
+    def enqueue(self, mask: np.ndarray, action: int, due: np.ndarray):
+        """Queues an action for the cars in mask, active until sub-step `due`"""
+        b, i = np.nonzero(mask)
+        if len(b) == 0:
+            return
+        due = np.asarray(due)
+        if due.ndim > 0:
+            due = due[b, i]
+        last = np.clip(np.floor(due).astype(np.int64), self.time, self.time + self.delay_slots - 1)
+        self.pending[b, i, action, last % self.delay_slots] += 1
+        self.active[b, i, action] += 1
+        self.enqueued_at[b, i, action] = self.time
+
+    def keep_only(self, mask: np.ndarray, action: int):
+        """Drops every queued action except `action` for the cars in mask"""
+        others = [code for code in range(ACTION_COUNT) if code != action]
+        for code in others:
+            self.pending[:, :, code][mask] = 0
+            self.active[:, :, code][mask] = 0
+
+    def expire(self):
+        """Removes the entries whose last active sub-step was the previous one"""
+        slot = (self.time - 1) % self.delay_slots
+        self.active -= self.pending[:, :, :, slot]
+        self.pending[:, :, :, slot] = 0
+
+    def resolve(self, valid: np.ndarray):
+        u = self.rng.uniform(size=self.active.shape)
+        if self.backend == "kernel":
+            kernel.resolve(
+                self.n,
+                u,
+                self.a,
+                self.amax,
+                self.brake,
+                self.throttle,
+                self.stopping_acc,
+                self.stopping,
+                self.increased_attention,
+                self.decreased_attention,
+                self.active,
+                self.enqueued_at,
+            )
+            return
+
+        fires = u < 1 - 0.9 ** self.active
+        fires &= valid[:, :, None]
+
+        def accelerate(a):
+            return np.minimum(self.amax, np.maximum(a, 0) + 100 * self.throttle)
+
+        def decelerate(a):
+            return np.maximum(-self.brake, a - 100 * self.stopping_acc / 5)
+
+        # The queue is in order, when both fire the most recently queued one runs last
+        acc = fires[:, :, ACCELERATE]
+        dec = fires[:, :, DECELERATE]
+        acc_last = self.enqueued_at[:, :, ACCELERATE] > self.enqueued_at[:, :, DECELERATE]
+        a = self.a
+        self.a = np.select(
+            [acc & ~dec, dec & ~acc, acc & dec & acc_last, acc & dec],
+            [accelerate(a), decelerate(a), accelerate(decelerate(a)), decelerate(accelerate(a))],
+            a,
+        )
+
+        self.stopping |= fires[:, :, STOP]
+        self.increased_attention |= fires[:, :, INCREASE_ATTENTION]
+        default = fires[:, :, DEFAULT_ATTENTION]
+        self.increased_attention &= ~default
+        self.decreased_attention &= ~default
+
+    # Sub-step
+
+    def step(self):
+        t = self.time
+        valid = self.valid()
+
+        # Tows that are due
+        towed = valid & self.registered & (self.crash_frame + self.crash_remove_delay <= t)
+        if towed.any():
+            self.historic_crash_count += towed.sum(axis=1)
+            self.compact(towed)
+            valid = self.valid()
+
+        self.expire()
+
+        # Physics
+        x_before = self.x.copy()
+        self.x = np.where(valid, self.x + self.v / self.precision, self.x)
+        v = self.v + self.a / self.precision
+        v = np.where(self.stopping, v - self.stopping_acc, v)
+        v = np.maximum(0, np.minimum(v, self.vmax))
+        self.v = np.where(valid, v, 0)
+        self.stopping &= self.v != 0
+
+        # Collisions: leader of i is i - 1, it is seen where it was before moving
+        has_leader = valid.copy()
+        has_leader[:, 0] = False
+        has_follower = np.zeros_like(valid)
+        has_follower[:, :-1] = valid[:, 1:]
+
+        front_gap = np.full(self.x.shape, np.nan)
+        front_gap[:, 1:] = x_before[:, :-1] - (self.x[:, 1:] + self.car_length[:, 1:])
+        front_gap[~has_leader] = np.nan
+        back_gap = np.full(self.x.shape, np.nan)
+        back_gap[:, :-1] = self.x[:, :-1] - (self.x[:, 1:] + self.car_length[:, 1:])
+        back_gap[~has_follower] = np.nan
+
+        with np.errstate(invalid="ignore"):
+            self.crashed |= valid & ((front_gap < 0) | (back_gap < 0))
+
+        crashed_before = np.cumsum(self.crashed, axis=1) - self.crashed
+        crash_ahead = self.attached & (crashed_before > 0)
+
+        leader_v = np.zeros_like(self.v)
+        leader_v[:, 1:] = self.v[:, :-1]
+        leader_a = np.zeros_like(self.a)
+        leader_a[:, 1:] = self.a[:, :-1]
+        leader_stopping = np.zeros_like(self.stopping)
+        leader_stopping[:, 1:] = self.stopping[:, :-1]
+        leader_crashed = np.zeros_like(self.crashed)
+        leader_crashed[:, 1:] = self.crashed[:, :-1]
+
+        # Crashed cars only keep their stops and brake
+        crashed = valid & self.crashed
+        self.keep_only(crashed, STOP)
+        self.enqueue(crashed, DECELERATE, t)
+
+        driving = valid & ~self.crashed
+        self.record_samples(driving)
+
+        self.custom_behavior(driving)
+        self.slugish_behavior(driving, front_gap, has_leader)
+        self.sleepy_behavior(driving)
+        self.behaviour(
+            driving,
+            front_gap,
+            has_leader,
+            crash_ahead,
+            leader_v,
+            leader_a,
+            leader_stopping,
+            leader_crashed,
+        )
+
+        self.resolve(valid)
+
+        self.time_ellapsed[valid] += 1
+
+        self.v_total += np.where(valid, self.v, 0).sum(axis=1)
+        self.a_total += np.where(valid, self.a, 0).sum(axis=1)
+        self.samples_total += self.n
+
+        # New crashes are queued for towing
+        new_crashes = valid & self.crashed & ~self.registered
+        if new_crashes.any():
+            self.registered |= new_crashes
+            self.crash_frame[new_crashes] = t
+            if self.log:
+                self.log_rows(self.crashes_rows, new_crashes, t)
+
+        # Exits
+        exits = valid & (self.x > self.length)
+        if exits.any():
+            self.trip_total += np.where(exits, self.time_ellapsed, 0).sum(axis=1)
+            self.trip_count += exits.sum(axis=1)
+            if self.log:
+                self.log_exits(exits, t)
+            self.compact(exits)
+
+        self.time += 1
+
+        self.spawn(t)
+
+    def record_samples(self, driving: np.ndarray):
+        slot = self.samples % RECENT_SAMPLES
+        b, i = np.nonzero(driving)
+        self.recent_v[b, i, slot[b, i]] = self.v[b, i]
+        self.recent_a[b, i, slot[b, i]] = self.a[b, i]
+        self.samples += driving
+        self.v_sum += np.where(driving, self.v, 0)
+        self.a_sum += np.where(driving, self.a, 0)
+
+    def custom_behavior(self, driving: np.ndarray):
+        # Induced crash: the first car with random behavior (from the back) on
+        # a highway without crashes, after sub-step 3000 and 100 cars
+        t = self.time
+        candidates = (
+            driving
+            & self.random_behavior
+            & self.attached
+            & (self.historic_crash_count == 0)[:, None]
+            & (self.spawned > 100)[:, None]
+        )
+        if t <= 3000 or not candidates.any():
+            return
+        for b in np.flatnonzero(candidates.any(axis=1)):
+            i = np.flatnonzero(candidates[b])[-1]
+            mask = np.zeros_like(driving)
+            mask[b, i] = True
+            self.enqueue(mask, STOP, t + self.reaction_delay())
+            self.crashed[b, i] = True
+            self.historic_crash_count[b] += 1
+
+    def slugish_behavior(self, driving, front_gap, has_leader):
+        t = self.time
+        candidates = driving & self.attached & (self.rng.uniform(size=driving.shape) < 0.01)
+        if not candidates.any():
+            return
+        valid = self.valid()
+        delay = self.reaction_delay()
+        for b, i in zip(*np.nonzero(candidates)):
+            x = self.x[b, i]
+            behind = valid[b] & (self.x[b] < x) & (self.x[b] > x - 10 * self.v[b, i])
+            if (
+                behind.sum() > 10
+                and x > 3000
+                and has_leader[b, i]
+                and front_gap[b, i] > 20 * self.v[b, i]
+            ):
+                mask = np.zeros_like(driving)
+                mask[b, i] = True
+                for k in range(10):
+                    self.enqueue(mask, ACCELERATE, t + delay + k)
+
+    def sleepy_behavior(self, driving: np.ndarray):
+        enough = driving & (self.samples > RECENT_SAMPLES)
+        calm = ~self.increased_attention
+        u = self.rng.uniform(size=(2,) + driving.shape)
+        sleepy = enough & calm & (
+            ((self.recent_a.std(axis=2) < 0.1) & (u[0] < 0.2))
+            | ((self.recent_v.std(axis=2) < 0.1) & (u[1] < 0.2))
+        )
+        self.decreased_attention = np.where(driving, sleepy, self.decreased_attention)
+
+    def behaviour(
+        self,
+        driving,
+        front_gap,
+        has_leader,
+        crash_ahead,
+        leader_v,
+        leader_a,
+        leader_stopping,
+        leader_crashed,
+    ):
+        t = self.time
+        v = self.v
+        gap = np.where(has_leader, front_gap, np.inf)
+        u = self.rng.uniform(size=(2,) + v.shape)
+        noise = self.rng.standard_normal(v.shape)
+        if self.backend == "kernel":
+            kernel.behaviour(
+                self.n,
+                t,
+                driving,
+                v,
+                self.vd,
+                self.tr,
+                self.stopping,
+                self.increased_attention,
+                self.decreased_attention,
+                self.reaction_delay(),
+                front_gap,
+                has_leader,
+                crash_ahead,
+                leader_v,
+                leader_a,
+                leader_stopping,
+                leader_crashed,
+                u,
+                noise,
+                self.pending,
+                self.active,
+                self.enqueued_at,
+            )
+            return
+
+        inc = self.increased_attention
+        dec = self.decreased_attention
+
+        # Attention
+        alert = crash_ahead | (has_leader & leader_stopping & (gap <= 5 * v) & (u[0] < 0.5))
+        self.enqueue(driving & alert & ~inc, INCREASE_ATTENTION, t + 1)
+        self.enqueue(driving & ~alert & inc, DEFAULT_ATTENTION, t + 1)
+
+        delay = t + self.reaction_delay()
+        acting = driving & ~self.stopping
+        reacts = self.tr > 0
+
+        # Front car crashed
+        front_crash = acting & has_leader & leader_crashed
+        stop = front_crash & (gap <= 8 * v)
+        self.enqueue(stop, STOP, delay)
+        self.keep_only(stop, STOP)
+
+        # Front car close, or close and braking harder than perceived
+        threshold = np.where(reacts, noise * (0.1 - 0.05 * inc + 0.5 * dec), 0)
+        close = (
+            acting
+            & has_leader
+            & ~leader_crashed
+            & ((gap <= 2 * v) | ((gap <= 10 * v) & (leader_a < threshold)))
+        )
+        self.enqueue(close, DECELERATE, delay)
+
+        # Slower than the front car (with an error in the estimation)
+        error = np.where(reacts, u[1] * (5 - 2 * inc + 2 * dec), 0)
+        follow = (
+            acting
+            & has_leader
+            & ~leader_crashed
+            & ~close
+            & (v < leader_v + error)
+            & (v < self.vd)
+        )
+        self.enqueue(follow, ACCELERATE, delay)
+
+        free = acting & ~front_crash & ~close & ~follow & (v < self.vd)
+        self.enqueue(free, ACCELERATE, delay)
+
+    # Inflow
+
+    def spawn(self, frame: int):
+        for b in range(self.replicas):
+            arrivals = self.arrivals[b]
+            self.queued[b] += arrivals.arrivals(frame / self.precision)
+            if arrivals.max_queued is not None:
+                self.queued[b] = min(self.queued[b], arrivals.max_queued)
+            if self.queued[b] == 0 or not self.entrance_free(b):
+                continue
+            self.place_car(
+                b, self.populations[b].next_parameters(), x=0, attached=False, frame=frame
+            )
+            self.queued[b] -= 1
+
+    def entrance_free(self, b: int) -> bool:
+        n = self.n[b]
+        if n == 0:
+            return True
+        back = n - 1
+        if self.x[b, back] <= self.MIN_GAP:
+            return False
+        # Only a back car attached to the highway looks for crashes ahead, like Inflow
+        if not self.attached[b, back]:
+            return True
+        crashes = self.registered[b, :n].sum() - self.registered[b, back]
+        return crashes == 0 or self.entrance_rngs[b].uniform() < self.escape_probability
+
+    # Logs
+
+    def leader_ids(self) -> np.ndarray:
+        ids = np.full(self.id.shape, -1)
+        ids[:, 1:] = self.id[:, :-1]
+        return ids
+
+    def follower_ids(self) -> np.ndarray:
+        ids = np.full(self.id.shape, -1)
+        ids[:, :-1] = self.id[:, 1:]
+        ids[~self.valid()] = -1
+        return ids
+
+    def log_rows(self, rows: List[List], mask: np.ndarray, frame: int):
+        f_ids = self.leader_ids()
+        b_ids = np.where(
+            np.arange(self.capacity)[None, :] + 1 < self.n[:, None], self.follower_ids(), -1
+        )
+        for b in np.flatnonzero(mask.any(axis=1)):
+            m = mask[b]
+            rows[b].append(
+                np.column_stack(
+                    [
+                        np.full(m.sum(), frame),
+                        self.id[b, m],
+                        self.x[b, m],
+                        self.v[b, m],
+                        self.a[b, m],
+                        self.time_ellapsed[b, m] / self.precision,
+                        f_ids[b, m],
+                        b_ids[b, m],
+                    ]
+                )
+            )
+
+    def log_exits(self, exits: np.ndarray, frame: int):
+        samples = np.maximum(self.samples, 1)
+        for b in np.flatnonzero(exits.any(axis=1)):
+            m = exits[b]
+            self.exits_rows[b].append(
+                np.column_stack(
+                    [
+                        np.full(m.sum(), frame),
+                        self.id[b, m],
+                        np.where(self.samples[b, m] > 0, self.v_sum[b, m] / samples[b, m], 0),
+                        np.where(self.samples[b, m] > 0, self.a_sum[b, m] / samples[b, m], 0),
+                        self.time_ellapsed[b, m] / self.precision,
+                        self.init_frame[b, m],
+                    ]
+                )
+            )
+
+    def log_frame(self, frame: int):
+        samples = np.maximum(self.samples_total, 1)
+        trips = np.maximum(self.trip_count, 1)
+        for b in range(self.replicas):
+            self.agp_rows[b].append(
+                [
+                    frame,
+                    self.n[b],
+                    self.spawned[b],
+                    self.historic_crash_count[b],
+                    self.historic_crash_count[b],
+                    self.v_total[b] / samples[b],
+                    self.a_total[b] / samples[b],
+                    self.trip_total[b] / trips[b],
+                ]
+            )
+        self.log_rows(self.cars_rows, self.valid(), frame)
+
+    def run(self, frames: int, progress: bool = True):
+        for frame in tqdm(range(frames), desc="Frames", unit="frame", disable=not progress):
+            for _ in range(self.precision):
+                self.step()
+            if self.log:
+                self.log_frame(frame)
+
+    def replica_logs(self, b: int) -> Dict[str, pd.DataFrame]:
+        """The four logs of a replica, as simulation.py writes them"""
+
+        def frame_of(rows, columns):
+            if len(rows) == 0:
+                return pd.DataFrame(columns=columns)
+            return pd.DataFrame(np.vstack(rows), columns=columns)
+
+        agp_df = pd.DataFrame(self.agp_rows[b], columns=AGP_COLUMNS)
+        agp_df.index = agp_df["frame"].to_numpy()
+        return {
+            "agp_data": agp_df,
+            "cars_data": frame_of(self.cars_rows[b], CARS_COLUMNS),
+            "exits_data": frame_of(self.exits_rows[b], EXITS_COLUMNS),
+            "crashes_data": frame_of(self.crashes_rows[b], CRASHES_COLUMNS),
+        }
+
+    def export_logs(self, b: int, log_dir: str):
+        """Writes the logs of replica b to log_dir in the logs/<ts>/ format"""
+        os.makedirs(log_dir, exist_ok=True)
+        for name, df in self.replica_logs(b).items():
+            df.to_csv(f"{log_dir}/{name}.csv")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Simulate many highway replicas at once")
+    parser.add_argument("--replicas", type=int, help="Number of replicas", default=8)
+    parser.add_argument("--precision", type=int, help="Precision of the simulation", default=100)
+    parser.add_argument("--frames", type=int, help="Number of frames to simulate", default=12000)
+    parser.add_argument("--length", type=int, help="Length of the highway in meters", default=14 * 1000)
+    parser.add_argument("--max_v", type=int, help="Maximum velocity of the cars in km/h", default=100)
+    parser.add_argument("--seed", type=int, help="Seed for the random number generator", default=42)
+    parser.add_argument(
+        "--smart_car_probability", type=float, help="Probability of a smart car", default=0
+    )
+    parser.add_argument("--inflow", type=str, choices=["gap", "poisson"], default="gap")
+    parser.add_argument("--arrival_rate", type=float, help="Cars per hour", default=1800)
+    parser.add_argument("--log", type=bool, help="Log the simulation", default=True)
+    parser.add_argument(
+        "--backend", type=str, choices=["auto", "numpy", "kernel"], default="auto"
+    )
+
+    args = parser.parse_args()
+
+    engine = BatchedHighway(
+        replicas=args.replicas,
+        length=args.length,
+        precision=args.precision,
+        seed=args.seed,
+        max_v=args.max_v,
+        smart_car_probability=args.smart_car_probability,
+        inflow=args.inflow,
+        arrival_rate=args.arrival_rate,
+        log=args.log,
+        backend=args.backend,
+    )
+    engine.run(args.frames)
+
+    if args.log:
+        ts = datetime.now().strftime("%Y-%m-%d_%H-%M-%S")
+        for b in range(args.replicas):
+            engine.export_logs(b, f"logs/{ts}_r{b}")
+        print(f"Logs saved to logs/{ts}_r*")
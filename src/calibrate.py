@@ -0,0 +1,414 @@
+"""
+* Calibration of the driver parameters against target distributions
+* Searches the parameters of the driver population (reaction time, stopping acceleration,
+* share of drivers with random behavior) and the attention factors of Car.get_reaction_time
+* so that the speed, trip time and car count distributions of simulation.py match a target
+* The target is one or more run directories (an observed or reference run in the log
+* format) or a JSON with a list of samples per metric
+* The loss of a candidate is the weighted sum of the KS distances to the target
+
+* Cross-entropy search: the first round samples the bounds (Latin hypercube, plus the
+* current defaults), the next rounds sample a normal around the best candidates so far
+* Every simulation runs on a process pool. A candidate first runs a short screening run on
+* one seed and is rejected when its loss is over reject_factor times the best screening
+* loss, only the rest run the full length on every seed
+* Each stage of a candidate is stored in the result cache, keyed by its configuration, the
+* seeds, the target and the code version, so repeated points and restarted calibrations
+* do not run again
+
+* run: python calibrate.py --target logs/2023-09-10_20-58-50 --rounds 6 --candidates 16 --workers 8
+"""
+
+import argparse
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+
+from car import Car
+from equivalence import ks_2samp, samples
+from inflow import DriverPopulation
+from result_cache import SIMULATION_SOURCES, ResultCache, code_version, config_key
+from runlog import load_run
+from sweep import run_simulation
+
+# Parameters that can be calibrated and the bounds of the search
+SPACE = {
+    "tr_mean": (0.4, 1.2),
+    "tr_std": (0.05, 0.3),
+    "acc_stopping": (0.1, 0.8),
+    "random_behavior_share": (0.0, 1.0),
+    "increased_attention_factor": (0.3, 1.0),
+    "decreased_attention_factor": (1.0, 3.0),
+}
+
+DEFAULTS = {
+    **DriverPopulation.DEFAULT_PARAMETERS,
+    "increased_attention_factor": Car.INCREASED_ATTENTION_FACTOR,
+    "decreased_attention_factor": Car.DECREASED_ATTENTION_FACTOR,
+}
+
+TARGET_METRICS = ["speed", "trip_time", "car_count"]
+
+
+def load_target(paths: List[str], warmup: int, thin: int) -> Dict[str, np.ndarray]:
+    """Samples of every metric of the target
+
+    Args:
+        paths (List[str]): Run directories, or a single JSON with a list of samples per metric
+        warmup (int): Frames skipped at the start of each run
+        thin (int): Keep one frame every `thin` for speed and car count
+
+    Returns:
+        Dict[str, np.ndarray]: Samples per metric
+    """
+    if len(paths) == 1 and paths[0].endswith(".json"):
+        with open(paths[0]) as f:
+            data = json.load(f)
+        return {metric: np.asarray(data.get(metric, []), dtype=float) for metric in TARGET_METRICS}
+
+    logs = []
+    for path in paths:
+        agp_df, cars_df, exits_df, crashes_df = load_run(path)
+        logs.append({"agp_data": agp_df, "cars_data": cars_df, "exits_data": exits_df, "crashes_data": crashes_df})
+    target = {}
+    for metric in TARGET_METRICS:
+        runs = samples(logs, metric, warmup, thin)
+        target[metric] = np.concatenate(runs) if runs else np.empty(0)
+    return target
+
+
+def target_digest(target: Dict[str, np.ndarray]) -> str:
+    digest = hashlib.sha256()
+    for metric in TARGET_METRICS:
+        digest.update(metric.encode())
+        digest.update(np.ascontiguousarray(target[metric], dtype=np.float64).tobytes())
+    return digest.hexdigest()[:16]
+
+
+def run_seed(config: Dict, seed: int, warmup: int, thin: int) -> Optional[Dict[str, np.ndarray]]:
+    """Runs simulation.py once and returns the samples of every metric (in a pool worker)"""
+    log_dir = tempfile.mkdtemp(prefix=f"calibrate_{seed}_")
+    try:
+        if run_simulation({**config, "seed": seed}, log_dir, "npz") != 0:
+            return None
+        # The cars are logged every `thin` frames only, see Calibration.stage
+        agp_df, cars_df, exits_df = load_run(log_dir, tables=["agp_data", "cars_data", "exits_data"])
+        log = {"agp_data": agp_df, "cars_data": cars_df, "exits_data": exits_df}
+        return {metric: samples([log], metric, warmup, thin)[0] for metric in TARGET_METRICS}
+    finally:
+        shutil.rmtree(log_dir, ignore_errors=True)
+
+
+def distances(runs: List[Dict[str, np.ndarray]], target: Dict[str, np.ndarray]) -> Dict:
+    """KS distance of each metric, with the samples of every seed pooled"""
+    metrics = {}
+    for metric in TARGET_METRICS:
+        pooled = np.concatenate([run[metric] for run in runs])
+        d, _ = ks_2samp(pooled, target[metric])
+        # A metric without samples (no exits in a short run) is as far as it gets
+        metrics[f"ks_{metric}"] = 1.0 if np.isnan(d) else d
+        metrics[f"mean_{metric}"] = float(np.mean(pooled)) if len(pooled) else float(np.nan)
+        metrics[f"n_{metric}"] = int(len(pooled))
+    return metrics
+
+
+def loss(metrics: Dict, weights: Dict[str, float]) -> float:
+    return float(sum(weight * metrics[f"ks_{metric}"] for metric, weight in weights.items()))
+
+
+def propose(
+    space: Dict[str, Tuple[float, float]],
+    n: int,
+    rng: np.random.Generator,
+    elite: Optional[pd.DataFrame] = None,
+    min_spread: float = 0.05,
+) -> List[Dict[str, float]]:
+    """Candidates of a round
+
+    Args:
+        space (Dict[str, Tuple[float, float]]): Bounds of each calibrated parameter
+        n (int): Candidates
+        rng (np.random.Generator): Random generator of the search
+        elite (Optional[pd.DataFrame], optional): Best candidates so far. Defaults to None (Latin hypercube).
+        min_spread (float, optional): Smallest standard deviation, relative to the bounds. Defaults to 0.05.
+
+    Returns:
+        List[Dict[str, float]]: Parameters of each candidate, rounded so that close points share a cache entry
+    """
+    names = list(space)
+    low = np.array([space[name][0] for name in names])
+    high = np.array([space[name][1] for name in names])
+
+    if elite is None or len(elite) == 0:
+        # One stratum per candidate in every dimension
+        strata = np.array([rng.permutation(n) for _ in names]).T
+        points = low + (strata + rng.uniform(size=strata.shape)) / n * (high - low)
+    else:
+        values = elite[names].to_numpy(dtype=float)
+        mean = values.mean(axis=0)
+        std = np.maximum(values.std(axis=0), min_spread * (high - low))
+        points = np.clip(rng.normal(mean, std, size=(n, len(names))), low, high)
+
+    return [{name: round(float(value), 4) for name, value in zip(names, point)} for point in points]
+
+
+class Calibration:
+    """Search state: the pool, the cache and every evaluated candidate
+
+    Args:
+        target (Dict[str, np.ndarray]): Samples of the target per metric
+        space (Dict[str, Tuple[float, float]]): Bounds of the calibrated parameters
+        scenario (Dict): Arguments of simulation.py shared by every run
+        seeds (List[int]): Seeds of a full evaluation
+        cache (ResultCache): Result cache
+        frames (int, optional): Frames of a full run. Defaults to 2400.
+        screen_frames (Optional[int], optional): Frames of the screening run, None to skip it. Defaults to 600.
+        reject_factor (float, optional): Rejected when the screening loss is over this times the best one. Defaults to 1.5.
+        warmup (int, optional): Frames skipped at the start of each run. Defaults to 100.
+        thin (int, optional): Keep one frame every `thin`. Defaults to 10.
+        weights (Optional[Dict[str, float]], optional): Weight of each metric in the loss. Defaults to 1 each.
+        workers (int, optional): Simulations at the same time. Defaults to 4.
+    """
+
+    def __init__(
+        self,
+        target: Dict[str, np.ndarray],
+        space: Dict[str, Tuple[float, float]],
+        scenario: Dict,
+        seeds: List[int],
+        cache: ResultCache,
+        frames: int = 2400,
+        screen_frames: Optional[int] = 600,
+        reject_factor: float = 1.5,
+        warmup: int = 100,
+        thin: int = 10,
+        weights: Optional[Dict[str, float]] = None,
+        workers: int = 4,
+    ):
+        if screen_frames is not None and screen_frames <= warmup:
+            raise ValueError("The screening run must be longer than the warm-up")
+        self.target = target
+        self.space = space
+        self.scenario = scenario
+        self.seeds = seeds
+        self.cache = cache
+        self.frames = frames
+        self.screen_frames = screen_frames if screen_frames is not None and screen_frames < frames else None
+        self.reject_factor = reject_factor
+        self.warmup = warmup
+        self.thin = thin
+        self.weights = weights or {metric: 1.0 for metric in TARGET_METRICS}
+        self.workers = workers
+
+        # The cached losses also depend on how the samples are compared
+        self.version = code_version(SIMULATION_SOURCES + ["calibrate.py", "equivalence.py"])
+        self.target_key = target_digest(target)
+        self.best_screen = np.inf
+        self.rows = []
+        self.simulations = 0
+        self.cache_hits = 0
+
+    def stage(self, parameters: Dict, stage: str) -> Tuple[Dict, List[int], str]:
+        """Configuration, seeds and cache key of a stage (screen or full) of a candidate"""
+        frames = self.screen_frames if stage == "screen" else self.frames
+        seeds = self.seeds[:1] if stage == "screen" else self.seeds
+        config = {**self.scenario, **parameters, "frames": frames, "log_policy": f"every:{self.thin}"}
+        key = config_key(
+            {
+                "calibration": config,
+                "seeds": seeds,
+                "target": self.target_key,
+                "warmup": self.warmup,
+                "thin": self.thin,
+            },
+            self.version,
+        )
+        return config, seeds, key
+
+    def evaluate(self, candidates: List[Dict], iteration: int, executor: ProcessPoolExecutor) -> List[Dict]:
+        """Screens and evaluates the candidates of a round, as their runs finish"""
+        rows = [{"round": iteration, **parameters, "status": "pending"} for parameters in candidates]
+        pending = {}
+        runs = {}
+
+        def submit(i: int, stage: str):
+            config, seeds, key = self.stage(candidates[i], stage)
+            entry = self.cache.get(key)
+            if entry is not None:
+                self.cache_hits += 1
+                finish(i, stage, entry["metrics"])
+                return
+            runs[i, stage] = []
+            for seed in seeds:
+                pending[executor.submit(run_seed, config, seed, self.warmup, self.thin)] = (i, stage)
+                self.simulations += 1
+
+        def finish(i: int, stage: str, metrics: Dict):
+            row = rows[i]
+            value = loss(metrics, self.weights)
+            if stage == "screen":
+                row["screen_loss"] = value
+                self.best_screen = min(self.best_screen, value)
+                if value > self.reject_factor * self.best_screen:
+                    row["status"] = "rejected"
+                    return
+                submit(i, "full")
+                return
+            row.update({name: metrics[name] for name in metrics if name.startswith("ks_")})
+            row["loss"] = value
+            row["status"] = "done"
+
+        for i in range(len(candidates)):
+            submit(i, "screen" if self.screen_frames is not None else "full")
+
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                i, stage = pending.pop(future)
+                if (i, stage) not in runs:
+                    # Another seed of the stage failed
+                    continue
+                result = future.result()
+                if result is None:
+                    rows[i]["status"] = "failed"
+                    del runs[i, stage]
+                    continue
+                runs[i, stage].append(result)
+                config, seeds, key = self.stage(candidates[i], stage)
+                if len(runs[i, stage]) == len(seeds):
+                    metrics = distances(runs.pop((i, stage)), self.target)
+                    self.cache.put(key, config, metrics)
+                    finish(i, stage, metrics)
+
+        # Saves the last use of the cache hits, put saves only the new entries
+        self.cache.save()
+        self.rows += rows
+        return rows
+
+    def results(self) -> pd.DataFrame:
+        df = pd.DataFrame(self.rows)
+        if "loss" not in df:
+            df["loss"] = np.nan
+        return df.sort_values("loss", na_position="last").reset_index(drop=True)
+
+    def run(self, rounds: int, candidates: int, elite: int = 4, seed: int = 0, include_defaults: bool = True) -> pd.DataFrame:
+        """Cross-entropy search
+
+        Args:
+            rounds (int): Rounds of candidates
+            candidates (int): Candidates per round
+            elite (int, optional): Best candidates the next round samples around. Defaults to 4.
+            seed (int, optional): Seed of the search itself. Defaults to 0.
+            include_defaults (bool, optional): Evaluate the current defaults in the first round. Defaults to True.
+
+        Returns:
+            pd.DataFrame: Every candidate, best first
+        """
+        rng = np.random.default_rng(seed)
+        started = time.perf_counter()
+        with ProcessPoolExecutor(max_workers=self.workers) as executor:
+            for iteration in range(rounds):
+                done = self.results()
+                done = done[done["status"] == "done"].head(elite) if len(done) else None
+                proposals = propose(self.space, candidates, rng, done if iteration > 0 else None)
+                if iteration == 0 and include_defaults:
+                    proposals[0] = {name: DEFAULTS[name] for name in self.space}
+
+                rows = self.evaluate(proposals, iteration, executor)
+
+                best = self.results().iloc[0]
+                statuses = pd.Series([row["status"] for row in rows]).value_counts().to_dict()
+                print(
+                    f"Round {iteration + 1}/{rounds}: {statuses}, best loss {best['loss']:.4f} "
+                    f"({', '.join(f'{name}={best[name]}' for name in self.space)}), "
+                    f"{self.simulations} simulations, {self.cache_hits} cached, "
+                    f"{time.perf_counter() - started:.0f} s"
+                )
+        return self.results()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Calibrate the driver parameters against target distributions")
+    parser.add_argument("--target", type=str, nargs="+", required=True, help="Target run directories or a JSON of samples per metric")
+    parser.add_argument(
+        "--parameters",
+        type=str,
+        nargs="+",
+        choices=list(SPACE),
+        help="Parameters to calibrate, the rest keep their defaults. Defaults to all",
+        default=list(SPACE),
+    )
+    parser.add_argument(
+        "--bounds",
+        type=str,
+        nargs=3,
+        action="append",
+        metavar=("NAME", "LOW", "HIGH"),
+        help="Bounds of a parameter, can be repeated",
+        default=[],
+    )
+    parser.add_argument("--rounds", type=int, help="Rounds of the search", default=6)
+    parser.add_argument("--candidates", type=int, help="Candidates per round", default=16)
+    parser.add_argument("--elite", type=int, help="Best candidates the next round samples around", default=4)
+    parser.add_argument("--seeds", type=int, nargs="+", help="Seeds of a full evaluation", default=[1, 2, 3])
+    parser.add_argument("--frames", type=int, help="Frames of a full run", default=2400)
+    parser.add_argument("--screen_frames", type=int, help="Frames of the screening run, 0 to skip it", default=600)
+    parser.add_argument("--reject_factor", type=float, help="Reject over this times the best screening loss", default=1.5)
+    parser.add_argument("--warmup", type=int, help="Frames skipped at the start of each run", default=100)
+    parser.add_argument("--thin", type=int, help="Keep one frame every thin", default=10)
+    parser.add_argument("--weights", type=float, nargs=3, metavar=("SPEED", "TRIP_TIME", "CAR_COUNT"), default=[1, 1, 1])
+    parser.add_argument("--workers", type=int, help="Simulations at the same time", default=os.cpu_count() or 1)
+    parser.add_argument("--precision", type=int, help="Precision of the runs", default=10)
+    parser.add_argument("--length", type=int, help="Length of the highway in meters", default=14 * 1000)
+    parser.add_argument("--max_v", type=int, help="Maximum velocity in km/h", default=100)
+    parser.add_argument("--inflow", type=str, help="Arrival process: gap, poisson", default="gap")
+    parser.add_argument("--arrival_rate", type=float, help="Poisson arrival rate in cars per hour", default=1800)
+    parser.add_argument("--search_seed", type=int, help="Seed of the search", default=0)
+    parser.add_argument("--cache_dir", type=str, help="Result cache directory", default="cache")
+    parser.add_argument("--output", type=str, help="CSV with every candidate", default="calibration_results.csv")
+
+    args = parser.parse_args()
+
+    space = {name: SPACE[name] for name in args.parameters}
+    for name, low, high in args.bounds:
+        if name not in space:
+            parser.error(f"{name} is not calibrated, add it to --parameters")
+        space[name] = (float(low), float(high))
+
+    target = load_target(args.target, args.warmup, args.thin)
+    print(", ".join(f"{metric}: {len(values)} target samples" for metric, values in target.items()))
+
+    calibration = Calibration(
+        target,
+        space,
+        scenario={
+            "precision": args.precision,
+            "length": args.length,
+            "max_v": args.max_v,
+            "inflow": args.inflow,
+            "arrival_rate": args.arrival_rate,
+        },
+        seeds=args.seeds,
+        cache=ResultCache(args.cache_dir),
+        frames=args.frames,
+        screen_frames=args.screen_frames or None,
+        reject_factor=args.reject_factor,
+        warmup=args.warmup,
+        thin=args.thin,
+        weights=dict(zip(TARGET_METRICS, args.weights)),
+        workers=args.workers,
+    )
+    results = calibration.run(args.rounds, args.candidates, args.elite, args.search_seed)
+    results.to_csv(args.output)
+
+    best = results.iloc[0]
+    print(results.head(10).to_string())
+    print("python simulation.py " + " ".join(f"--{name} {best[name]}" for name in space))
@@ -2,8 +2,64 @@ from typing import Optional
 
 import numpy as np
 
+# Action codes, dispatched through Car.ACTIONS
+ACCELERATE = 0
+DECELERATE = 1
+STOP = 2
+KEEP_VELOCITY = 3
+INCREASE_ATTENTION = 4
+DEFAULT_ATTENTION = 5
+
+# Samples kept to detect a monotonous drive (sleepy behavior)
+RECENT_SAMPLES = 10
+
 
 class Car:
+    __slots__ = (
+        "id",
+        "time_ellapsed",
+        "x",
+        "v",
+        "vmax",
+        "desired_velocity",
+        "a",
+        "amax",
+        "max_brake_acc",
+        "throttle_acc",
+        "stopping_acc",
+        "length",
+        "reaction_time",
+        "f_car",
+        "b_car",
+        "will_measure",
+        "crashed",
+        "init_frame",
+        "action_queue",
+        "highway",
+        "increased_attention",
+        "decresed_attention",
+        "stopping",
+        "samples",
+        "velocity_sum",
+        "acceleration_sum",
+        "recent_velocities",
+        "recent_accelerations",
+        "precision",
+        "has_random_behavior",
+        "gaps_cached",
+        "front_gap",
+        "back_gap",
+        "crash_ahead",
+        "lane",
+        "lane_frame",
+    )
+
+    POSIBLE_ACTIONS = (ACCELERATE, DECELERATE, STOP, KEEP_VELOCITY)
+
+    # Reaction time multipliers of an attentive and a distracted driver (see calibrate.py)
+    INCREASED_ATTENTION_FACTOR = 0.5
+    DECREASED_ATTENTION_FACTOR = 1.8
+
     def __init__(
         self,
         x: float,
@@ -92,20 +148,27 @@ class Car:
 
         self.stopping = False
 
-        self.posible_actions = [
-            self.accelerate,
-            self.decelerate,
-            self.stop,
-            self.keep_velocity,
-        ]
-
-        self.historic_velocities = []
-        self.historic_accelerations = []
+        # Running sums instead of the full history
+        self.samples = 0
+        self.velocity_sum = 0.0
+        self.acceleration_sum = 0.0
+        self.recent_velocities = []
+        self.recent_accelerations = []
 
         self.precision = 1
 
         self.has_random_behavior = has_random_behavior
 
+        # Filled once per sub-step by Highway.detect_collisions
+        self.gaps_cached = False
+        self.front_gap = None
+        self.back_gap = None
+        self.crash_ahead = False
+
+        # Lane of a multi-lane highway and sub-step of the last lane change
+        self.lane = 0
+        self.lane_frame = None
+
     def __str__(self):
         return f"Car(x={self.x}, v={self.v}, vmax={self.vmax}, a={self.a}, l={self.length}, tr={self.get_reaction_time()}, vd={self.desired_velocity}, fc={self.f_car.id}, bc={self.b_car.id})"
 
@@ -115,6 +178,21 @@ class Car:
     def __eq__(self, other):
         return self.id == other.id
 
+    def __getstate__(self):
+        # The neighbours are left out, pickling them would follow the whole chain of cars
+        # (the Highway pickles them as indices, see Highway.__getstate__)
+        return {
+            name: getattr(self, name)
+            for name in self.__slots__
+            if name not in ("f_car", "b_car") and hasattr(self, name)
+        }
+
+    def __setstate__(self, state):
+        self.f_car = None
+        self.b_car = None
+        for name, value in state.items():
+            setattr(self, name, value)
+
     def set_precision(self, precision):
         self.precision = precision
 
@@ -124,9 +202,6 @@ class Car:
             and self.distance_to_front_car()
             and self.distance_to_front_car() <= 0
         ):
-            print(
-                f"Car {self.id} crashed at frame {self.time_ellapsed} in position {self.x} to car {self.f_car.id}"
-            )
             self.crashed = True
 
     def check_rear_end(self):
@@ -135,14 +210,13 @@ class Car:
             and self.distance_to_back_car()
             and self.distance_to_back_car() <= 0
         ):
-            print(
-                f"Car {self.id} rear-ended at frame {self.time_ellapsed} in position {self.x}"
-            )
             self.crashed = True
 
     def has_collided(self):
-        self.check_frontal_crash()
-        self.check_rear_end()
+        # When the highway already ran its collision pass, the flag is up to date
+        if not self.gaps_cached:
+            self.check_frontal_crash()
+            self.check_rear_end()
         return self.crashed
 
     def accelerate(self):
@@ -169,6 +243,8 @@ class Car:
         Returns:
             float: Front Car X - Car X
         """
+        if self.gaps_cached:
+            return self.front_gap
         if self.f_car is not None:
             return self.f_car.x - (self.x + self.length)
         else:
@@ -181,6 +257,8 @@ class Car:
         Returns:
             float: Car X - Back Car X
         """
+        if self.gaps_cached:
+            return self.back_gap
         if self.b_car is not None:
             return self.x - (self.b_car.x + self.b_car.length)
         else:
@@ -192,6 +270,23 @@ class Car:
     def get_velocity(self):
         return self.v
 
+    def record_sample(self):
+        self.samples += 1
+        self.velocity_sum += self.v
+        self.acceleration_sum += self.a
+
+        self.recent_velocities.append(self.v)
+        self.recent_accelerations.append(self.a)
+        if len(self.recent_velocities) > RECENT_SAMPLES:
+            del self.recent_velocities[0]
+            del self.recent_accelerations[0]
+
+    def get_avg_velocity(self) -> float:
+        return self.velocity_sum / self.samples if self.samples > 0 else 0
+
+    def get_avg_acceleration(self) -> float:
+        return self.acceleration_sum / self.samples if self.samples > 0 else 0
+
     def dead_stop(self):
         self.v = 0
         self.a = 0
@@ -226,16 +321,23 @@ class Car:
     def update(self, frame: int):
 
         self.physics()
+        self.decide(frame)
+
+    def decide(self, frame: int):
+        """Decision making and action resolution, after physics and collisions
+
+        Args:
+            frame (int): Current frame
+        """
 
         if self.has_collided():
-            self.action_queue = list(
-                filter(lambda x: x[0] == self.stop, self.action_queue)
-            )
-            self.action_queue.append((self.decelerate, frame))
+            self.action_queue = [
+                action for action in self.action_queue if action[0] == STOP
+            ]
+            self.action_queue.append((DECELERATE, frame))
         else:
 
-            self.historic_velocities.append(self.v)
-            self.historic_accelerations.append(self.a)
+            self.record_sample()
 
             # Decision making
 
@@ -257,20 +359,47 @@ class Car:
 
     def resolve_actions(self, frame):
         for action, action_frame in self.action_queue:
-            # print(f"Car {self.id} took action {action.__name__} at frame {frame}")
             if frame <= action_frame:
                 p = np.random.uniform()
                 if p < 0.1:
-                    for _ in range(100):
-                        action()
+                    self.repeat_action(action, 100)
                 if p < 0.07:
-                    action()
+                    self.repeat_action(action, 1)
 
         # Remove actions that have been taken
         self.action_queue = [
             action_pair for action_pair in self.action_queue if action_pair[1] >= frame
         ]
 
+    def repeat_action(self, action: int, times: int):
+        """Runs an action `times` times
+
+        Stops as soon as more calls would not change the state: accelerate and
+        decelerate saturate at their limits, the other actions are idempotent.
+
+        Args:
+            action (int): Action code
+            times (int): Number of calls
+        """
+        if times <= 0:
+            return
+        method = Car.ACTIONS[action]
+        if action == ACCELERATE and self.throttle_acc > 0:
+            for _ in range(times):
+                method(self)
+                if self.a == self.amax:
+                    return
+        elif action == DECELERATE and self.stopping_acc > 0:
+            for _ in range(times):
+                method(self)
+                if self.a == -self.max_brake_acc:
+                    return
+        elif action == ACCELERATE or action == DECELERATE:
+            for _ in range(times):
+                method(self)
+        else:
+            method(self)
+
     def increase_attention(self):
         self.increased_attention = True
 
@@ -280,13 +409,15 @@ class Car:
 
     def get_reaction_time(self):
         if self.increased_attention:
-            return self.reaction_time / 2 * self.precision
+            return self.reaction_time * self.INCREASED_ATTENTION_FACTOR * self.precision
         elif self.decresed_attention:
-            return self.reaction_time * 1.8 * self.precision
+            return self.reaction_time * self.DECREASED_ATTENTION_FACTOR * self.precision
         return self.reaction_time * self.precision
 
     def crashes_upfront(self):
         if self.highway:
+            if self.gaps_cached:
+                return self.crash_ahead
             for car in self.highway.get_cars():
                 if car != self and car.x > self.x and car.has_collided():
                     return True
@@ -297,10 +428,7 @@ class Car:
         # but not a close one in front of me
         # , I will increase my speed
         if self.highway and np.random.uniform() < 0.01:
-            cars_close_behind = 0
-            for car in self.highway.get_cars():
-                if car != self and car.x < self.x and car.x > self.x - 10 * self.v:
-                    cars_close_behind += 1
+            cars_close_behind = self.highway.count_cars_behind(self.x, 10 * self.v)
 
             if (
                 cars_close_behind > 10
@@ -311,7 +439,7 @@ class Car:
 
                 for i in range(10):
                     self.action_queue.append(
-                        (self.accelerate, frame + self.get_reaction_time() + i)
+                        (ACCELERATE, frame + self.get_reaction_time() + i)
                     )
 
     def sleepy_behavior(self, frame):
@@ -319,15 +447,15 @@ class Car:
         # enter Decresed Attention mode
 
         if (
-            len(self.historic_accelerations) > 10
+            self.samples > RECENT_SAMPLES
             and (
-                np.std(self.historic_accelerations[-10:]) < 0.1
+                np.std(self.recent_accelerations) < 0.1
                 and not self.increased_attention
                 and np.random.uniform() < 0.2
             )
-            or (len(self.historic_velocities) > 10)
+            or (self.samples > RECENT_SAMPLES)
             and (
-                np.std(self.historic_velocities[-10:]) < 0.1
+                np.std(self.recent_velocities) < 0.1
                 and not self.increased_attention
                 and np.random.uniform() < 0.2
             )
@@ -341,15 +469,17 @@ class Car:
             low = np.random.uniform(1000, 9000)
             high = np.random.uniform(low, 10000)
             if self.x < low and self.x > high:
-                random_action = np.random.choice(self.posible_actions)
+                random_action = np.random.choice(self.POSIBLE_ACTIONS)
                 # random_action = self.decelerate
                 for i in range(100):
                     self.action_queue.append(
                         (random_action, frame + self.get_reaction_time() + i)
                     )
-                self.action_queue = list(
-                    filter(lambda x: x[0] == random_action, self.action_queue)
-                )
+                self.action_queue = [
+                    action
+                    for action in self.action_queue
+                    if action[0] == random_action
+                ]
 
         if (
             self.highway
@@ -357,7 +487,7 @@ class Car:
             and frame > 3000
             and len(self.highway.historic_ids) > 100
         ):
-            self.action_queue.append((self.stop, frame + self.get_reaction_time()))
+            self.action_queue.append((STOP, frame + self.get_reaction_time()))
             self.crashed = True
             self.highway.historic_crash_count += 1
 
@@ -378,10 +508,10 @@ class Car:
             and np.random.uniform() < 0.5
         ):
             if not self.increased_attention:
-                self.action_queue.append((self.increase_attention, frame + 1))
+                self.action_queue.append((INCREASE_ATTENTION, frame + 1))
         else:
             if self.increased_attention:
-                self.action_queue.append((self.default_attention, frame + 1))
+                self.action_queue.append((DEFAULT_ATTENTION, frame + 1))
 
         if not self.stopping:
             should_acc = True
@@ -391,11 +521,11 @@ class Car:
                     should_acc = False
                     if self.distance_to_front_car() <= 8 * self.v:
                         self.action_queue.append(
-                            (self.stop, frame + self.get_reaction_time())
-                        )
-                        self.action_queue = list(
-                            filter(lambda x: x[0] == self.stop, self.action_queue)
+                            (STOP, frame + self.get_reaction_time())
                         )
+                        self.action_queue = [
+                            action for action in self.action_queue if action[0] == STOP
+                        ]
                 elif (self.distance_to_front_car() <= 2 * self.v) or (
                     (self.distance_to_front_car() <= 10 * self.v)
                     and self.f_car.a
@@ -411,7 +541,7 @@ class Car:
                     # Front car is close and decelerating
                     should_acc = False
                     self.action_queue.append(
-                        (self.decelerate, frame + self.get_reaction_time())
+                        (DECELERATE, frame + self.get_reaction_time())
                     )
                 elif (
                     self.v
@@ -427,10 +557,21 @@ class Car:
                     # Error factor as to simulate an approximation
                     should_acc = False
                     self.action_queue.append(
-                        (self.accelerate, frame + self.get_reaction_time())
+                        (ACCELERATE, frame + self.get_reaction_time())
                     )
 
             if self.v < self.desired_velocity and should_acc:
                 self.action_queue.append(
-                    (self.accelerate, frame + self.get_reaction_time())
+                    (ACCELERATE, frame + self.get_reaction_time())
                 )
+
+
+# Indexed by action code
+Car.ACTIONS = (
+    Car.accelerate,
+    Car.decelerate,
+    Car.stop,
+    Car.keep_velocity,
+    Car.increase_attention,
+    Car.default_attention,
+)
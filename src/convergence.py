@@ -0,0 +1,231 @@
+"""
+* Convergence based early stopping
+* The end of the warm-up is found with MSER-5 and the confidence interval of each
+* metric is estimated with batch means over the data after the warm-up
+* The run stops when every metric reaches the target relative precision. Rates (crash_rate)
+* use an absolute half width instead: with no crashes the mean is 0 and a relative precision
+* could never be reached
+
+* Metrics:
+* v           mean speed of the cars on the highway in each frame (km/h)
+* t_d         trip duration of each car that exits (s)
+* crash_rate  crashes per frame
+"""
+
+import json
+from statistics import NormalDist
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+METRICS = ["v", "t_d", "crash_rate"]
+
+# Metrics whose precision is an absolute half width (events per frame)
+RATE_METRICS = ["crash_rate"]
+
+
+def mser(series: np.ndarray, batch_size: int = 5) -> int:
+    """Warm-up length with MSER (Marginal Standard Error Rule) on batches of `batch_size`
+
+    Args:
+        series (np.ndarray): Observations in order
+        batch_size (int, optional): Observations per batch, 5 is MSER-5. Defaults to 5.
+
+    Returns:
+        int: Observations to discard
+    """
+    batches = len(series) // batch_size
+    if batches < 4:
+        return 0
+    y = np.asarray(series[: batches * batch_size], dtype=float).reshape(batches, batch_size).mean(axis=1)
+
+    # Only truncations that keep at least half of the batches are considered
+    best, best_d = np.inf, 0
+    for d in range(batches // 2 + 1):
+        z = y[d:]
+        statistic = np.sum((z - z.mean()) ** 2) / len(z) ** 2
+        if statistic < best:
+            best, best_d = statistic, d
+    return best_d * batch_size
+
+
+def t_quantile(confidence: float, df: int) -> float:
+    """Two sided Student t quantile, Cornish-Fisher expansion around the normal one"""
+    z = NormalDist().inv_cdf(1 - (1 - confidence) / 2)
+    g1 = (z**3 + z) / 4
+    g2 = (5 * z**5 + 16 * z**3 + 3 * z) / 96
+    g3 = (3 * z**7 + 19 * z**5 + 17 * z**3 - 15 * z) / 384
+    g4 = (79 * z**9 + 776 * z**7 + 1482 * z**5 - 1920 * z**3 - 945 * z) / 92160
+    return z + g1 / df + g2 / df**2 + g3 / df**3 + g4 / df**4
+
+
+def batch_means(series: np.ndarray, batches: int = 20, confidence: float = 0.95) -> Tuple[float, float]:
+    """Mean and confidence interval half width with non overlapping batch means
+
+    Args:
+        series (np.ndarray): Observations after the warm-up
+        batches (int, optional): Number of batches. Defaults to 20.
+        confidence (float, optional): Confidence level. Defaults to 0.95.
+
+    Returns:
+        Tuple[float, float]: Mean and half width
+    """
+    size = len(series) // batches
+    if size == 0:
+        return float(np.mean(series)) if len(series) else np.nan, np.inf
+    means = np.asarray(series[: batches * size], dtype=float).reshape(batches, size).mean(axis=1)
+    half_width = t_quantile(confidence, batches - 1) * means.std(ddof=1) / np.sqrt(batches)
+    return float(means.mean()), float(half_width)
+
+
+class ConvergenceMonitor:
+    """Tracks the metrics of a run and decides when to stop
+
+    Args:
+        metrics (List[str]): Metrics that must converge, see METRICS
+        rel_precision (float, optional): Target half width over mean. Defaults to 0.05.
+        confidence (float, optional): Confidence level. Defaults to 0.95.
+        batches (int, optional): Batches of the batch means. Defaults to 20.
+        min_batch_size (int, optional): Observations per batch needed to check. Defaults to 5.
+        check_every (int, optional): Frames between checks. Defaults to 100.
+        rate_tolerance (float, optional): Target half width of the rate metrics, in events per frame. Defaults to 0.001.
+    """
+
+    def __init__(
+        self,
+        metrics: List[str],
+        rel_precision: float = 0.05,
+        confidence: float = 0.95,
+        batches: int = 20,
+        min_batch_size: int = 5,
+        check_every: int = 100,
+        rate_tolerance: float = 0.001,
+    ):
+        unknown = [metric for metric in metrics if metric not in METRICS]
+        if unknown:
+            raise ValueError(f"Unknown metrics: {', '.join(unknown)}")
+        if rel_precision <= 0:
+            raise ValueError("rel_precision must be positive")
+        if rate_tolerance < 0:
+            raise ValueError("rate_tolerance can not be negative")
+
+        self.metrics = metrics
+        self.rel_precision = rel_precision
+        self.confidence = confidence
+        self.batches = batches
+        self.min_batch_size = min_batch_size
+        self.check_every = check_every
+        self.rate_tolerance = rate_tolerance
+
+        self.series = {metric: [] for metric in METRICS}
+        self.frame_crashes = 0
+        self.checks = []
+        self.decision = None
+
+    # Hooks for Highway.update
+
+    def record_exit(self, car, frame: int):
+        # On a ring road the trip is the lap that just ended
+        highway = car.highway
+        duration = highway.trip_duration(car) if highway is not None and highway.ring else car.time_ellapsed
+        self.series["t_d"].append(duration / car.precision)
+
+    def record_crash(self, car, frame: int):
+        self.frame_crashes += 1
+
+    def end_frame(self, frame: int, cars: List):
+        if len(cars) > 0:
+            self.series["v"].append(3.6 * sum(car.v for car in cars) / len(cars))
+        self.series["crash_rate"].append(self.frame_crashes)
+        self.frame_crashes = 0
+
+    # Stopping
+
+    def estimate(self, metric: str) -> Dict:
+        series = np.asarray(self.series[metric], dtype=float)
+        warmup = mser(series)
+        data = series[warmup:]
+        rule = "absolute" if metric in RATE_METRICS else "relative"
+        estimate = {"warmup": int(warmup), "n": int(len(data)), "rule": rule}
+        if len(data) < self.batches * self.min_batch_size:
+            return {**estimate, "mean": None, "half_width": None, "relative": None, "converged": False}
+
+        mean, half_width = batch_means(data, self.batches, self.confidence)
+        relative = half_width / abs(mean) if mean != 0 else (0.0 if half_width == 0 else np.inf)
+        if rule == "absolute":
+            converged = half_width <= self.rate_tolerance
+        else:
+            converged = relative <= self.rel_precision
+        return {
+            **estimate,
+            "mean": mean,
+            "half_width": half_width,
+            "relative": relative,
+            "converged": bool(converged),
+        }
+
+    def check(self, frame: int) -> bool:
+        """Called after each frame, True when the run can stop"""
+        if self.decision is not None:
+            return True
+        if (frame + 1) % self.check_every != 0:
+            return False
+
+        estimates = {metric: self.estimate(metric) for metric in self.metrics}
+        self.checks.append({"frame": frame, "metrics": estimates})
+
+        if all(estimate["converged"] for estimate in estimates.values()):
+            self.decision = {"stopped": True, "frame": frame, "metrics": estimates}
+            return True
+        return False
+
+    def finish(self, frame: int):
+        """Records the decision of a run that reached its last frame"""
+        if self.decision is None:
+            self.decision = {
+                "stopped": False,
+                "frame": frame,
+                "metrics": {metric: self.estimate(metric) for metric in self.metrics},
+            }
+
+    def describe(self) -> Dict:
+        return {
+            "metrics": self.metrics,
+            "rel_precision": self.rel_precision,
+            "confidence": self.confidence,
+            "batches": self.batches,
+            "min_batch_size": self.min_batch_size,
+            "check_every": self.check_every,
+            "rate_metrics": [metric for metric in self.metrics if metric in RATE_METRICS],
+            "rate_tolerance": self.rate_tolerance,
+        }
+
+    def summary(self) -> str:
+        decision = self.decision
+        if decision is None:
+            return "No decision"
+        parts = []
+        for metric, estimate in decision["metrics"].items():
+            if estimate["mean"] is None:
+                parts.append(f"{metric}: not enough data after a warm-up of {estimate['warmup']}")
+            else:
+                precision = (
+                    f"{estimate['relative'] * 100:.1f}%"
+                    if estimate["rule"] == "relative"
+                    else f"absolute, target ± {self.rate_tolerance}"
+                )
+                parts.append(
+                    f"{metric}: {estimate['mean']:.3f} ± {estimate['half_width']:.3f} "
+                    f"({precision}, warm-up {estimate['warmup']})"
+                )
+        state = "Converged" if decision["stopped"] else "Not converged"
+        return f"{state} at frame {decision['frame']}: " + ", ".join(parts)
+
+    def save(self, path: Optional[str]):
+        with open(path, "w") as f:
+            json.dump(
+                {"monitor": self.describe(), "decision": self.decision, "checks": self.checks},
+                f,
+                indent=4,
+                default=float,
+            )
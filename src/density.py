@@ -0,0 +1,240 @@
+"""
+* Space-time trajectory plots as a density image
+* Every (time, position) sample of cars_data is binned into a 2D grid with np.bincount,
+* instead of drawing one line per car
+* The grid keeps the sample count and the speed sum of each cell, the image shows the
+* count (log scale) or the mean speed
+* Samples are added chunk by chunk, straight from the log tables (runlog.iter_table)
+
+* Modes:
+* absolute   x: frame (s), y: position (m)
+* relative   x: time since the car entered (s), y: position (m)
+
+* run: python density.py logs/<ts> --mode absolute --color speed --out plots/density.png
+"""
+
+import argparse
+import os
+import time
+from typing import Optional, Tuple
+
+import numpy as np
+import pandas as pd
+from matplotlib.colors import LogNorm
+
+from runlog import iter_table, read_table
+
+MODES = {"absolute": "frame", "relative": "car_t_d"}
+COLORS = ["count", "speed"]
+
+
+class TrajectoryDensity:
+    """2D accumulation grid of trajectory samples
+
+    Args:
+        x_range (Tuple[float, float]): Time range (s)
+        y_range (Tuple[float, float]): Position range (m)
+        shape (Tuple[int, int], optional): Cells along time and position. Defaults to (1200, 600).
+    """
+
+    def __init__(
+        self,
+        x_range: Tuple[float, float],
+        y_range: Tuple[float, float],
+        shape: Tuple[int, int] = (1200, 600),
+    ):
+        if x_range[1] <= x_range[0] or y_range[1] <= y_range[0]:
+            raise ValueError("Empty density range")
+        self.x_range = x_range
+        self.y_range = y_range
+        self.shape = shape
+
+        self.counts = np.zeros(shape[0] * shape[1], dtype=np.int64)
+        self.speed_sum = np.zeros(shape[0] * shape[1], dtype=np.float64)
+        self.samples = 0
+
+    def cells(self, x: np.ndarray, y: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """Flat cell index of each sample and the mask of the samples inside the grid"""
+        nx, ny = self.shape
+        ix = np.floor((x - self.x_range[0]) * (nx / (self.x_range[1] - self.x_range[0])))
+        iy = np.floor((y - self.y_range[0]) * (ny / (self.y_range[1] - self.y_range[0])))
+        inside = (ix >= 0) & (ix < nx) & (iy >= 0) & (iy < ny)
+        return ix[inside].astype(np.intp) * ny + iy[inside].astype(np.intp), inside
+
+    def add(self, x: np.ndarray, y: np.ndarray, v: Optional[np.ndarray] = None):
+        """Adds samples, out of range ones are dropped
+
+        Args:
+            x (np.ndarray): Times
+            y (np.ndarray): Positions
+            v (Optional[np.ndarray], optional): Speeds in m/s. Defaults to None.
+        """
+        flat, inside = self.cells(np.asarray(x, dtype=np.float64), np.asarray(y, dtype=np.float64))
+        size = self.counts.size
+        self.counts += np.bincount(flat, minlength=size)
+        if v is not None:
+            self.speed_sum += np.bincount(flat, weights=np.asarray(v, dtype=np.float64)[inside], minlength=size)
+        self.samples += len(flat)
+
+    def image(self, color: str = "count") -> np.ndarray:
+        """Grid of (time, position) cells, count or mean speed (km/h, NaN where empty)"""
+        counts = self.counts.reshape(self.shape)
+        if color == "count":
+            return counts
+        if color == "speed":
+            with np.errstate(invalid="ignore", divide="ignore"):
+                return np.where(counts > 0, 3.6 * self.speed_sum.reshape(self.shape) / counts, np.nan)
+        raise ValueError(f"Unknown color {color}, use one of {', '.join(COLORS)}")
+
+    def draw(self, ax, color: str = "count", cmap: Optional[str] = None):
+        image = self.image(color)
+        extent = [*self.x_range, *self.y_range]
+        if color == "count":
+            mesh = ax.imshow(
+                np.where(image > 0, image, np.nan).T,
+                origin="lower",
+                aspect="auto",
+                extent=extent,
+                cmap=cmap or "viridis",
+                norm=LogNorm(vmin=1, vmax=max(1, int(image.max()))),
+                interpolation="nearest",
+            )
+            label = "Samples"
+        else:
+            mesh = ax.imshow(
+                image.T,
+                origin="lower",
+                aspect="auto",
+                extent=extent,
+                cmap=cmap or "RdYlGn",
+                interpolation="nearest",
+            )
+            label = "Mean speed (km/h)"
+        ax.figure.colorbar(mesh, ax=ax, label=label)
+        return mesh
+
+
+def run_ranges(log_dir: str, mode: str, length: Optional[float] = None, chunk_rows: int = 1 << 20):
+    """Time and position ranges of a run
+
+    The time range is read from agp_data in absolute mode. The rest comes from a pass
+    over the needed columns of cars_data, which only decompresses those columns.
+    """
+    column = MODES[mode]
+    x_max = None
+    if mode == "absolute":
+        agp_df = read_table(log_dir, "agp_data", ["frame"])
+        x_max = float(agp_df["frame"].max()) + 1 if len(agp_df) else None
+
+    columns = ([] if x_max is not None else [column]) + ([] if length is not None else ["car_x"])
+    if columns:
+        found_x, found_y = 0.0, 0.0
+        for chunk in iter_table(log_dir, "cars_data", columns, chunk_rows):
+            if len(chunk) == 0:
+                continue
+            if column in chunk:
+                found_x = max(found_x, float(chunk[column].max()))
+            if "car_x" in chunk:
+                found_y = max(found_y, float(chunk["car_x"].max()))
+        x_max = x_max if x_max is not None else found_x + 1
+        # Just above the furthest position, so it falls in the last cell
+        length = length if length is not None else float(np.nextafter(found_y, np.inf))
+
+    return (0.0, max(x_max, 1.0)), (0.0, max(length, 1.0))
+
+
+def density_from_frame(
+    cars_df: pd.DataFrame,
+    mode: str = "absolute",
+    shape: Tuple[int, int] = (1200, 600),
+    length: Optional[float] = None,
+) -> TrajectoryDensity:
+    """Density of a loaded cars_data table"""
+    x = cars_df[MODES[mode]].to_numpy(dtype=np.float64)
+    y = cars_df["car_x"].to_numpy(dtype=np.float64)
+    x_range = (0.0, float(x.max()) + 1 if len(x) else 1.0)
+    y_range = (0.0, length if length is not None else (float(np.nextafter(y.max(), np.inf)) if len(y) else 1.0))
+    density = TrajectoryDensity(x_range, y_range, shape)
+    density.add(x, y, cars_df["car_v"].to_numpy())
+    return density
+
+
+def density_from_run(
+    log_dir: str,
+    mode: str = "absolute",
+    shape: Tuple[int, int] = (1200, 600),
+    length: Optional[float] = None,
+    chunk_rows: int = 1 << 20,
+) -> TrajectoryDensity:
+    """Density of a run, streamed from its cars_data chunks
+
+    Args:
+        log_dir (str): Run directory
+        mode (str, optional): absolute or relative. Defaults to "absolute".
+        shape (Tuple[int, int], optional): Cells along time and position. Defaults to (1200, 600).
+        length (Optional[float], optional): Highway length (m). Defaults to None (from the log).
+        chunk_rows (int, optional): Rows read at once. Defaults to 1 << 20.
+
+    Returns:
+        TrajectoryDensity: Accumulated grid
+    """
+    if mode not in MODES:
+        raise ValueError(f"Unknown mode {mode}, use one of {', '.join(MODES)}")
+    x_range, y_range = run_ranges(log_dir, mode, length, chunk_rows)
+    density = TrajectoryDensity(x_range, y_range, shape)
+    for chunk in iter_table(log_dir, "cars_data", [MODES[mode], "car_x", "car_v"], chunk_rows):
+        density.add(chunk[MODES[mode]].to_numpy(), chunk["car_x"].to_numpy(), chunk["car_v"].to_numpy())
+    return density
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Space-time density of the car trajectories")
+    parser.add_argument("run", type=str, nargs="?", help="Run directory or timestamp in logs/")
+    parser.add_argument("--mode", type=str, choices=list(MODES), default="absolute")
+    parser.add_argument("--color", type=str, choices=COLORS, default="count")
+    parser.add_argument("--bins", type=int, nargs=2, help="Cells along time and position", default=[1200, 600])
+    parser.add_argument("--length", type=float, help="Highway length in meters", default=None)
+    parser.add_argument("--out", type=str, help="Image path", default=None)
+    parser.add_argument("--dpi", type=int, help="Resolution of the image", default=300)
+    parser.add_argument(
+        "--benchmark", type=int, help="Bin this many random samples and report the time", default=None
+    )
+
+    args = parser.parse_args()
+
+    if args.benchmark is not None:
+        rng = np.random.default_rng(0)
+        x = rng.uniform(0, 12000, args.benchmark)
+        y = rng.uniform(0, 14000, args.benchmark)
+        v = rng.uniform(0, 30, args.benchmark)
+        start = time.perf_counter()
+        density = TrajectoryDensity((0, 12000), (0, 14000), tuple(args.bins))
+        density.add(x, y, v)
+        print(f"{density.samples} samples binned in {time.perf_counter() - start:.2f} s")
+        raise SystemExit(0)
+
+    if args.run is None:
+        parser.error("A run is needed")
+
+    import matplotlib
+
+    matplotlib.use("Agg")
+    from matplotlib import pyplot as plt
+
+    log_dir = args.run if os.path.isdir(args.run) else os.path.join("logs", args.run)
+
+    start = time.perf_counter()
+    density = density_from_run(log_dir, args.mode, tuple(args.bins), args.length)
+    print(f"{density.samples} samples binned in {time.perf_counter() - start:.2f} s")
+
+    fig, ax = plt.subplots(figsize=(20, 10))
+    density.draw(ax, args.color)
+    ax.set_xlabel("Frame (s)" if args.mode == "absolute" else "Time (s)", fontsize=15)
+    ax.set_ylabel("Distance (m)", fontsize=15)
+    ax.set_title("Car trajectories", fontsize=16)
+    fig.tight_layout()
+    fig.patch.set_alpha(0)
+
+    out = args.out or os.path.join(log_dir, f"density_{args.mode}_{args.color}.png")
+    fig.savefig(out, dpi=args.dpi, transparent=True)
+    print(f"Saved {out}")
@@ -0,0 +1,556 @@
+"""
+* Statistical equivalence of an engine with the reference simulation
+* The reference is simulation.py (Highway and Car objects), run as a subprocess per seed
+* A candidate engine runs the same scenario with the same seeds, then the metrics of
+* speed, acceleration, trip time, car count and crash rate are compared seed by seed
+* batched and segments draw the drivers of simulation.py from the seed, the car dynamics
+* use other streams, so the pairs share the drivers but not the crashes
+
+* The runs are the units: samples inside a run are correlated (a jam lasts many frames),
+* so every metric is reduced to one mean per run (crash_rate: crashes per 1000 frames)
+* Equivalence test (TOST): a metric passes when the 1 - 2 alpha interval of the mean
+* per-seed difference lies inside ± its margin (MARGINS), so a noisy comparison fails
+* KS test of the pooled samples, with a critical value for the effective sample sizes:
+* the samples of a run count as runs * pooled variance / variance of the run means
+* An engine passes when every metric passes both tests
+
+* False failures: an engine equal to the reference fails with probability FALSE_FAILURE_RATE
+* at most, split between the five metrics (Bonferroni), half to the KS test and half to the
+* TOST. The TOST share depends on the seeds, the report gives the estimated false failure
+* rate of each metric and the seeds it needs
+* A false pass needs every metric to pass, so each TOST keeps its alpha
+
+* Negative control: the reference with a perturbed scenario (half of the cars smart) must fail
+* max_v does not work as a control, it only sets the desired speed of the smart cars and the
+* first car, with max_v 30 the metrics stay inside the noise of the runs
+
+* The reference and control runs are kept in the result cache (result_cache.py, the same
+* entries as sweep.py), keyed by the scenario, the seed and the code of simulation.py, so
+* only the candidate runs again
+
+* Engines: reference (self check of the harness, on other seeds), batched, segments
+* run: python equivalence.py --engine batched
+"""
+
+import argparse
+import json
+import math
+import os
+import shutil
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from statistics import NormalDist
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+
+from convergence import t_quantile
+from result_cache import ResultCache, config_key, summarize_logs
+from runlog import load_run
+from sweep import error_tail, run_simulation
+
+METRICS = ["speed", "acceleration", "trip_time", "car_count", "crash_rate"]
+
+# Arguments of simulation.py that define a run of the reference
+SIMULATION_ARGS = ["frames", "precision", "length", "max_v", "smart_car_probability"]
+
+# With precision 5 most runs end in a crash cascade and the run means are mostly noise (the
+# mean speed of a run goes from 10 to 75 km/h), with precision 20 there is about a crash per run
+DEFAULT_SCENARIO = {"frames": 400, "precision": 20, "length": 3000, "max_v": 100, "smart_car_probability": 0}
+DEFAULT_SEEDS = list(range(1, 33))
+
+# Largest difference of the run means accepted, relative to the mean of the reference or in the
+# units of the metric (acceleration in m/s², crash_rate in crashes per 1000 frames)
+MARGINS = {
+    "speed": ("relative", 0.1),
+    "acceleration": ("absolute", 0.25),
+    "trip_time": ("relative", 0.1),
+    "car_count": ("relative", 0.15),
+    "crash_rate": ("absolute", 7.5),
+}
+EQUIVALENCE_ALPHA = 0.05
+FALSE_FAILURE_RATE = 0.05
+CONTROL = {"smart_car_probability": 0.5}
+
+# The self check of the reference runs on other seeds, the same seed gives the same run
+SELF_CHECK_OFFSET = 1000
+
+
+# Tests without scipy
+
+
+def ks_2samp_p(d: float, n: float, m: float) -> Tuple[float, float]:
+    """Asymptotic p-value of a KS distance with (effective) sample sizes n and m"""
+    # Kolmogorov distribution with the Stephens correction
+    ne = n * m / (n + m)
+    lam = (math.sqrt(ne) + 0.12 + 0.11 / math.sqrt(ne)) * d
+    if lam < 1e-3:
+        return d, 1.0
+    k = np.arange(1, 101)
+    p = 2 * np.sum((-1) ** (k - 1) * np.exp(-2 * k**2 * lam**2))
+    return d, float(min(1.0, max(0.0, p)))
+
+
+def ks_2samp(a: np.ndarray, b: np.ndarray) -> Tuple[float, float]:
+    """Two sample Kolmogorov-Smirnov statistic and asymptotic p-value"""
+    a, b = np.sort(np.asarray(a, dtype=float)), np.sort(np.asarray(b, dtype=float))
+    n, m = len(a), len(b)
+    if n == 0 or m == 0:
+        return np.nan, np.nan
+    values = np.concatenate([a, b])
+    d = float(np.max(np.abs(np.searchsorted(a, values, "right") / n - np.searchsorted(b, values, "right") / m)))
+    return ks_2samp_p(d, n, m)
+
+
+def ks_critical(alpha: float, n: float, m: float) -> float:
+    """Asymptotic critical KS distance at level alpha for (effective) sample sizes n and m"""
+    return math.sqrt(-math.log(alpha / 2) / 2) * math.sqrt((n + m) / (n * m))
+
+
+def effective_size(runs: List[np.ndarray]) -> float:
+    """Independent samples that the pooled samples of correlated runs are worth
+
+    The mean of the m samples of a run has the variance of m / deff independent samples
+    (design effect), and its variance is estimated by the variance of the run means.
+    Between the number of runs and the number of samples.
+    """
+    runs = [run for run in runs if len(run) > 0]
+    total = sum(len(run) for run in runs)
+    if len(runs) < 2:
+        return float(total)
+    var_means = np.var([np.mean(run) for run in runs], ddof=1)
+    pooled = np.var(np.concatenate(runs), ddof=1)
+    if var_means == 0:
+        return float(total)
+    return float(np.clip(len(runs) * pooled / var_means, len(runs), total))
+
+
+def tost(differences: np.ndarray, margin: float, alpha: float) -> Dict:
+    """Two one-sided tests of |mean difference| < margin on paired differences
+
+    Args:
+        differences (np.ndarray): Candidate minus reference, one per seed
+        margin (float): Equivalence margin
+        alpha (float): Level of each one-sided test, the interval is 1 - 2 alpha
+
+    Returns:
+        Dict: Mean difference, half width of the interval and whether it is inside the margin
+    """
+    n = len(differences)
+    difference = float(np.mean(differences)) if n else np.nan
+    if n < 2:
+        return {"difference": difference, "half_width": np.nan, "equivalent": False}
+    half_width = t_quantile(1 - 2 * alpha, n - 1) * float(np.std(differences, ddof=1)) / math.sqrt(n)
+    return {
+        "difference": difference,
+        "half_width": half_width,
+        "equivalent": bool(abs(difference) + half_width < margin),
+    }
+
+
+def tost_false_failure(sd: float, n: int, margin: float, alpha: float) -> float:
+    """Probability that the TOST fails on equal engines, with n pairs of this spread"""
+    if n < 2:
+        return 1.0
+    if sd == 0:
+        return 0.0
+    se = sd / math.sqrt(n)
+    slack = margin - t_quantile(1 - 2 * alpha, n - 1) * se
+    if slack <= 0:
+        return 1.0
+    return 2 * (1 - NormalDist().cdf(slack / se))
+
+
+def seeds_needed(sd: float, margin: float, alpha: float, false_failure: float) -> int:
+    """Pairs that bring the false failure rate of the TOST down to `false_failure`"""
+    if sd == 0:
+        return 2
+    z = NormalDist().inv_cdf(1 - alpha) + NormalDist().inv_cdf(1 - false_failure / 2)
+    return max(2, math.ceil((z * sd / margin) ** 2))
+
+
+# Engines, each one returns the logs of every seed
+
+
+def run_reference(
+    scenario: Dict, seeds: List[int], workers: int = 4, cache: Optional[ResultCache] = None
+) -> List[Dict[str, pd.DataFrame]]:
+    """Runs of simulation.py, from the cache when it has them
+
+    Args:
+        scenario (Dict): Arguments of simulation.py, see SIMULATION_ARGS
+        seeds (List[int]): Seeds
+        workers (int, optional): Runs at the same time. Defaults to 4.
+        cache (Optional[ResultCache], optional): Result cache. Defaults to None (temporary logs).
+
+    Returns:
+        List[Dict[str, pd.DataFrame]]: The four logs of each seed
+    """
+    configs = [{**{name: scenario[name] for name in SIMULATION_ARGS}, "seed": seed} for seed in seeds]
+    keys = [config_key(config) for config in configs]
+
+    def cached(key):
+        entry = cache.get(key) if cache is not None else None
+        if entry is not None and entry["log_dir"] is not None and os.path.exists(entry["log_dir"]):
+            return entry["log_dir"]
+        return None
+
+    def run(item):
+        key, config = item
+        log_dir = os.path.abspath(cache.log_dir(key)) if cache is not None else tempfile.mkdtemp(prefix="equivalence_")
+        os.makedirs(log_dir, exist_ok=True)
+        returncode = run_simulation(config, log_dir, "npz")
+        if returncode != 0:
+            tail = error_tail(log_dir)
+            shutil.rmtree(log_dir, ignore_errors=True)
+            raise RuntimeError(f"simulation.py failed with code {returncode}: {config}\n{tail}")
+        return log_dir
+
+    log_dirs = {key: cached(key) for key in keys}
+    pending = [(key, config) for key, config in zip(keys, configs) if log_dirs[key] is None]
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for (key, config), log_dir in zip(pending, executor.map(run, pending)):
+            log_dirs[key] = log_dir
+            if cache is not None:
+                cache.put(key, config, summarize_logs(log_dir), log_dir)
+
+    logs = []
+    for key in keys:
+        agp_df, cars_df, exits_df, crashes_df = load_run(log_dirs[key])
+        logs.append({"agp_data": agp_df, "cars_data": cars_df, "exits_data": exits_df, "crashes_data": crashes_df})
+    if cache is None:
+        for log_dir in log_dirs.values():
+            shutil.rmtree(log_dir, ignore_errors=True)
+    else:
+        # The last use of the cached runs, once
+        cache.save()
+    return logs
+
+
+def run_batched(
+    scenario: Dict, seeds: List[int], workers: int = 4, cache: Optional[ResultCache] = None
+) -> List[Dict[str, pd.DataFrame]]:
+    from batched import BatchedHighway
+
+    engine = BatchedHighway(
+        replicas=len(seeds),
+        length=scenario["length"],
+        precision=scenario["precision"],
+        seed=seeds[0],
+        replica_seeds=seeds,
+        max_v=scenario["max_v"],
+        smart_car_probability=scenario["smart_car_probability"],
+        log=True,
+    )
+    engine.run(scenario["frames"], progress=False)
+    return [engine.replica_logs(b) for b in range(len(seeds))]
+
+
+def run_segments(
+    scenario: Dict, seeds: List[int], workers: int = 4, cache: Optional[ResultCache] = None
+) -> List[Dict[str, pd.DataFrame]]:
+    from segments import SegmentedHighway
+
+    def run(seed):
+        engine = SegmentedHighway(
+            scenario["length"],
+            segments=scenario.get("segments", 2),
+            precision=scenario["precision"],
+            seed=seed,
+            max_v=scenario["max_v"],
+            smart_car_probability=scenario["smart_car_probability"],
+        )
+        engine.run(scenario["frames"], processes=False, progress=False)
+        return engine.logs()
+
+    return [run(seed) for seed in seeds]
+
+
+ENGINES = {"reference": run_reference, "batched": run_batched, "segments": run_segments}
+
+
+# Samples
+
+
+def samples(logs: List[Dict[str, pd.DataFrame]], metric: str, warmup: int, thin: int) -> Optional[List[np.ndarray]]:
+    """Samples of a metric after the warm-up, one array per run, None if the engine does not log it"""
+    runs = []
+    for log in logs:
+        if metric in ("speed", "acceleration"):
+            if "cars_data" not in log:
+                return None
+            cars = log["cars_data"]
+            cars = cars[(cars["frame"] >= warmup) & (cars["frame"] % thin == 0)]
+            runs.append(cars["car_v"].to_numpy(float) * 3.6 if metric == "speed" else cars["car_a"].to_numpy(float))
+        elif metric == "trip_time":
+            runs.append(log["exits_data"]["t_d"].to_numpy(float))
+        elif metric == "car_count":
+            agp = log["agp_data"]
+            agp = agp[(agp["frame"] >= warmup) & (agp["frame"] % thin == 0)]
+            runs.append(agp["current_car_count"].to_numpy(float))
+        elif metric == "crash_rate":
+            crashes = log["crashes_data"]
+            runs.append(np.array([len(crashes)], dtype=float))
+    return runs
+
+
+def margin(metric: str, mean_reference: float, margins: Dict = MARGINS) -> float:
+    kind, value = margins[metric]
+    return value * abs(mean_reference) if kind == "relative" else value
+
+
+def compare(
+    reference: List[Dict[str, pd.DataFrame]],
+    candidate: List[Dict[str, pd.DataFrame]],
+    frames: int,
+    warmup: int,
+    thin: int = 10,
+    margins: Dict = MARGINS,
+    alpha: float = EQUIVALENCE_ALPHA,
+    false_failure_rate: float = FALSE_FAILURE_RATE,
+) -> List[Dict]:
+    """Compares the metrics of two engines, run i of both with the same seed
+
+    Args:
+        reference (List[Dict[str, pd.DataFrame]]): Logs of the reference, one per seed
+        candidate (List[Dict[str, pd.DataFrame]]): Logs of the candidate, one per seed, same order
+        frames (int): Frames of each run
+        warmup (int): Frames left out of the frame based metrics
+        thin (int, optional): Keep one frame every `thin`. Defaults to 10.
+        margins (Dict, optional): Equivalence margin of each metric. Defaults to MARGINS.
+        alpha (float, optional): Level of each one-sided test of the TOST. Defaults to EQUIVALENCE_ALPHA.
+        false_failure_rate (float, optional): Largest chance that an equal engine fails. Defaults to FALSE_FAILURE_RATE.
+
+    Returns:
+        List[Dict]: One row per metric with its statistics and verdict
+    """
+    # Bonferroni: each metric gets an equal share, half for the KS test and half for the TOST
+    share = false_failure_rate / len(METRICS) / 2
+    rows = []
+    for metric in METRICS:
+        runs_r = samples(reference, metric, warmup, thin)
+        runs_c = samples(candidate, metric, warmup, thin)
+        if runs_r is None or runs_c is None:
+            rows.append({"metric": metric, "passed": None, "note": "not logged by the engine"})
+            continue
+
+        if metric == "crash_rate":
+            means_r = np.array([1000 * run[0] / frames for run in runs_r])
+            means_c = np.array([1000 * run[0] / frames for run in runs_c])
+        else:
+            means_r = np.array([np.mean(run) if len(run) > 0 else np.nan for run in runs_r])
+            means_c = np.array([np.mean(run) if len(run) > 0 else np.nan for run in runs_c])
+        # A seed without samples in one of the engines has no pair
+        paired = ~(np.isnan(means_r) | np.isnan(means_c))
+        differences = means_c[paired] - means_r[paired]
+        mean_r = float(np.mean(means_r[paired])) if paired.any() else np.nan
+        row = {
+            "metric": metric,
+            "pairs": int(paired.sum()),
+            "mean_reference": mean_r,
+            "mean_candidate": float(np.mean(means_c[paired])) if paired.any() else np.nan,
+            "margin": margin(metric, mean_r, margins),
+            **tost(differences, margin(metric, mean_r, margins), alpha),
+        }
+        sd = float(np.std(differences, ddof=1)) if len(differences) > 1 else np.nan
+        row["false_failure"] = tost_false_failure(sd, len(differences), row["margin"], alpha)
+        row["seeds_needed"] = seeds_needed(sd, row["margin"], alpha, share) if len(differences) > 1 else None
+
+        # One count per run, its distribution is the one of the run means
+        row["ks_d"], row["ks_critical"], row["ks_passed"] = None, None, True
+        if metric != "crash_rate":
+            n_r, n_c = effective_size(runs_r), effective_size(runs_c)
+            d, _ = ks_2samp(np.concatenate(runs_r), np.concatenate(runs_c))
+            row["ks_d"], row["ks_critical"] = d, ks_critical(share, n_r, n_c)
+            row["ks_passed"] = bool(d <= row["ks_critical"])
+            row["false_failure"] = min(1.0, row["false_failure"] + share)
+        row["passed"] = row["equivalent"] and row["ks_passed"]
+        rows.append(row)
+    return rows
+
+
+def verify(
+    engine: str,
+    scenario: Dict,
+    seeds: List[int],
+    cache: Optional[ResultCache] = None,
+    seed_offset: Optional[int] = None,
+    control: Optional[Dict] = None,
+    workers: int = 4,
+    warmup: Optional[int] = None,
+    **options,
+) -> Dict:
+    """Runs the reference, the engine and the negative control on the same seeds and compares them
+
+    Args:
+        engine (str): Engine of ENGINES
+        scenario (Dict): frames, precision, length, max_v and smart_car_probability
+        seeds (List[int]): Seeds
+        cache (Optional[ResultCache], optional): Keeps the runs of the reference and the control. Defaults to None.
+        seed_offset (Optional[int], optional): The engine runs on seed + offset. Defaults to 0,
+            SELF_CHECK_OFFSET for the reference.
+        control (Optional[Dict], optional): Scenario changes of the negative control, None skips it. Defaults to None.
+        workers (int, optional): Reference runs at the same time. Defaults to 4.
+        warmup (Optional[int], optional): Warm-up frames. Defaults to frames / 5.
+        **options: thin, margins, alpha and false_failure_rate of compare
+
+    Returns:
+        Dict: Verdicts, metrics and times. passed needs the engine to pass and the control to fail
+    """
+    frames = scenario["frames"]
+    warmup = warmup if warmup is not None else frames // 5
+    if seed_offset is None:
+        seed_offset = SELF_CHECK_OFFSET if engine == "reference" else 0
+    times = {}
+
+    start = time.perf_counter()
+    reference = run_reference(scenario, seeds, workers, cache)
+    times["reference"] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    candidate = ENGINES[engine](scenario, [seed + seed_offset for seed in seeds], workers, cache)
+    times["candidate"] = time.perf_counter() - start
+    rows = compare(reference, candidate, frames, warmup, **options)
+    false_failure = sum(row["false_failure"] for row in rows if row["passed"] is not None)
+    result = {
+        "engine": engine,
+        "scenario": scenario,
+        "seeds": seeds,
+        "seed_offset": seed_offset,
+        "engine_passed": all(row["passed"] is not False for row in rows),
+        "false_failure": min(1.0, false_failure),
+        "metrics": rows,
+        "times": times,
+    }
+
+    control_failed = True
+    if control is not None:
+        start = time.perf_counter()
+        control_logs = run_reference({**scenario, **control}, seeds, workers, cache)
+        times["control"] = time.perf_counter() - start
+        control_rows = compare(reference, control_logs, frames, warmup, **options)
+        control_failed = not all(row["passed"] is not False for row in control_rows)
+        result["control"] = {"changes": control, "failed": control_failed, "metrics": control_rows}
+
+    result["passed"] = result["engine_passed"] and control_failed
+    return result
+
+
+def report(rows: List[Dict]) -> str:
+    lines = [
+        f"{'metric':<14}{'pairs':>6}{'mean ref':>11}{'mean cand':>11}{'diff':>10}{'±':>9}{'margin':>9}"
+        f"{'KS D':>7}{'crit':>7}{'P(ff)':>7}{'seeds':>7}  verdict"
+    ]
+    for row in rows:
+        if row["passed"] is None:
+            lines.append(f"{row['metric']:<14}{'':>84}  skipped ({row['note']})")
+            continue
+        d = f"{row['ks_d']:.3f}" if row["ks_d"] is not None else "-"
+        critical = f"{row['ks_critical']:.3f}" if row["ks_critical"] is not None else "-"
+        verdict = "PASS"
+        if not row["passed"]:
+            verdict = "FAIL (" + ", ".join(
+                reason
+                for reason, failed in (("outside the margin", not row["equivalent"]), ("KS", not row["ks_passed"]))
+                if failed
+            ) + ")"
+        lines.append(
+            f"{row['metric']:<14}{row['pairs']:>6}{row['mean_reference']:>11.4g}{row['mean_candidate']:>11.4g}"
+            f"{row['difference']:>10.3g}{row['half_width']:>9.3g}{row['margin']:>9.3g}{d:>7}{critical:>7}"
+            f"{row['false_failure']:>7.3f}{row['seeds_needed'] or '-':>7}  {verdict}"
+        )
+    return "\n".join(lines)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare an engine with the reference simulation")
+    parser.add_argument("--engine", type=str, choices=list(ENGINES), default="batched")
+    parser.add_argument("--seeds", type=int, nargs="+", help="Seeds, at least 2", default=DEFAULT_SEEDS)
+    parser.add_argument(
+        "--seed_offset",
+        type=int,
+        help="The candidate runs on seed + offset. Defaults to 0, and to 1000 for the reference",
+        default=None,
+    )
+    parser.add_argument("--frames", type=int, help="Frames of each run", default=DEFAULT_SCENARIO["frames"])
+    parser.add_argument("--precision", type=int, help="Precision of the simulation", default=DEFAULT_SCENARIO["precision"])
+    parser.add_argument("--length", type=int, help="Length of the highway in meters", default=DEFAULT_SCENARIO["length"])
+    parser.add_argument("--max_v", type=int, help="Maximum velocity in km/h", default=DEFAULT_SCENARIO["max_v"])
+    parser.add_argument(
+        "--smart_car_probability",
+        type=float,
+        help="Probability of a smart car",
+        default=DEFAULT_SCENARIO["smart_car_probability"],
+    )
+    parser.add_argument("--warmup", type=int, help="Warm-up frames. Defaults to frames / 5", default=None)
+    parser.add_argument("--thin", type=int, help="Keep one frame every thin", default=10)
+    parser.add_argument(
+        "--alpha", type=float, help="Level of each one-sided test of the TOST", default=EQUIVALENCE_ALPHA
+    )
+    parser.add_argument(
+        "--false_failure_rate",
+        type=float,
+        help="Largest chance that an engine equal to the reference fails",
+        default=FALSE_FAILURE_RATE,
+    )
+    parser.add_argument(
+        "--control_smart_car_probability",
+        type=float,
+        help="Share of smart cars of the negative control, it must fail",
+        default=CONTROL["smart_car_probability"],
+    )
+    parser.add_argument("--negative_control", type=bool, help="Run the negative control", default=True)
+    parser.add_argument("--workers", type=int, help="Reference runs at the same time", default=4)
+    parser.add_argument("--cache_dir", type=str, help="Result cache of the reference runs", default="cache")
+    parser.add_argument("--output", type=str, help="JSON report", default=None)
+
+    args = parser.parse_args()
+    if len(args.seeds) < 2:
+        parser.error("The runs are the units, use at least 2 seeds")
+
+    scenario = {
+        "frames": args.frames,
+        "precision": args.precision,
+        "length": args.length,
+        "max_v": args.max_v,
+        "smart_car_probability": args.smart_car_probability,
+    }
+    result = verify(
+        args.engine,
+        scenario,
+        args.seeds,
+        cache=ResultCache(args.cache_dir),
+        seed_offset=args.seed_offset,
+        control={"smart_car_probability": args.control_smart_car_probability} if args.negative_control else None,
+        workers=args.workers,
+        warmup=args.warmup,
+        thin=args.thin,
+        alpha=args.alpha,
+        false_failure_rate=args.false_failure_rate,
+    )
+
+    times = ", ".join(f"{name}: {seconds:.1f} s" for name, seconds in result["times"].items())
+    print(f"{times}, scenario {scenario}")
+    print(report(result["metrics"]))
+    print(f"{args.engine}: {'PASS' if result['engine_passed'] else 'FAIL'}")
+    if result["false_failure"] > args.false_failure_rate:
+        print(
+            f"An equal engine fails with probability {result['false_failure']:.3f} with these seeds, "
+            f"above {args.false_failure_rate}, see the seeds column"
+        )
+    if "control" in result:
+        print(f"Negative control, reference with smart_car_probability {args.control_smart_car_probability}:")
+        print(report(result["control"]["metrics"]))
+        if result["control"]["failed"]:
+            print("Negative control: FAIL, as expected")
+        else:
+            print("Negative control: PASS, the margins are too wide to tell it apart")
+    print("PASS" if result["passed"] else "FAIL")
+
+    if args.output is not None:
+        with open(args.output, "w") as f:
+            json.dump(result, f, indent=4, default=float)
+
+    raise SystemExit(0 if result["passed"] else 1)
@@ -0,0 +1,254 @@
+"""
+* Structured events emitted by the highway (spawns, exits, crashes and tows)
+* Events are put in a queue and written to the sinks by a background thread
+* The simulation never waits on the terminal or on files
+"""
+
+import csv
+import json
+import queue
+import threading
+from typing import Iterable, List, NamedTuple, Optional
+
+
+class SpawnEvent(NamedTuple):
+    frame: int
+    car_id: int
+    car_x: float
+    car_v: float
+
+
+class ExitEvent(NamedTuple):
+    frame: int
+    car_id: int
+    avg_v: float
+    avg_a: float
+    t_d: float
+    init_frame: Optional[int]
+
+
+class CrashEvent(NamedTuple):
+    frame: int
+    car_id: int
+    car_x: float
+    car_v: float
+    car_a: float
+    car_t_d: float
+    f_car_id: int
+    b_car_id: int
+
+
+class TowEvent(NamedTuple):
+    frame: int
+    car_id: int
+    car_x: float
+
+
+EVENT_KINDS = {
+    SpawnEvent: "spawn",
+    ExitEvent: "exit",
+    CrashEvent: "crash",
+    TowEvent: "tow",
+}
+
+
+def event_kind(event) -> str:
+    return EVENT_KINDS[type(event)]
+
+
+class Sink:
+    """Base sink, receives batches of events from the writer thread
+
+    Args:
+        kinds (Optional[Iterable[str]], optional): Event kinds to keep. Defaults to None (all).
+    """
+
+    def __init__(self, kinds: Optional[Iterable[str]] = None):
+        self.kinds = set(kinds) if kinds is not None else None
+
+    def accepts(self, event) -> bool:
+        return self.kinds is None or event_kind(event) in self.kinds
+
+    def write(self, events: List):
+        for event in events:
+            if self.accepts(event):
+                self.write_event(event)
+
+    def write_event(self, event):
+        pass
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.flush()
+
+
+class ConsoleSink(Sink):
+    """Prints the same messages the simulation used to print"""
+
+    def __init__(self, kinds: Optional[Iterable[str]] = ("crash", "tow")):
+        super().__init__(kinds)
+
+    def write_event(self, event):
+        kind = event_kind(event)
+        if kind == "crash":
+            print(f"AGP: Car {event.car_id} crashed at frame {event.frame}, queueing tow")
+        elif kind == "tow":
+            print(f"AGP: Towing car {event.car_id} from {event.car_x} at frame {event.frame}")
+        elif kind == "exit":
+            print(f"AGP: Car {event.car_id} exited at frame {event.frame} after {event.t_d:.2f}s")
+        elif kind == "spawn":
+            print(f"AGP: Car {event.car_id} entered at frame {event.frame}")
+
+
+class CsvSink(Sink):
+    """Appends one kind of event to a CSV file
+
+    The file has the same layout as DataFrame.to_csv, index column included,
+    so the notebooks can keep loading it with index_col=0.
+
+    Args:
+        path (str): CSV file path
+        kind (str): Event kind to write
+    """
+
+    def __init__(self, path: str, kind: str):
+        super().__init__([kind])
+        self.path = path
+        self.file = open(path, "w", newline="")
+        self.writer = csv.writer(self.file)
+        self.index = 0
+
+        columns = next(cls for cls, k in EVENT_KINDS.items() if k == kind)._fields
+        self.writer.writerow([""] + list(columns))
+
+    def write_event(self, event):
+        self.writer.writerow([self.index] + list(event))
+        self.index += 1
+
+    def flush(self):
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+
+class JsonlSink(Sink):
+    """Writes every event as a JSON line with its kind
+
+    Args:
+        path (str): JSON lines file path
+        kinds (Optional[Iterable[str]], optional): Event kinds to keep. Defaults to None (all).
+    """
+
+    def __init__(self, path: str, kinds: Optional[Iterable[str]] = None):
+        super().__init__(kinds)
+        self.path = path
+        self.file = open(path, "w")
+
+    def write_event(self, event):
+        record = {"kind": event_kind(event)}
+        record.update(event._asdict())
+        self.file.write(json.dumps(record, default=float) + "\n")
+
+    def flush(self):
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+
+class EventBus:
+    """Collects events without blocking and writes them in batches
+
+    emit only puts the event in a SimpleQueue (no Python level locks), a
+    daemon thread takes them out in batches and hands them to the sinks.
+
+    Args:
+        sinks (Optional[List[Sink]], optional): Sinks to write to. Defaults to None.
+        batch_size (int, optional): Maximum events per batch. Defaults to 512.
+        flush_interval (float, optional): Seconds to wait before writing a partial batch. Defaults to 0.5.
+    """
+
+    _STOP = object()
+
+    def __init__(
+        self,
+        sinks: Optional[List[Sink]] = None,
+        batch_size: int = 512,
+        flush_interval: float = 0.5,
+    ):
+        self.sinks = list(sinks) if sinks is not None else []
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+
+        self.queue = queue.SimpleQueue()
+        self.thread = None
+        self.emitted = 0
+
+    def add_sink(self, sink: Sink):
+        self.sinks.append(sink)
+
+    def start(self):
+        if self.thread is None:
+            self.thread = threading.Thread(
+                target=self._run, name="event-writer", daemon=True
+            )
+            self.thread.start()
+        return self
+
+    def emit(self, event):
+        self.emitted += 1
+        self.queue.put_nowait(event)
+
+    def close(self):
+        """Writes the pending events and closes the sinks"""
+        if self.thread is not None:
+            self.queue.put(self._STOP)
+            self.thread.join()
+            self.thread = None
+        else:
+            self._write(self._drain())
+        for sink in self.sinks:
+            sink.close()
+
+    def _drain(self) -> List:
+        events = []
+        while True:
+            try:
+                event = self.queue.get_nowait()
+            except queue.Empty:
+                return events
+            if event is self._STOP:
+                return events
+            events.append(event)
+
+    def _write(self, events: List):
+        if len(events) == 0:
+            return
+        for sink in self.sinks:
+            sink.write(events)
+            sink.flush()
+
+    def _run(self):
+        running = True
+        while running:
+            batch = []
+            try:
+                event = self.queue.get(timeout=self.flush_interval)
+            except queue.Empty:
+                continue
+
+            while event is not self._STOP:
+                batch.append(event)
+                if len(batch) >= self.batch_size:
+                    break
+                try:
+                    event = self.queue.get_nowait()
+                except queue.Empty:
+                    break
+            else:
+                running = False
+
+            self._write(batch)
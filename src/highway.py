@@ -1,77 +1,119 @@
+import bisect
 import gc
-from typing import Callable
+import heapq
+from typing import Callable, Optional
 import numpy as np
 from car import Car
+from events import CrashEvent, EventBus, ExitEvent, SpawnEvent, TowEvent
+from telemetry import RunningStats
+
+
+def _or_nan(value: Optional[float]) -> float:
+    return np.nan if value is None else value
 
 
 class Highway:
-    def __init__(self, length: float, crash_remove_delay: int = 5000, precision: int = 1):
+    def __init__(
+        self,
+        length: float,
+        crash_remove_delay: int = 5000,
+        precision: int = 1,
+        event_bus: Optional[EventBus] = None,
+        ring: bool = False,
+    ):
         self.length = length
+
+        # Ring road: the road wraps around, the front car follows the back car
+        # and a car that passes the end starts a new lap instead of exiting
+        self.ring = ring
+        self.lap_starts = {}
         self.cars = []
         self.time = 0
 
-        self.crashes = []
+        # Min-heap of (remove_time, seq, car) tows and ids of crashed cars awaiting one
+        self.tow_queue = []
+        self.crashed_ids = set()
+        self._tow_seq = 0
         self.crash_remove_delay = crash_remove_delay
-        self.historic_ids = []
+        self.historic_ids = set()
 
-        self.historic_velocities = []
-        self.historic_accelerations = []
-        self.historic_trip_duration = []
+        # Running sums instead of every sample, the averages are O(1)
+        self.velocity_stats = RunningStats()
+        self.acceleration_stats = RunningStats()
+        self.trip_stats = RunningStats()
 
         self.historic_crash_count = 0
 
+        # Sorted positions of the last collision pass, for range counts with bisect
+        self.sorted_x = None
+
+        # Arrays of the get_cars_* queries, built on the first call after the cars change
+        self.arrays = {}
+
         self.precision = precision
 
+        self.event_bus = event_bus
+
     def __len__(self):
         return len(self.cars)
 
+    def __getstate__(self):
+        """State for the replay checkpoints, without the event bus
+
+        The neighbours of every car are kept as indices in self.cars.
+        """
+        state = self.__dict__.copy()
+        state["event_bus"] = None
+        state["arrays"] = {}
+        index = {id(car): i for i, car in enumerate(self.cars)}
+        state["links"] = [
+            (
+                index.get(id(car.f_car), -1) if car.f_car is not None else -1,
+                index.get(id(car.b_car), -1) if car.b_car is not None else -1,
+            )
+            for car in self.cars
+        ]
+        return state
+
+    def __setstate__(self, state):
+        links = state.pop("links")
+        self.__dict__.update(state)
+        for car, (front, back) in zip(self.cars, links):
+            car.f_car = self.cars[front] if front >= 0 else None
+            car.b_car = self.cars[back] if back >= 0 else None
+
+    def set_event_bus(self, event_bus: Optional[EventBus]):
+        self.event_bus = event_bus
+
     def get_crash_count(self):
         return self.historic_crash_count
 
     def get_avg_v(self):
-        if len(self.historic_velocities) == 0:
-            return 0
-        return np.mean(self.historic_velocities)
+        return self.velocity_stats.mean()
 
     def get_avg_a(self):
-        if len(self.historic_accelerations) == 0:
-            return 0
-        return np.mean(self.historic_accelerations)
+        return self.acceleration_stats.mean()
 
     def get_avg_trip_duration(self):
-        if len(self.historic_trip_duration) == 0:
-            return 0
-        return np.mean(self.historic_trip_duration)
+        return self.trip_stats.mean()
 
     def get_max_v(self):
-        if (len(self.historic_velocities)) == 0:
-            return 0
-        return np.max(self.historic_velocities)
+        return self.velocity_stats.max or 0
 
     def get_max_a(self):
-        if (len(self.historic_accelerations)) == 0:
-            return 0
-        return np.max(self.historic_accelerations)
+        return self.acceleration_stats.max or 0
 
     def get_max_trip_duration(self):
-        if (len(self.historic_trip_duration)) == 0:
-            return 0
-        return np.max(self.historic_trip_duration)
+        return self.trip_stats.max or 0
 
     def get_min_v(self):
-        if (len(self.historic_velocities)) == 0:
-            return 0
-        return np.min(self.historic_velocities)
+        return self.velocity_stats.min or 0
 
     def get_min_a(self):
-        if (len(self.historic_accelerations)) == 0:
-            return 0
-        return np.min(self.historic_accelerations)
+        return self.acceleration_stats.min or 0
 
     def get_min_trip_duration(self):
-        if (len(self.historic_trip_duration)) == 0:
-            return 0
-        return np.min(self.historic_trip_duration)
+        return self.trip_stats.min or 0
 
     def __str__(self):
         return (
@@ -97,15 +139,39 @@ class Highway:
             return None
         return self.cars[0]
 
+    def emit(self, event):
+        if self.event_bus is not None:
+            self.event_bus.emit(event)
+
     def add_car(self, car: Car):
+        """Adds a car to the road
+
+        Only the cars placed on the road get a link to the highway (the checks that look at the
+        other cars: crashes upfront, slugish behavior and the induced crash). A car that arrives
+        through the entrance (x None or 0) drives without it, like in the original model; the
+        batched and segmented engines keep the same split with their `attached` flag. A ring road
+        has no entrance, every car is placed, see insert_car.
+        """
+
+        if self.ring:
+            self.insert_car(car)
+            return
 
         car.set_precision(self.precision)
 
+        # Neighbours change, gaps are computed live until the next collision pass
+        self.sorted_x = None
+        self.arrays = {}
+        car.gaps_cached = False
+        if len(self.cars) > 0:
+            self.cars[0].gaps_cached = False
+            self.cars[-1].gaps_cached = False
+
         if not car.id:
             car.id = len(self.historic_ids)
-            self.historic_ids.append(car.id)
+            self.historic_ids.add(car.id)
         if car.id and car.id not in self.historic_ids:
-            self.historic_ids.append(car.id)
+            self.historic_ids.add(car.id)
 
         if car.get_position() is None:
             car.x = 0
@@ -114,6 +180,7 @@ class Highway:
             if len(self.cars) > 1:
                 self.cars[1].b_car = car
                 self.cars[0].f_car = self.cars[1]
+            self.emit(SpawnEvent(self.time, car.id, car.x, car.v))
             return
 
         if car.get_position() == 0:
@@ -121,6 +188,7 @@ class Highway:
                 self.cars[0].b_car = car
                 car.f_car = self.cars[0]
             self.cars = [car] + self.cars
+            self.emit(SpawnEvent(self.time, car.id, car.x, car.v))
             return
 
         if car.get_position() > self.length:
@@ -135,51 +203,248 @@ class Highway:
 
         car.set_highway(self)
 
-    def remove_car(self, car: Car):
-        if car in self.cars:
-            # Remove references to car
-            if car.f_car:
-                car.f_car.b_car = car.b_car
-            if car.b_car:
-                car.b_car.f_car = car.f_car
+        self.emit(SpawnEvent(self.time, car.id, car.x, car.v))
 
-            self.cars.remove(car)
+    def insert_car(self, car: Car):
+        """Inserts a car in a ring road keeping the cars sorted by position
+
+        The ring has no entrance, the cars (also the replacements of the towed ones) are placed on
+        the road, so all of them get the highway link, see add_car.
+        """
+        car.set_precision(self.precision)
+        car.set_highway(self)
+        self.arrays = {}
+
+        if car.get_position() is None:
+            car.x = 0
+        car.x = car.x % self.length
+
+        if not car.id:
+            car.id = len(self.historic_ids)
+        if car.id not in self.historic_ids:
+            self.historic_ids.add(car.id)
+        self.lap_starts[car.id] = car.time_ellapsed
+
+        i = bisect.bisect_right([c.x for c in self.cars], car.x)
+        self.cars.insert(i, car)
+
+        n = len(self.cars)
+        front = self.cars[(i + 1) % n]
+        back = self.cars[i - 1]
+        car.f_car = front
+        car.b_car = back
+        front.b_car = car
+        back.f_car = car
+
+        car.gaps_cached = False
+        front.gaps_cached = False
+        back.gaps_cached = False
+
+        self.emit(SpawnEvent(self.time, car.id, car.x, car.v))
+
+    def wrap_cars(self, frame: int, exit_logger: Optional[Callable] = None):
+        """Moves the cars that passed the end of a ring road back to the start
+
+        Each completed lap is recorded like a trip, emitted as an exit and passed to the exit logger.
+        """
+        while len(self.cars) > 0 and self.cars[-1].x >= self.length:
+            car = self.cars.pop()
+            car.x -= self.length
+            self.cars.insert(0, car)
+
+            lap = self.trip_duration(car)
+            self.trip_stats.add(lap)
+            self.emit(
+                ExitEvent(
+                    frame,
+                    car.id,
+                    car.get_avg_velocity(),
+                    car.get_avg_acceleration(),
+                    lap / self.precision,
+                    car.init_frame,
+                )
+            )
+            if exit_logger is not None:
+                exit_logger(car, frame)
+            self.lap_starts[car.id] = car.time_ellapsed
+
+    def trip_duration(self, car: Car) -> float:
+        """Sub-steps of the current trip of a car, its current lap on a ring road"""
+        return car.time_ellapsed - self.lap_starts.get(car.id, 0)
+
+    def bisect_x(self, x: float, right: bool = False) -> int:
+        """Index of a position in the cars sorted by position, like bisect_left (or bisect_right)
+
+        A binary search on car.x, bisect only takes a key from Python 3.10
+        """
+        lo, hi = 0, len(self.cars)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.cars[mid].x < x or (right and self.cars[mid].x == x):
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def detach_car(self, car: Car) -> bool:
+        """Takes a car out of the road and links its neighbours, without destroying it
+
+        Returns:
+            bool: True if the car was on the road
+        """
+        # Bisect first, the cars are sorted unless a crash made them overlap
+        i = self.bisect_x(car.x)
+        if i >= len(self.cars) or self.cars[i] is not car:
+            if car not in self.cars:
+                return False
+            i = self.cars.index(car)
+
+        # Remove references to car
+        if car.f_car:
+            car.f_car.b_car = car.b_car
+            car.f_car.gaps_cached = False
+        if car.b_car:
+            car.b_car.f_car = car.f_car
+            car.b_car.gaps_cached = False
+        car.f_car = None
+        car.b_car = None
+
+        del self.cars[i]
+        self.arrays = {}
+        return True
+
+    def attach_car(self, car: Car):
+        """Inserts a car coming from another lane, keeping the cars sorted by position
+
+        A lane change keeps the kind of highway link the car had, see add_car: a linked car
+        now looks at the cars of this lane, a car without the link stays without it.
+        """
+        i = self.bisect_x(car.x, right=True)
+        back = self.cars[i - 1] if i > 0 else None
+        front = self.cars[i] if i < len(self.cars) else None
+        self.cars.insert(i, car)
+        self.arrays = {}
+
+        car.b_car = back
+        car.f_car = front
+        if back is not None:
+            back.f_car = car
+            back.gaps_cached = False
+        if front is not None:
+            front.b_car = car
+            front.gaps_cached = False
+        car.gaps_cached = False
+        if car.highway is not None:
+            car.set_highway(self)
+
+    def remove_car(self, car: Car):
+        if self.detach_car(car):
+            self.lap_starts.pop(car.id, None)
 
             del car
             gc.collect()
 
-    def tow_cars(self, now: bool = False):
-        for car, frame in self.crashes:
-            if now or frame + self.crash_remove_delay == self.time:
-                print(f"AGP: Towing car {car.id} from {car.x} at frame {self.time}")
-                self.remove_car(car)
-                self.crashes.remove((car, frame))
-                self.historic_crash_count += 1
+    def register_crash(self, car: Car, frame: int) -> bool:
+        """Schedules the tow of a crashed car
+
+        Args:
+            car (Car): Crashed car
+            frame (int): Frame in which the car crashed
+
+        Returns:
+            bool: True if the crash was not registered before
+        """
+        if car.id in self.crashed_ids:
+            return False
+        self.crashed_ids.add(car.id)
+        self._tow_seq += 1
+        heapq.heappush(
+            self.tow_queue,
+            (frame + self.crash_remove_delay, self._tow_seq, car),
+        )
+        return True
 
-    def update(self, frame: int, exit_logger: Callable, crash_logger: Callable):
+    def is_crash_registered(self, car: Car) -> bool:
+        return car.id in self.crashed_ids
+
+    def tow_cars(self, now: bool = False):
+        # Only pop the tows that are due
+        while self.tow_queue and (now or self.tow_queue[0][0] <= self.time):
+            _, _, car = heapq.heappop(self.tow_queue)
+            self.crashed_ids.discard(car.id)
+            self.emit(TowEvent(self.time, car.id, car.x))
+            self.remove_car(car)
+            self.historic_crash_count += 1
+
+    def update(
+        self,
+        frame: int,
+        exit_logger: Optional[Callable] = None,
+        crash_logger: Optional[Callable] = None,
+    ):
+        if self.has_crashes():
+            self.tow_cars()
+
+        x_before = np.fromiter(
+            (car.x for car in self.cars), dtype=float, count=len(self.cars)
+        )
         for car in self.cars:
-            car.update(frame)
+            car.physics()
 
-            self.historic_velocities.append(car.v)
-            self.historic_accelerations.append(car.a)
+        self.detect_collisions(x_before)
 
-            if car.crashed:
-                if car not in [c for c, _ in self.crashes]:
-                    print(f"AGP: Car {car.id} crashed at frame {frame}, queueing tow")
+        velocities = []
+        accelerations = []
+        for car in self.cars:
+            car.decide(frame)
+
+            velocities.append(car.v)
+            accelerations.append(car.a)
+
+            if car.crashed and self.register_crash(car, frame):
+                self.emit(
+                    CrashEvent(
+                        frame,
+                        car.id,
+                        car.x,
+                        car.v,
+                        car.a,
+                        car.time_ellapsed / self.precision,
+                        car.f_car.id if car.f_car is not None else -1,
+                        car.b_car.id if car.b_car is not None else -1,
+                    )
+                )
+                if crash_logger is not None:
                     crash_logger(car, frame)
-                    self.crashes.append((car, frame))
-
-            if self.has_crashes():
-                self.tow_cars()
 
-            if car.get_position() > self.length:
-                self.historic_trip_duration.append(car.time_ellapsed)
-                exit_logger(car, frame)
+            if not self.ring and car.get_position() > self.length:
+                self.trip_stats.add(car.time_ellapsed)
+                self.emit(
+                    ExitEvent(
+                        frame,
+                        car.id,
+                        car.get_avg_velocity(),
+                        car.get_avg_acceleration(),
+                        car.time_ellapsed / self.precision,
+                        car.init_frame,
+                    )
+                )
+                if exit_logger is not None:
+                    exit_logger(car, frame)
                 self.remove_car(car)
 
-            if len(self.cars) > 0:
+            if not self.ring and len(self.cars) > 0:
                 self.cars[-1].f_car = None
 
+        self.velocity_stats.extend(velocities)
+        self.acceleration_stats.extend(accelerations)
+
+        if self.ring:
+            self.wrap_cars(frame, exit_logger)
+
+        # Once per sub-step, the queries of this state build their arrays again
+        self.arrays = {}
+
         if len(self.cars) == 0:
             return 2
 
@@ -187,8 +452,84 @@ class Highway:
 
         return 1
 
+    def detect_collisions(self, x_before: Optional[np.ndarray] = None):
+        """Computes the gaps and collision flags of every car in a single pass
+
+        Cars are stored from back to front, so the front car of cars[i] is
+        cars[i + 1]. In a ring road the front car of the last car is the
+        first one, a lap ahead. The results are cached on each car and read by
+        Car.has_collided, Car.distance_to_front_car, Car.distance_to_back_car
+        and Car.crashes_upfront until the next sub-step.
+
+        Args:
+            x_before (Optional[np.ndarray], optional): Positions before this
+                sub-step's physics. Cars used to be updated one at a time from
+                back to front, so each car saw its front car where it was
+                before moving. Passing them keeps that model. Defaults to None.
+        """
+        n = len(self.cars)
+        if n == 0:
+            return
+
+        x = np.fromiter((car.x for car in self.cars), dtype=float, count=n)
+        length = np.fromiter((car.length for car in self.cars), dtype=float, count=n)
+        crashed = np.fromiter((car.crashed for car in self.cars), dtype=bool, count=n)
+
+        if x_before is None or len(x_before) != n:
+            x_before = x
+
+        front_gap = np.full(n, np.nan)
+        front_gap[:-1] = x_before[1:] - (x[:-1] + length[:-1])
+        back_gap = np.full(n, np.nan)
+        back_gap[1:] = x[1:] - (x[:-1] + length[:-1])
+
+        if self.ring:
+            front_gap[-1] = x_before[0] + self.length - (x[-1] + length[-1])
+            back_gap[0] = x[0] + self.length - (x[-1] + length[-1])
+
+        # A gap of exactly 0 is not a crash
+        crashed |= (front_gap < 0) | (back_gap < 0)
+
+        # Crashed cars can overlap, so the order of the list is not trusted
+        self.sorted_x = np.sort(x)
+
+        # Crashed cars strictly ahead of each car, in a ring every other car is ahead
+        if self.ring:
+            crashes_ahead = crashed.sum() - crashed
+        else:
+            crashes_ahead = np.cumsum(crashed[::-1])[::-1] - crashed
+
+        front_gap_list = front_gap.tolist()
+        back_gap_list = back_gap.tolist()
+        for i, car in enumerate(self.cars):
+            car.crashed = bool(crashed[i])
+            car.front_gap = None if i == n - 1 and not self.ring else front_gap_list[i]
+            car.back_gap = None if i == 0 and not self.ring else back_gap_list[i]
+            car.crash_ahead = bool(crashes_ahead[i])
+            car.gaps_cached = True
+
+    def count_cars_behind(self, x: float, distance: float) -> int:
+        """Cars strictly between x - distance and x
+
+        Two bisections over the positions of the last collision pass, a scan of the
+        cars when there was none.
+        """
+        if self.sorted_x is None:
+            return sum(1 for car in self.cars if car.x < x and car.x > x - distance)
+        return int(
+            np.searchsorted(self.sorted_x, x, "left")
+            - np.searchsorted(self.sorted_x, x - distance, "right")
+        )
+
+    def has_crash_ahead_of_back(self) -> bool:
+        """Whether any crashed car other than the back car is on the road, in O(1)"""
+        back_car = self.get_back_car()
+        if back_car is None:
+            return False
+        return len(self.crashed_ids) - (back_car.id in self.crashed_ids) > 0
+
     def has_crashes(self) -> bool:
-        return len(self.crashes) > 0
+        return len(self.tow_queue) > 0
 
     def run(self, time: float):
         pass
@@ -202,29 +543,58 @@ class Highway:
     def get_cars(self):
         return self.cars
 
+    def car_array(self, name: str, value: Callable, dtype=float) -> np.ndarray:
+        """Array of a value of every car, in the order of get_cars
+
+        Built once until the cars change (every sub-step, or when a car enters or
+        leaves) and returned read-only, every caller gets the same array.
+
+        Args:
+            name (str): Name of the array in the cache
+            value (Callable): value(car) of each car
+            dtype (optional): Type of the array. Defaults to float.
+
+        Returns:
+            np.ndarray: Read-only array
+        """
+        array = self.arrays.get(name)
+        if array is None:
+            cars = self.get_cars()
+            array = np.fromiter((value(car) for car in cars), dtype=dtype, count=len(cars))
+            array.flags.writeable = False
+            self.arrays[name] = array
+        return array
+
     def get_cars_positions(self):
-        return [car.get_position() for car in self.cars]
+        return self.car_array("x", lambda car: car.x)
 
     def get_cars_velocities(self):
-        return [car.v for car in self.cars]
+        """Velocities in m/s"""
+        return self.car_array("v", lambda car: car.v)
 
     def get_cars_accelerations(self):
-        return [car.a for car in self.cars]
+        return self.car_array("a", lambda car: car.a)
 
     def get_cars_distances(self):
-        pass
+        """Gap to the front car in meters, NaN without a front car"""
+        return self.car_array("distance", lambda car: _or_nan(car.distance_to_front_car()))
 
     def get_cars_times(self):
-        return [car.time_ellapsed for car in self.cars]
+        """Time on the highway in sub-steps"""
+        return self.car_array("time", lambda car: car.time_ellapsed)
 
     def get_cars_reaction_times(self):
-        pass
+        """Current reaction time in seconds, attention included"""
+        return self.car_array("reaction_time", lambda car: car.get_reaction_time() / car.precision)
 
     def get_cars_desired_velocities(self):
-        pass
+        """Desired velocities in m/s"""
+        return self.car_array("desired_velocity", lambda car: car.desired_velocity)
 
     def get_cars_front_cars(self):
-        pass
+        """Id of the front car of each car, -1 without one"""
+        return self.car_array("f_car_id", lambda car: car.f_car.id if car.f_car is not None else -1, np.int64)
 
     def get_cars_back_cars(self):
-        pass
+        """Id of the back car of each car, -1 without one"""
+        return self.car_array("b_car_id", lambda car: car.b_car.id if car.b_car is not None else -1, np.int64)
@@ -0,0 +1,409 @@
+"""
+* Hybrid corridor: macroscopic stretches around a microscopic focus window
+* Upstream and downstream stretches use the cell transmission model (CTM), the Godunov
+* discretization of the LWR model with a triangular fundamental diagram
+* The focus window is a regular Highway with Car objects, fed by an Inflow
+
+* Boundaries, vehicles are conserved:
+* macro -> micro  the last upstream cell sends flow into a small buffer, whole vehicles leave
+*                 the buffer through the Inflow of the window (same 80 m entrance rule as
+*                 the simulation) with the speed of the cell. A full buffer stops the flow,
+*                 so a blocked entrance spills back upstream
+* micro -> macro  every car that exits the window joins a buffer that feeds the first
+*                 downstream cell as far as it can receive
+* Towed cars leave the corridor and are counted apart
+
+* Capacity: the entrance rule limits the window to its saturation flow, well below the
+* 2000 veh/h of a macroscopic lane. The stretches use the same capacity as the window,
+* measured with a car always waiting at the entrance (--measure_capacity True), so the
+* bottleneck of the corridor is not an artifact of the boundary
+
+* Units: density in veh/m, flow in veh/s, one macro step per frame (1 s)
+* Spillback from the downstream stretch into the window is not modelled, the window always
+* lets its cars out
+
+* run: python hybrid.py --upstream 10000 --window 2000 --downstream 2000 --frames 1200 --precision 10 --arrival_rate 400
+"""
+
+import argparse
+import os
+import time
+from datetime import datetime
+from typing import Dict
+
+import numpy as np
+from tqdm import tqdm
+
+from highway import Highway
+from inflow import DemandProfile, DriverPopulation, GapArrivals, Inflow, PoissonArrivals
+from variance import random_streams
+
+
+# Saturation flow of a 2000 m window with the 80 m entrance rule, veh/h. Measured with
+# window_capacity on seeds 1 to 6 (2400 frames, 300 to 700 veh/h, crashes make it vary a lot)
+WINDOW_CAPACITY = 450
+
+
+def window_capacity(
+    length: float,
+    population: DriverPopulation,
+    rng: np.random.Generator,
+    precision: int = 10,
+    entrance_gap: float = 80,
+    frames: int = 1200,
+    warmup: int = 200,
+) -> float:
+    """Saturation flow of a microscopic window, a car is always waiting at the entrance
+
+    Args:
+        length (float): Length of the window in meters
+        population (DriverPopulation): Drivers of the window
+        rng (np.random.Generator): Random generator of the entrance
+        precision (int, optional): Sub-steps per frame. Defaults to 10.
+        entrance_gap (float, optional): Meters the back car must be in. Defaults to 80.
+        frames (int, optional): Frames to simulate. Defaults to 1200.
+        warmup (int, optional): Frames left out of the count. Defaults to 200.
+
+    Returns:
+        float: Cars that entered per hour after the warm-up
+    """
+    window = Highway(length, precision=precision)
+    inflow = Inflow(window, population, GapArrivals(), rng, min_gap=entrance_gap)
+    entered = 0
+    for frame in range(frames):
+        for sub_t in range(precision):
+            t = frame * precision + sub_t
+            window.update(t)
+            if inflow.step(t) is not None and frame >= warmup:
+                entered += 1
+    return 3600 * entered / (frames - warmup)
+
+
+class CellTransmission:
+    """Cell transmission model of a stretch
+
+    Args:
+        length (float): Length of the stretch in meters
+        cell_length (float, optional): Cell length in meters. Defaults to 100.
+        free_speed (float, optional): Free flow speed in km/h. Defaults to 100.
+        capacity (float, optional): Capacity in veh/h. Defaults to 2000.
+        jam_density (float, optional): Jam density in veh/km. Defaults to 133.
+        dt (float, optional): Step in seconds. Defaults to 1.
+    """
+
+    def __init__(
+        self,
+        length: float,
+        cell_length: float = 100,
+        free_speed: float = 100,
+        capacity: float = 2000,
+        jam_density: float = 133,
+        dt: float = 1,
+    ):
+        self.cells = max(1, int(round(length / cell_length)))
+        self.dx = length / self.cells
+        self.dt = dt
+
+        self.v_f = free_speed / 3.6
+        self.q_max = capacity / 3600
+        self.k_jam = jam_density / 1000
+        self.k_critical = self.q_max / self.v_f
+        if self.k_critical >= self.k_jam:
+            raise ValueError("Capacity too high for the jam density")
+        self.w = self.q_max / (self.k_jam - self.k_critical)
+
+        # Courant-Friedrichs-Lewy condition
+        if max(self.v_f, self.w) * dt > self.dx:
+            raise ValueError(f"Cells of {self.dx:.1f} m are too short for a {dt} s step at {free_speed} km/h")
+
+        self.k = np.zeros(self.cells)
+        self.accepted = 0.0
+
+    def sending(self) -> np.ndarray:
+        return np.minimum(self.v_f * self.k, self.q_max)
+
+    def receiving(self) -> np.ndarray:
+        return np.minimum(self.q_max, self.w * (self.k_jam - self.k))
+
+    def speed(self, cell: int) -> float:
+        """Speed of a cell in m/s, from the fundamental diagram"""
+        k = self.k[cell]
+        if k <= self.k_critical:
+            return self.v_f
+        return self.w * (self.k_jam - k) / k
+
+    def step(self, inflow: float, outflow_capacity: float) -> float:
+        """Advances one step
+
+        Args:
+            inflow (float): Flow offered to the first cell (veh/s)
+            outflow_capacity (float): Flow the end of the stretch can take (veh/s)
+
+        Returns:
+            float: Flow that left the stretch (veh/s). The flow that entered is
+            min(inflow, receiving of the first cell), see accepted
+        """
+        sending = self.sending()
+        receiving = self.receiving()
+
+        flows = np.empty(self.cells + 1)
+        flows[0] = min(inflow, receiving[0])
+        flows[1:-1] = np.minimum(sending[:-1], receiving[1:])
+        flows[-1] = min(sending[-1], outflow_capacity)
+
+        self.k += self.dt / self.dx * (flows[:-1] - flows[1:])
+        self.accepted = flows[0]
+        return flows[-1]
+
+    def vehicles(self) -> float:
+        return float(self.k.sum() * self.dx)
+
+
+class BoundaryArrivals:
+    """Arrival process of the window, the vehicles that left the upstream stretch
+
+    Holds the fractional part of the flow, whole vehicles are handed to the Inflow.
+    """
+
+    name = "boundary"
+    max_queued = None
+
+    def __init__(self):
+        self.pending = 0.0
+
+    def add(self, vehicles: float):
+        self.pending += vehicles
+
+    def arrivals(self, t: float) -> int:
+        count = int(self.pending)
+        self.pending -= count
+        return count
+
+    def describe(self) -> Dict:
+        return {"name": self.name}
+
+
+class HybridCorridor:
+    """Corridor with a microscopic focus window between two macroscopic stretches
+
+    Args:
+        upstream (float): Length of the upstream stretch in meters
+        window (float): Length of the focus window in meters
+        downstream (float): Length of the downstream stretch in meters
+        arrivals: Arrival process at the start of the corridor (PoissonArrivals or DemandProfile)
+        population (DriverPopulation): Drivers of the window
+        rng (np.random.Generator): Random generator of the window entrance
+        precision (int, optional): Sub-steps per frame in the window. Defaults to 10.
+        cell_length (float, optional): Cell length of the stretches in meters. Defaults to 100.
+        max_v (float, optional): Free flow speed in km/h. Defaults to 100.
+        capacity (float, optional): Capacity of the stretches in veh/h. Defaults to WINDOW_CAPACITY,
+            the saturation flow of the window, so both models have the same capacity.
+        jam_density (float, optional): Jam density in veh/km. Defaults to 133.
+        buffer_vehicles (float, optional): Vehicles that can wait at the window entrance. Defaults to 2.
+        entrance_gap (float, optional): Meters the back car of the window must be in for the next
+            one to enter. Defaults to 80, like the simulation.
+        crash_remove_delay (int, optional): Sub-steps before a crashed car is towed. Defaults to 5000.
+    """
+
+    def __init__(
+        self,
+        upstream: float,
+        window: float,
+        downstream: float,
+        arrivals,
+        population: DriverPopulation,
+        rng: np.random.Generator,
+        precision: int = 10,
+        cell_length: float = 100,
+        max_v: float = 100,
+        capacity: float = WINDOW_CAPACITY,
+        jam_density: float = 133,
+        buffer_vehicles: float = 2,
+        entrance_gap: float = 80,
+        crash_remove_delay: int = 5000,
+    ):
+        model = dict(
+            cell_length=cell_length, free_speed=max_v, capacity=capacity, jam_density=jam_density
+        )
+        self.upstream = CellTransmission(upstream, **model)
+        self.downstream = CellTransmission(downstream, **model)
+        self.window = Highway(window, crash_remove_delay=crash_remove_delay, precision=precision)
+
+        self.arrivals = arrivals
+        self.boundary = BoundaryArrivals()
+        self.inflow = Inflow(self.window, population, self.boundary, rng, min_gap=entrance_gap)
+        self.precision = precision
+        self.buffer_vehicles = buffer_vehicles
+
+        # Vehicle counts of the balance
+        self.entry_queue = 0.0
+        self.arrived = 0
+        self.window_entered = 0
+        self.window_exited = 0
+        self.window_crashes = 0
+        self.exit_buffer = 0.0
+        self.exited = 0.0
+
+        self.frame = 0
+        self.history = {"upstream": [], "downstream": [], "window": [], "balance_error": []}
+
+    def record_exit(self, car, frame: int):
+        self.window_exited += 1
+        self.exit_buffer += 1
+
+    def record_crash(self, car, frame: int):
+        self.window_crashes += 1
+
+    def step(self):
+        """Simulates one frame: the stretches once, the window `precision` times"""
+        dt = self.upstream.dt
+        frame = self.frame
+
+        # Upstream stretch, it can send into the window while the entrance buffer has room
+        arrived = self.arrivals.arrivals((frame + 1) * dt)
+        self.arrived += arrived
+        self.entry_queue += arrived
+
+        waiting = self.boundary.pending + self.inflow.queued
+        boundary_capacity = max(0.0, self.buffer_vehicles - waiting) / dt
+        sent = self.upstream.step(self.entry_queue / dt, boundary_capacity)
+        self.entry_queue -= self.upstream.accepted * dt
+        self.boundary.add(sent * dt)
+
+        # Window, whole vehicles enter at the speed of the last upstream cell
+        speed = self.upstream.speed(self.upstream.cells - 1)
+        for sub_t in range(self.precision):
+            t = frame * self.precision + sub_t
+            self.window.update(t, exit_logger=self.record_exit, crash_logger=self.record_crash)
+            car = self.inflow.step(t)
+            if car is not None:
+                car.v = min(car.v, speed)
+                self.window_entered += 1
+
+        # Downstream stretch, fed by the cars that left the window
+        self.exited += self.downstream.step(self.exit_buffer / dt, np.inf) * dt
+        self.exit_buffer -= self.downstream.accepted * dt
+
+        self.frame += 1
+        self.history["upstream"].append(self.upstream.k.copy())
+        self.history["downstream"].append(self.downstream.k.copy())
+        self.history["window"].append(len(self.window))
+        self.history["balance_error"].append(self.balance()["error"])
+
+    def balance(self) -> Dict[str, float]:
+        """Vehicles in each part of the corridor, error is arrived minus all of them"""
+        towed = self.window_entered - self.window_exited - len(self.window)
+        parts = {
+            "entry_queue": self.entry_queue,
+            "upstream": self.upstream.vehicles(),
+            "entrance_buffer": self.boundary.pending + self.inflow.queued,
+            "window": len(self.window),
+            "towed": towed,
+            "exit_buffer": self.exit_buffer,
+            "downstream": self.downstream.vehicles(),
+            "exited": self.exited,
+        }
+        parts["error"] = self.arrived - sum(parts.values())
+        parts["arrived"] = self.arrived
+        return parts
+
+    def corridor_density(self) -> np.ndarray:
+        """Density of every cell of the corridor (veh/km), window cars binned like the cells"""
+        dx = self.upstream.dx
+        window_cells = max(1, int(round(self.window.length / dx)))
+        x = np.fromiter((car.x for car in self.window.cars), dtype=float, count=len(self.window))
+        counts, _ = np.histogram(x, bins=window_cells, range=(0, self.window.length))
+        window_k = counts / (self.window.length / window_cells)
+        return 1000 * np.concatenate([self.upstream.k, window_k, self.downstream.k])
+
+    def run(self, frames: int, progress: bool = True):
+        for _ in tqdm(range(frames), disable=not progress):
+            self.step()
+
+    def save(self, path: str):
+        np.savez_compressed(
+            path,
+            upstream=np.array(self.history["upstream"]),
+            downstream=np.array(self.history["downstream"]),
+            window=np.array(self.history["window"]),
+            balance_error=np.array(self.history["balance_error"]),
+            cell_length=self.upstream.dx,
+            window_length=self.window.length,
+        )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Hybrid macro/micro corridor")
+    parser.add_argument("--upstream", type=float, help="Upstream macroscopic stretch in meters", default=10000)
+    parser.add_argument("--window", type=float, help="Microscopic focus window in meters", default=2000)
+    parser.add_argument("--downstream", type=float, help="Downstream macroscopic stretch in meters", default=2000)
+    parser.add_argument("--frames", type=int, help="Number of frames to simulate", default=1200)
+    parser.add_argument("--precision", type=int, help="Sub-steps per frame in the window", default=10)
+    parser.add_argument("--cell_length", type=float, help="Cell length in meters", default=100)
+    parser.add_argument("--max_v", type=int, help="Free flow speed in km/h", default=100)
+    parser.add_argument(
+        "--capacity", type=float, help="Capacity of the stretches in veh/h, the saturation flow of the window", default=WINDOW_CAPACITY
+    )
+    parser.add_argument(
+        "--measure_capacity", type=bool, help="Measure the saturation flow of the window and use it as capacity", default=False
+    )
+    parser.add_argument("--jam_density", type=float, help="Jam density in veh/km", default=133)
+    parser.add_argument("--arrival_rate", type=float, help="Poisson arrivals in cars per hour", default=400)
+    parser.add_argument("--demand_profile", type=str, help="CSV with time and rate columns", default=None)
+    parser.add_argument("--smart_car_probability", type=float, help="Probability of a smart car", default=0)
+    parser.add_argument("--seed", type=int, help="Seed for the random number generator", default=42)
+    parser.add_argument("--log", type=bool, help="Save the densities to logs/<timestamp>/hybrid.npz", default=False)
+
+    args = parser.parse_args()
+
+    np.random.seed(args.seed)
+    streams = random_streams(args.seed)
+    population = DriverPopulation(
+        streams["population"], max_v=args.max_v, smart_car_probability=args.smart_car_probability
+    )
+    if args.demand_profile is not None:
+        arrivals = DemandProfile.from_csv(streams["arrivals"], args.demand_profile)
+    else:
+        arrivals = PoissonArrivals(streams["arrivals"], args.arrival_rate)
+
+    capacity = args.capacity
+    if args.measure_capacity:
+        # Own random streams, the run itself is the same as with --capacity
+        measure_streams = random_streams(args.seed + 1)
+        capacity = window_capacity(
+            args.window,
+            DriverPopulation(measure_streams["population"], max_v=args.max_v, smart_car_probability=args.smart_car_probability),
+            measure_streams["entrance"],
+            precision=args.precision,
+        )
+        print(f"Saturation flow of the window: {capacity:.0f} veh/h")
+        np.random.seed(args.seed)
+
+    corridor = HybridCorridor(
+        args.upstream,
+        args.window,
+        args.downstream,
+        arrivals,
+        population,
+        streams["entrance"],
+        precision=args.precision,
+        cell_length=args.cell_length,
+        max_v=args.max_v,
+        capacity=capacity,
+        jam_density=args.jam_density,
+    )
+
+    start = time.perf_counter()
+    corridor.run(args.frames)
+    elapsed = time.perf_counter() - start
+
+    balance = corridor.balance()
+    print(f"{args.frames} frames in {elapsed:.1f} s, {corridor.window_crashes} crashes in the window")
+    print(", ".join(f"{name}: {value:.2f}" for name, value in balance.items()))
+    print(f"Max conservation error: {np.abs(corridor.history['balance_error']).max():.2e} vehicles")
+
+    if args.log:
+        log_dir = f"logs/{datetime.now().strftime('%Y-%m-%d_%H-%M-%S')}"
+        os.makedirs(log_dir, exist_ok=True)
+        corridor.save(f"{log_dir}/hybrid.npz")
+        print(f"Saved {log_dir}/hybrid.npz")
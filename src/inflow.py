@@ -0,0 +1,448 @@
+"""
+* Inflow of cars into the highway
+* The driver population is sampled in large vectorized blocks
+* Arrivals follow a configurable process and are checked every sub-step
+
+* Arrival processes:
+* GapArrivals: a car enters as soon as the back car is far enough (the original rule)
+* PoissonArrivals: exponential inter-arrival times with a fixed rate
+* DemandProfile: time-varying Poisson arrivals, piecewise constant rate (thinning)
+
+* RingInflow keeps a fixed number of cars on a ring road instead
+"""
+
+import copy
+from typing import Dict, List, Optional
+
+import numpy as np
+import pandas as pd
+
+from car import Car
+from highway import Highway
+
+
+class DriverPopulation:
+    """Pre-sampled driver parameters
+
+    Args:
+        rng (np.random.Generator): Random generator of the population
+        max_v (float, optional): Speed limit in km/h, desired velocity of smart cars. Defaults to 100.
+        smart_car_probability (float, optional): Share of smart cars. Defaults to 0.
+        block_size (int, optional): Cars sampled at once. Defaults to 4096.
+        parameters (Optional[Dict], optional): Distribution parameters to change, see DEFAULT_PARAMETERS. Defaults to None.
+    """
+
+    # Distribution parameters that calibrate.py searches
+    DEFAULT_PARAMETERS = {
+        "tr_mean": 0.732,
+        "tr_std": 0.163,
+        "acc_stopping": 0.4,
+        "random_behavior_share": 0.6,
+    }
+
+    FIELDS = [
+        "v",
+        "vmax",
+        "a",
+        "amax",
+        "break_max",
+        "acc_throttle",
+        "acc_stopping",
+        "length",
+        "tr",
+        "vd",
+        "has_random_behavior",
+        "smart",
+    ]
+
+    def __init__(
+        self,
+        rng: np.random.Generator,
+        max_v: float = 100,
+        smart_car_probability: float = 0,
+        block_size: int = 4096,
+        parameters: Optional[Dict] = None,
+    ):
+        unknown = set(parameters or {}) - set(self.DEFAULT_PARAMETERS)
+        if unknown:
+            raise ValueError(f"Unknown driver parameters: {', '.join(sorted(unknown))}")
+        self.parameters = {**self.DEFAULT_PARAMETERS, **(parameters or {})}
+
+        self.rng = rng
+        self.max_v = max_v
+        self.smart_car_probability = smart_car_probability
+        self.block_size = block_size
+
+        self.block = None
+        # Generator as it was before the current block, the block is drawn again from it
+        # when a checkpoint is loaded instead of being stored (see replay.py)
+        self.block_rng = None
+        self.index = 0
+        self.sampled = 0
+
+    def __getstate__(self):
+        return {**self.__dict__, "block": None}
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        if self.block_rng is not None:
+            rng, self.rng = self.rng, copy.deepcopy(self.block_rng)
+            self.block = self.sample_block(self.block_size)
+            self.rng = rng
+
+    def sample_block(self, size: int) -> Dict[str, np.ndarray]:
+        """Samples the parameters of `size` cars
+
+        Same distributions the simulation used car by car, int() truncations included.
+        """
+        rng = self.rng
+        p = self.parameters
+
+        block = {
+            "v": rng.uniform(50, 80, size).astype(int).astype(float),
+            "vmax": rng.normal(120, 10, size).astype(int).astype(float),
+            "a": np.maximum(0, rng.normal(2, 1, size).astype(int)).astype(float),
+            "amax": rng.uniform(1.5, 3, size),
+            "break_max": rng.normal(3.5, 0.5, size),
+            "acc_throttle": rng.normal(0.1, 0.01, size),
+            "acc_stopping": rng.normal(p["acc_stopping"], 0.001, size),
+            "length": rng.normal(4.5, 0.5, size),
+            "tr": np.where(
+                rng.uniform(size=size) > 0.001, rng.normal(p["tr_mean"], p["tr_std"], size), 0
+            ),
+            "vd": rng.normal(100, 5, size).astype(int).astype(float),
+            "has_random_behavior": rng.uniform(size=size) > 1 - p["random_behavior_share"],
+            "smart": rng.uniform(size=size) < self.smart_car_probability,
+        }
+
+        # Smart cars: fixed parameters, no reaction time
+        smart = block["smart"]
+        block["v"][smart] = 60
+        block["vmax"][smart] = 120
+        block["vd"][smart] = self.max_v
+        block["a"][smart] = 2
+        block["amax"][smart] = 3
+        block["break_max"][smart] = 3.5
+        block["acc_throttle"][smart] = 0.1
+        block["acc_stopping"][smart] = 0.4
+        block["length"][smart] = 4.5
+        block["tr"][smart] = 0
+        block["has_random_behavior"][smart] = False
+
+        return block
+
+    def next_parameters(self) -> Dict:
+        if self.block is None or self.index >= self.block_size:
+            self.block_rng = copy.deepcopy(self.rng)
+            self.block = self.sample_block(self.block_size)
+            self.index = 0
+
+        i = self.index
+        self.index += 1
+        self.sampled += 1
+        return {field: self.block[field][i] for field in self.FIELDS}
+
+    def next_car(self, x: Optional[float] = None) -> Car:
+        p = self.next_parameters()
+        return Car(
+            x=x,
+            v=float(p["v"]),
+            vmax=float(p["vmax"]),
+            a=float(p["a"]),
+            amax=float(p["amax"]),
+            break_max=float(p["break_max"]),
+            acc_throttle=float(p["acc_throttle"]),
+            acc_stopping=float(p["acc_stopping"]),
+            length=float(p["length"]),
+            tr=float(p["tr"]),
+            vd=float(p["vd"]),
+            fc=None,
+            bc=None,
+            will_measure=True,
+            has_random_behavior=bool(p["has_random_behavior"]),
+        )
+
+
+class GapArrivals:
+    """A car is always waiting, it enters when the entrance is free"""
+
+    name = "gap"
+    max_queued = 1
+
+    def arrivals(self, t: float) -> int:
+        return 1
+
+    def describe(self) -> Dict:
+        return {"name": self.name}
+
+
+class PoissonArrivals:
+    """Poisson arrivals
+
+    Args:
+        rng (np.random.Generator): Random generator of the arrivals
+        rate (float): Cars per hour
+        block_size (int, optional): Inter-arrival times sampled at once. Defaults to 1024.
+    """
+
+    name = "poisson"
+    max_queued = None
+
+    def __init__(self, rng: np.random.Generator, rate: float, block_size: int = 1024):
+        if rate <= 0:
+            raise ValueError("Arrival rate must be positive")
+        self.rng = rng
+        self.rate = rate
+        self.block_size = block_size
+
+        self.times = np.empty(0)
+        self.index = 0
+        self.last_time = 0.0
+        self.next_time = self._next()
+
+    def _next(self) -> float:
+        if self.index >= len(self.times):
+            gaps = self.rng.exponential(3600 / self.rate, self.block_size)
+            self.times = self.last_time + np.cumsum(gaps)
+            self.index = 0
+        self.last_time = self.times[self.index]
+        self.index += 1
+        return self.last_time
+
+    def arrivals(self, t: float) -> int:
+        """Cars that arrived up to time t (seconds)"""
+        count = 0
+        while self.next_time <= t:
+            count += 1
+            self.next_time = self._next()
+        return count
+
+    def describe(self) -> Dict:
+        return {"name": self.name, "rate": self.rate}
+
+
+class DemandProfile(PoissonArrivals):
+    """Time-varying Poisson arrivals with a piecewise constant rate
+
+    Arrivals are sampled at the maximum rate and kept with probability
+    rate(t) / max rate (thinning).
+
+    Args:
+        rng (np.random.Generator): Random generator of the arrivals
+        times (List[float]): Start time of each period in seconds
+        rates (List[float]): Cars per hour of each period
+    """
+
+    name = "profile"
+
+    def __init__(self, rng: np.random.Generator, times: List[float], rates: List[float]):
+        if len(times) != len(rates) or len(times) == 0:
+            raise ValueError("Demand profile needs one rate per period")
+        self.period_times = np.asarray(times, dtype=float)
+        self.period_rates = np.asarray(rates, dtype=float)
+        super().__init__(rng, rate=float(self.period_rates.max()))
+
+    @classmethod
+    def from_csv(cls, rng: np.random.Generator, path: str) -> "DemandProfile":
+        """Reads a CSV with `time` (s) and `rate` (cars per hour) columns"""
+        profile = pd.read_csv(path)
+        return cls(rng, profile["time"].tolist(), profile["rate"].tolist())
+
+    def rate_at(self, t: float) -> float:
+        period = np.searchsorted(self.period_times, t, side="right") - 1
+        return float(self.period_rates[max(period, 0)])
+
+    def _next(self) -> float:
+        while True:
+            t = super()._next()
+            if self.rng.uniform() * self.rate < self.rate_at(t):
+                return t
+
+    def describe(self) -> Dict:
+        return {
+            "name": self.name,
+            "times": self.period_times.tolist(),
+            "rates": self.period_rates.tolist(),
+        }
+
+
+class Inflow:
+    """Inserts cars at the start of the highway at sub-step resolution
+
+    Arrivals wait at the entrance until the back car is `min_gap` meters in.
+    Like the original rule, a crash ahead only blocks the entrance when the
+    back car is linked to the highway (see Highway.add_car): a car that came
+    through the entrance does not look for crashes, so it never blocks. A
+    blocked entrance still opens with probability P(Poisson(1) == 1) per second.
+
+    Args:
+        highway (Highway): Highway
+        population (DriverPopulation): Driver population
+        arrivals: Arrival process
+        rng (np.random.Generator): Random generator of the entrance
+        min_gap (float, optional): Meters the back car must be in. Defaults to 80.
+    """
+
+    ESCAPE_PROBABILITY = np.exp(-1)
+
+    def __init__(
+        self,
+        highway: Highway,
+        population: DriverPopulation,
+        arrivals,
+        rng: np.random.Generator,
+        min_gap: float = 80,
+    ):
+        self.highway = highway
+        self.population = population
+        self.arrivals = arrivals
+        self.rng = rng
+        self.min_gap = min_gap
+
+        self.queued = 0
+        self.spawned = 0
+
+        # Same escape rate per second as the old once-per-frame check
+        self.escape_probability = 1 - (1 - self.ESCAPE_PROBABILITY) ** (
+            1 / highway.precision
+        )
+
+    def entrance_free(self) -> bool:
+        back_car = self.highway.get_back_car()
+        if back_car is None:
+            return True
+        if back_car.get_position() <= self.min_gap:
+            return False
+        return (
+            back_car.highway is None
+            or not self.highway.has_crash_ahead_of_back()
+            or self.rng.uniform() < self.escape_probability
+        )
+
+    def step(self, frame: int) -> Optional[Car]:
+        """Called after every sub-step
+
+        Args:
+            frame (int): Sub-step index
+
+        Returns:
+            Optional[Car]: Car added, if any
+        """
+        self.queued += self.arrivals.arrivals(frame / self.highway.precision)
+        if self.arrivals.max_queued is not None:
+            self.queued = min(self.queued, self.arrivals.max_queued)
+
+        if self.queued == 0 or not self.entrance_free():
+            return None
+
+        car = self.population.next_car()
+        car.set_initial_frame(frame)
+        self.highway.add_car(car)
+        self.queued -= 1
+        self.spawned += 1
+        return car
+
+    def describe(self) -> Dict:
+        return {
+            "arrivals": self.arrivals.describe(),
+            "min_gap": self.min_gap,
+            "smart_car_probability": self.population.smart_car_probability,
+        }
+
+
+class RingInflow:
+    """Keeps a fixed number of cars on a ring road
+
+    The cars are placed evenly spaced at the requested density, at a speed
+    they can keep with that spacing. A towed car is replaced by a new one in
+    the middle of the largest gap, once that gap leaves `min_gap` meters on
+    each side.
+
+    Args:
+        highway (Highway): Ring road
+        population (DriverPopulation): Driver population
+        density (float): Cars per km
+        min_gap (float, optional): Meters left in front and behind a replacement car. Defaults to 20.
+    """
+
+    # Room for a car (4.5 m ± 0.5 m) and a margin
+    MIN_SPACING = 8
+
+    def __init__(
+        self,
+        highway: Highway,
+        population: DriverPopulation,
+        density: float,
+        min_gap: float = 20,
+    ):
+        if not highway.ring:
+            raise ValueError("RingInflow needs a ring road")
+
+        self.highway = highway
+        self.population = population
+        self.density = density
+        self.min_gap = min_gap
+
+        self.car_count = int(round(density * highway.length / 1000))
+        if self.car_count < 1:
+            raise ValueError("Density too low for the ring length")
+
+        self.spacing = highway.length / self.car_count
+        if self.spacing < self.MIN_SPACING:
+            raise ValueError("Density too high, cars would overlap")
+
+        self.spawned = 0
+
+    def new_car(self, x: float, gap: float, frame: int) -> Car:
+        car = self.population.next_car(x=x)
+        # Start at a speed that does not force an immediate brake
+        car.v = min(car.v, max(0, gap - car.length) / 2)
+        car.set_initial_frame(frame)
+        return car
+
+    def populate(self, frame: int = 0):
+        """Places the fixed number of cars evenly spaced"""
+        for k in range(self.car_count):
+            self.highway.add_car(self.new_car(k * self.spacing, self.spacing, frame))
+            self.spawned += 1
+
+    def largest_gap(self):
+        """Start and size of the largest free gap of the ring"""
+        cars = self.highway.get_cars()
+        if len(cars) == 0:
+            return 0.0, self.highway.length
+        x = np.fromiter((car.x for car in cars), dtype=float, count=len(cars))
+        front = x + np.fromiter((car.length for car in cars), dtype=float, count=len(cars))
+        gaps = np.append(x[1:], x[0] + self.highway.length) - front
+        i = int(np.argmax(gaps))
+        return float(front[i]), float(gaps[i])
+
+    def step(self, frame: int) -> Optional[Car]:
+        """Called after every sub-step, replaces at most one towed car
+
+        Args:
+            frame (int): Sub-step index
+
+        Returns:
+            Optional[Car]: Car added, if any
+        """
+        if len(self.highway) >= self.car_count:
+            return None
+
+        start, gap = self.largest_gap()
+        if gap < 2 * self.min_gap + self.MIN_SPACING:
+            return None
+
+        car = self.new_car(start + gap / 2, gap / 2, frame)
+        self.highway.add_car(car)
+        self.spawned += 1
+        return car
+
+    def describe(self) -> Dict:
+        return {
+            "ring": True,
+            "density": self.density,
+            "car_count": self.car_count,
+            "min_gap": self.min_gap,
+            "smart_car_probability": self.population.smart_car_probability,
+        }
@@ -0,0 +1,214 @@
+"""
+* Compiled per car rules for the batched engine
+* Car following (Car.behaviour) and the resolution of the queued actions, as loops
+* over the flat (replica x car) arrays of BatchedHighway
+* Compiled with numba when it is installed, otherwise the same loops run as plain Python
+
+* The random numbers are drawn by the engine and passed in, so both backends use the same ones
+
+* run: python kernel.py (compares the kernel with the NumPy backend)
+"""
+
+import numpy as np
+
+from car import ACCELERATE, DECELERATE, DEFAULT_ATTENTION, INCREASE_ATTENTION, STOP
+
+try:
+    from numba import njit
+
+    NUMBA_AVAILABLE = True
+except ImportError:
+    NUMBA_AVAILABLE = False
+
+    def njit(*args, **kwargs):
+        if len(args) == 1 and callable(args[0]):
+            return args[0]
+        return lambda function: function
+
+
+ACTION_COUNT = 6
+
+
+@njit(cache=True)
+def enqueue(pending, active, enqueued_at, b, i, action, due, t):
+    slots = pending.shape[3]
+    last = int(np.floor(due))
+    if last < t:
+        last = t
+    if last > t + slots - 1:
+        last = t + slots - 1
+    pending[b, i, action, last % slots] += 1
+    active[b, i, action] += 1
+    enqueued_at[b, i, action] = t
+
+
+@njit(cache=True)
+def keep_only(pending, active, b, i, action):
+    for code in range(ACTION_COUNT):
+        if code != action:
+            pending[b, i, code, :] = 0
+            active[b, i, code] = 0
+
+
+@njit(cache=True)
+def behaviour(
+    n,
+    t,
+    driving,
+    v,
+    vd,
+    tr,
+    stopping,
+    increased_attention,
+    decreased_attention,
+    delay,
+    front_gap,
+    has_leader,
+    crash_ahead,
+    leader_v,
+    leader_a,
+    leader_stopping,
+    leader_crashed,
+    u,
+    noise,
+    pending,
+    active,
+    enqueued_at,
+):
+    """Queues the actions of every driving car, like BatchedHighway.behaviour"""
+    for b in range(n.shape[0]):
+        for i in range(n[b]):
+            if not driving[b, i]:
+                continue
+
+            speed = v[b, i]
+            inc = 1.0 if increased_attention[b, i] else 0.0
+            dec = 1.0 if decreased_attention[b, i] else 0.0
+            leader = has_leader[b, i]
+            gap = front_gap[b, i] if leader else np.inf
+
+            # Attention
+            alert = crash_ahead[b, i] or (
+                leader and leader_stopping[b, i] and gap <= 5 * speed and u[0, b, i] < 0.5
+            )
+            if alert and not increased_attention[b, i]:
+                enqueue(pending, active, enqueued_at, b, i, INCREASE_ATTENTION, t + 1, t)
+            elif not alert and increased_attention[b, i]:
+                enqueue(pending, active, enqueued_at, b, i, DEFAULT_ATTENTION, t + 1, t)
+
+            if stopping[b, i]:
+                continue
+
+            due = t + delay[b, i]
+            reacts = tr[b, i] > 0
+
+            # Front car crashed
+            if leader and leader_crashed[b, i]:
+                if gap <= 8 * speed:
+                    enqueue(pending, active, enqueued_at, b, i, STOP, due, t)
+                    keep_only(pending, active, b, i, STOP)
+                continue
+
+            if leader:
+                # Front car close, or close and braking harder than perceived
+                threshold = noise[b, i] * (0.1 - 0.05 * inc + 0.5 * dec) if reacts else 0.0
+                if gap <= 2 * speed or (gap <= 10 * speed and leader_a[b, i] < threshold):
+                    enqueue(pending, active, enqueued_at, b, i, DECELERATE, due, t)
+                    continue
+
+                # Slower than the front car (with an error in the estimation)
+                error = u[1, b, i] * (5 - 2 * inc + 2 * dec) if reacts else 0.0
+                if speed < leader_v[b, i] + error and speed < vd[b, i]:
+                    enqueue(pending, active, enqueued_at, b, i, ACCELERATE, due, t)
+                    continue
+
+            if speed < vd[b, i]:
+                enqueue(pending, active, enqueued_at, b, i, ACCELERATE, due, t)
+
+
+@njit(cache=True)
+def resolve(
+    n,
+    u,
+    a,
+    amax,
+    brake,
+    throttle,
+    stopping_acc,
+    stopping,
+    increased_attention,
+    decreased_attention,
+    active,
+    enqueued_at,
+):
+    """Runs the queued actions that fire, like BatchedHighway.resolve"""
+    for b in range(n.shape[0]):
+        for i in range(n[b]):
+            fires = np.zeros(ACTION_COUNT, dtype=np.bool_)
+            for code in range(ACTION_COUNT):
+                fires[code] = u[b, i, code] < 1 - 0.9 ** active[b, i, code]
+
+            acc = fires[ACCELERATE]
+            dec = fires[DECELERATE]
+            if acc and dec:
+                if enqueued_at[b, i, ACCELERATE] > enqueued_at[b, i, DECELERATE]:
+                    order = (DECELERATE, ACCELERATE)
+                else:
+                    order = (ACCELERATE, DECELERATE)
+            elif acc:
+                order = (ACCELERATE, ACCELERATE)
+            elif dec:
+                order = (DECELERATE, DECELERATE)
+            else:
+                order = (-1, -1)
+
+            value = a[b, i]
+            for k in range(2 if order[0] != order[1] else 1):
+                if order[k] == ACCELERATE:
+                    value = min(amax[b, i], max(value, 0.0) + 100 * throttle[b, i])
+                elif order[k] == DECELERATE:
+                    value = max(-brake[b, i], value - 100 * stopping_acc[b, i] / 5)
+            a[b, i] = value
+
+            if fires[STOP]:
+                stopping[b, i] = True
+            if fires[INCREASE_ATTENTION]:
+                increased_attention[b, i] = True
+            if fires[DEFAULT_ATTENTION]:
+                increased_attention[b, i] = False
+                decreased_attention[b, i] = False
+
+
+if __name__ == "__main__":
+    import time
+
+    from batched import BatchedHighway
+
+    print(f"numba: {'yes' if NUMBA_AVAILABLE else 'no, running the loops as plain Python'}")
+
+    engines = {}
+    for backend in ("numpy", "kernel"):
+        engine = BatchedHighway(
+            replicas=4, length=14 * 1000, precision=5, seed=7, log=True, backend=backend
+        )
+        start = time.perf_counter()
+        engine.run(300, progress=False)
+        engines[backend] = engine
+        print(f"{backend}: {time.perf_counter() - start:.2f} s")
+
+    reference, candidate = engines["numpy"], engines["kernel"]
+    for b in range(reference.replicas):
+        ref = reference.replica_logs(b)["agp_data"]
+        can = candidate.replica_logs(b)["agp_data"]
+        print(
+            f"replica {b}: cars {ref['current_car_count'].mean():.2f} / {can['current_car_count'].mean():.2f}, "
+            f"avg_v {ref['avg_v'].iloc[-1] * 3.6:.3f} / {can['avg_v'].iloc[-1] * 3.6:.3f} km/h, "
+            f"crashes {ref['historic_crash_count'].iloc[-1]} / {can['historic_crash_count'].iloc[-1]}"
+        )
+
+    # Same random numbers, so the runs only differ by rounding
+    same = np.array_equal(reference.n, candidate.n) and np.allclose(
+        reference.x, candidate.x, rtol=1e-9, atol=1e-6
+    )
+    print("OK: kernel matches the NumPy backend" if same else "FAIL: kernel differs")
+    raise SystemExit(0 if same else 1)
@@ -0,0 +1,395 @@
+"""
+* Multi-lane highway
+* Every lane is a Highway with its own cars sorted by position, so the single-lane rules
+* (collision pass, gaps, cars behind) run per lane on arrays of that lane only
+* Lane changes are decided in batch once per sub-step, after every lane updated: the leader
+* and follower of each car in the adjacent lanes come from np.searchsorted over the sorted
+* positions of that lane
+
+* A car changes lanes when:
+* - it is held back: slower than it wants and its front gap is under `anticipation` seconds
+*   at its desired speed
+* - the adjacent lane gives at least `incentive` meters more in front
+* - the gaps to the new leader and follower are safe: min_gap + safe_time * speed
+* - it did not change lanes in the last `cooldown` seconds
+* Crashed and stopping cars keep their lane. Moves into the same lane in the same sub-step
+* keep a safe distance between them, the rest wait for the next sub-step
+
+* MultiLaneHighway has the interface of Highway used by Inflow, the logs and the telemetry,
+* cars enter through the lane with the most room at the entrance
+
+* run: python lanes.py --lanes 4 --length 14000 --frames 600 --precision 10 --compare True
+"""
+
+import argparse
+import time
+from typing import Callable, Dict, List, Optional
+
+import numpy as np
+
+from car import Car
+from events import EventBus
+from highway import Highway
+from inflow import DriverPopulation, GapArrivals, Inflow
+from telemetry import RunningStats
+from variance import random_streams
+
+
+class MultiLaneHighway:
+    """Highway with several lanes in the same direction
+
+    Args:
+        length (float): Length in meters
+        lanes (int, optional): Number of lanes. Defaults to 2.
+        crash_remove_delay (int, optional): Sub-steps until a crashed car is towed. Defaults to 5000.
+        precision (int, optional): Sub-steps per frame. Defaults to 1.
+        event_bus (Optional[EventBus], optional): Bus for spawn, exit, crash and tow events. Defaults to None.
+        safe_time (float, optional): Seconds of headway needed in the target lane. Defaults to 1.
+        min_gap (float, optional): Meters needed in the target lane on top of the headway. Defaults to 5.
+        anticipation (float, optional): Seconds at the desired speed under which the front gap holds a car back. Defaults to 4.
+        incentive (float, optional): Meters of front gap the target lane has to add. Defaults to 10.
+        cooldown (float, optional): Seconds between two lane changes of a car. Defaults to 3.
+    """
+
+    def __init__(
+        self,
+        length: float,
+        lanes: int = 2,
+        crash_remove_delay: int = 5000,
+        precision: int = 1,
+        event_bus: Optional[EventBus] = None,
+        safe_time: float = 1.0,
+        min_gap: float = 5.0,
+        anticipation: float = 4.0,
+        incentive: float = 10.0,
+        cooldown: float = 3.0,
+    ):
+        if lanes < 1:
+            raise ValueError("A highway needs at least one lane")
+
+        self.length = length
+        self.precision = precision
+        self.crash_remove_delay = crash_remove_delay
+        self.event_bus = event_bus
+        self.ring = False
+        self.time = 0
+
+        self.safe_time = safe_time
+        self.min_gap = min_gap
+        self.anticipation = anticipation
+        self.incentive = incentive
+        self.cooldown = cooldown
+
+        self.lanes = [Highway(length, crash_remove_delay, precision, event_bus) for _ in range(lanes)]
+
+        # Ids and running sums are shared, the getters of Highway read the whole road
+        self.historic_ids = set()
+        self.velocity_stats = RunningStats()
+        self.acceleration_stats = RunningStats()
+        self.trip_stats = RunningStats()
+        for lane in self.lanes:
+            lane.historic_ids = self.historic_ids
+            lane.velocity_stats = self.velocity_stats
+            lane.acceleration_stats = self.acceleration_stats
+            lane.trip_stats = self.trip_stats
+
+        self.lane_changes = 0
+
+        # Arrays of the get_cars_* queries over every lane, see Highway.car_array
+        self.arrays = {}
+
+    get_crash_count = Highway.get_crash_count
+    get_avg_v = Highway.get_avg_v
+    get_avg_a = Highway.get_avg_a
+    get_avg_trip_duration = Highway.get_avg_trip_duration
+    get_max_v = Highway.get_max_v
+    get_max_a = Highway.get_max_a
+    get_max_trip_duration = Highway.get_max_trip_duration
+    get_min_v = Highway.get_min_v
+    get_min_a = Highway.get_min_a
+    get_min_trip_duration = Highway.get_min_trip_duration
+    car_array = Highway.car_array
+    get_cars_positions = Highway.get_cars_positions
+    get_cars_velocities = Highway.get_cars_velocities
+    get_cars_accelerations = Highway.get_cars_accelerations
+    get_cars_distances = Highway.get_cars_distances
+    get_cars_times = Highway.get_cars_times
+    get_cars_reaction_times = Highway.get_cars_reaction_times
+    get_cars_desired_velocities = Highway.get_cars_desired_velocities
+    get_cars_front_cars = Highway.get_cars_front_cars
+    get_cars_back_cars = Highway.get_cars_back_cars
+
+    def __len__(self):
+        return sum(len(lane) for lane in self.lanes)
+
+    def __getstate__(self):
+        # The lanes leave their bus out too, see Highway.__getstate__
+        return {**self.__dict__, "event_bus": None, "arrays": {}}
+
+    def set_event_bus(self, event_bus: Optional[EventBus]):
+        self.event_bus = event_bus
+        for lane in self.lanes:
+            lane.set_event_bus(event_bus)
+
+    def __str__(self):
+        return f"MultiLaneHighway(length={self.length}, lanes=[{', '.join(str(len(lane)) for lane in self.lanes)}])"
+
+    def __repr__(self):
+        return str(self)
+
+    @property
+    def cars(self) -> List[Car]:
+        """Cars of every lane, lane by lane and from back to front in each lane"""
+        return [car for lane in self.lanes for car in lane.cars]
+
+    @property
+    def historic_crash_count(self) -> int:
+        return sum(lane.historic_crash_count for lane in self.lanes)
+
+    def get_cars(self):
+        return self.cars
+
+    def get_front_car(self):
+        fronts = [lane.get_front_car() for lane in self.lanes if len(lane) > 0]
+        return max(fronts, key=lambda car: car.x) if fronts else None
+
+    def entrance_lane(self) -> int:
+        """Lane with the most room at the entrance, an empty lane first"""
+        room = [lane.get_back_car().x if len(lane) > 0 else np.inf for lane in self.lanes]
+        return int(np.argmax(room))
+
+    def get_back_car(self):
+        return self.lanes[self.entrance_lane()].get_back_car()
+
+    def has_crash_ahead_of_back(self) -> bool:
+        return self.lanes[self.entrance_lane()].has_crash_ahead_of_back()
+
+    def has_crashes(self) -> bool:
+        return any(lane.has_crashes() for lane in self.lanes)
+
+    def add_car(self, car: Car):
+        """Adds a car through the entrance lane (a positioned car goes to the front of it)"""
+        car.lane = self.entrance_lane()
+        self.lanes[car.lane].add_car(car)
+        self.arrays = {}
+
+    def tow_cars(self, now: bool = False):
+        for lane in self.lanes:
+            lane.tow_cars(now)
+        self.arrays = {}
+
+    def update(
+        self,
+        frame: int,
+        exit_logger: Optional[Callable] = None,
+        crash_logger: Optional[Callable] = None,
+    ):
+        for lane in self.lanes:
+            # Lanes tow on the clock of the road, even after a sub-step with no cars
+            lane.time = self.time
+            lane.update(frame, exit_logger, crash_logger)
+
+        if len(self.lanes) > 1:
+            self.change_lanes(frame)
+        self.arrays = {}
+
+        if len(self) == 0:
+            return 2
+
+        self.time += 1
+
+        return 1
+
+    def lane_arrays(self, lane: Highway) -> Dict[str, np.ndarray]:
+        """State of the cars of a lane sorted by position"""
+        cars = lane.cars
+        n = len(cars)
+        x = np.fromiter((car.x for car in cars), dtype=float, count=n)
+        order = np.argsort(x, kind="stable")
+        cars = [cars[i] for i in order]
+        return {
+            "cars": cars,
+            "x": x[order],
+            "length": np.fromiter((car.length for car in cars), dtype=float, count=n),
+            "v": np.fromiter((car.v for car in cars), dtype=float, count=n),
+            "desired": np.fromiter((car.desired_velocity for car in cars), dtype=float, count=n),
+            "crashed": np.fromiter((car.crashed for car in cars), dtype=bool, count=n),
+            "stopping": np.fromiter((car.stopping for car in cars), dtype=bool, count=n),
+            "lane_frame": np.fromiter(
+                (-np.inf if car.lane_frame is None else car.lane_frame for car in cars), dtype=float, count=n
+            ),
+        }
+
+    def candidate_moves(self, state: Dict[str, np.ndarray], target: Dict[str, np.ndarray], frame: int, source: np.ndarray):
+        """Front gap in the target lane of the cars in `source` and whether the move is safe
+
+        Args:
+            state (Dict[str, np.ndarray]): Arrays of the lane of the cars
+            target (Dict[str, np.ndarray]): Arrays of the adjacent lane
+            frame (int): Current sub-step
+            source (np.ndarray): Indexes of the candidate cars
+
+        Returns:
+            Tuple[np.ndarray, np.ndarray]: Front gap in the target lane, safe and worth it
+        """
+        x = state["x"][source]
+        length = state["length"][source]
+        v = state["v"][source]
+
+        n = len(target["x"])
+        if n == 0:
+            return np.full(len(source), np.inf), np.ones(len(source), dtype=bool)
+
+        # Leader: first car strictly ahead, follower: the one before it
+        k = np.searchsorted(target["x"], x, "right")
+        leader = np.minimum(k, n - 1)
+        follower = np.maximum(k - 1, 0)
+        has_leader = k < n
+        has_follower = k > 0
+
+        lead_gap = np.where(has_leader, target["x"][leader] - (x + length), np.inf)
+        follow_gap = np.where(has_follower, x - (target["x"][follower] + target["length"][follower]), np.inf)
+        follow_v = np.where(has_follower, target["v"][follower], 0.0)
+
+        safe = (lead_gap >= self.min_gap + self.safe_time * v) & (
+            follow_gap >= self.min_gap + self.safe_time * follow_v
+        )
+        # A crashed leader close ahead is no way out
+        trap = has_leader & target["crashed"][leader] & (lead_gap < self.anticipation * state["desired"][source])
+        return lead_gap, safe & ~trap
+
+    def change_lanes(self, frame: int) -> int:
+        """Decides and applies the lane changes of a sub-step
+
+        Args:
+            frame (int): Current sub-step
+
+        Returns:
+            int: Lane changes applied
+        """
+        states = [self.lane_arrays(lane) for lane in self.lanes]
+        cooldown = self.cooldown * self.precision
+
+        moves = {t: [] for t in range(len(self.lanes))}
+        for i, state in enumerate(states):
+            n = len(state["x"])
+            if n == 0:
+                continue
+
+            front_gap = np.full(n, np.inf)
+            front_gap[:-1] = state["x"][1:] - (state["x"][:-1] + state["length"][:-1])
+
+            held_back = (
+                ~state["crashed"]
+                & ~state["stopping"]
+                & (state["v"] < state["desired"])
+                & (front_gap < self.anticipation * state["desired"])
+                & (frame - state["lane_frame"] >= cooldown)
+            )
+            source = np.flatnonzero(held_back)
+            if len(source) == 0:
+                continue
+
+            best_gap = np.full(len(source), -np.inf)
+            best_lane = np.full(len(source), -1)
+            for t in (i - 1, i + 1):
+                if t < 0 or t >= len(self.lanes):
+                    continue
+                lead_gap, ok = self.candidate_moves(state, states[t], frame, source)
+                ok &= lead_gap >= front_gap[source] + self.incentive
+                better = ok & (lead_gap > best_gap)
+                best_gap[better] = lead_gap[better]
+                best_lane[better] = t
+
+            for j in np.flatnonzero(best_lane >= 0):
+                c = source[j]
+                moves[int(best_lane[j])].append(
+                    (state["x"][c], state["length"][c], state["v"][c], state["cars"][c])
+                )
+
+        changes = 0
+        for t, entering in moves.items():
+            # Cars entering the same lane keep a safe distance between them
+            entering.sort(key=lambda move: move[0])
+            last_front = -np.inf
+            for x, length, v, car in entering:
+                if x - last_front < self.min_gap + self.safe_time * v:
+                    continue
+                last_front = x + length
+
+                self.lanes[car.lane].detach_car(car)
+                self.lanes[t].attach_car(car)
+                car.lane = t
+                car.lane_frame = frame
+                changes += 1
+
+        self.lane_changes += changes
+        return changes
+
+
+def run(
+    lanes: int,
+    length: float,
+    frames: int,
+    precision: int,
+    seed: int,
+    max_v: float = 100,
+    smart_car_probability: float = 0,
+) -> Dict:
+    """Headless run of a multi-lane highway fed by the gap rule
+
+    Returns:
+        Dict: Cars, lane changes, crashes, exits and cost per car sub-step
+    """
+    np.random.seed(seed)
+    streams = random_streams(seed)
+    population = DriverPopulation(streams["population"], max_v=max_v, smart_car_probability=smart_car_probability)
+    highway = MultiLaneHighway(length, lanes, precision=precision)
+    inflow = Inflow(highway, population, GapArrivals(), streams["entrance"], min_gap=80)
+
+    car_substeps = 0
+    start = time.perf_counter()
+    for frame in range(frames):
+        for sub_t in range(precision):
+            highway.update(frame * precision + sub_t)
+            inflow.step(frame * precision + sub_t)
+            car_substeps += len(highway)
+    elapsed = time.perf_counter() - start
+
+    return {
+        "lanes": lanes,
+        "seconds": elapsed,
+        "mean_cars": car_substeps / (frames * precision),
+        "cars_entered": len(highway.historic_ids),
+        "exits": highway.trip_stats.count,
+        "crashes": highway.historic_crash_count,
+        "lane_changes": highway.lane_changes,
+        "avg_v": highway.get_avg_v() * 3.6,
+        "us_per_car_substep": 1e6 * elapsed / max(car_substeps, 1),
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Multi-lane highway")
+    parser.add_argument("--lanes", type=int, help="Number of lanes", default=4)
+    parser.add_argument("--length", type=float, help="Length of the highway in meters", default=14000)
+    parser.add_argument("--frames", type=int, help="Number of frames to simulate", default=600)
+    parser.add_argument("--precision", type=int, help="Sub-steps per frame", default=10)
+    parser.add_argument("--max_v", type=int, help="Maximum velocity in km/h", default=100)
+    parser.add_argument("--smart_car_probability", type=float, help="Probability of a smart car", default=0)
+    parser.add_argument("--seed", type=int, help="Seed for the random number generator", default=42)
+    parser.add_argument(
+        "--compare", type=bool, help="Also run a single lane and compare the cost per car", default=False
+    )
+
+    args = parser.parse_args()
+
+    configurations = [1, args.lanes] if args.compare and args.lanes > 1 else [args.lanes]
+    for lanes in configurations:
+        result = run(lanes, args.length, args.frames, args.precision, args.seed, args.max_v, args.smart_car_probability)
+        print(
+            f"{result['lanes']} lane(s): {result['seconds']:.1f} s, {result['mean_cars']:.0f} cars on average, "
+            f"{result['cars_entered']} entered, {result['exits']} exits, {result['crashes']} crashes, "
+            f"{result['lane_changes']} lane changes, avg v {result['avg_v']:.1f} km/h, "
+            f"{result['us_per_car_substep']:.2f} us per car sub-step"
+        )
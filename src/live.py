@@ -0,0 +1,261 @@
+"""
+* Pipelined live view of a run
+* The simulation publishes one snapshot per frame (positions, lanes, crash flags and a few
+* statistics as NumPy arrays) into a bounded queue and never waits: when the queue is full
+* the oldest snapshot is dropped. A sender thread takes them out and sends them to the viewer
+* The viewer is a separate process that redraws at its own rate with the newest snapshot,
+* the ones it did not get to draw are skipped as stale
+* The view shows the simulated time, the wall time, the lag between them and the age of the
+* snapshot on screen
+
+* The simulation keeps the main process (it owns the logs, the event bus thread and the
+* telemetry). The viewer is started as `python live.py` and connects back through a local
+* socket (multiprocessing.connection with a random key), so it does not re-run simulation.py
+
+* run: python simulation.py --plot True --live True --frames 1200 --precision 10
+"""
+
+import argparse
+import os
+import queue
+import secrets
+import subprocess
+import sys
+import threading
+import time
+from multiprocessing.connection import Client, Listener
+from typing import Dict, Optional, Tuple
+
+import numpy as np
+
+# Same palette as the car images in assets/, crashed cars in red
+CAR_COLORS = ["#1f4e9e", "#e8c21a", "#222222", "#f2f2f2", "#2e9e44", "#ef7d18", "#c2409b", "#7a3fb8"]
+CRASH_COLOR = "#d62728"
+
+AUTHKEY_VARIABLE = "LIVE_VIEW_AUTHKEY"
+
+
+class LivePublisher:
+    """Simulation side of the live view
+
+    Args:
+        length (float): Length of the highway in meters
+        lanes (int, optional): Number of lanes. Defaults to 1.
+        frames (Optional[int], optional): Frames of the run, for the progress text. Defaults to None.
+        fps (float, optional): Redraws per second of the viewer. Defaults to 30.
+        queue_size (int, optional): Snapshots waiting at most. Defaults to 4.
+        xlim (Optional[Tuple[float, float]], optional): Visible stretch in meters. Defaults to None (all).
+    """
+
+    def __init__(
+        self,
+        length: float,
+        lanes: int = 1,
+        frames: Optional[int] = None,
+        fps: float = 30,
+        queue_size: int = 4,
+        xlim: Optional[Tuple[float, float]] = None,
+    ):
+        authkey = secrets.token_bytes(16)
+        self.listener = Listener(("127.0.0.1", 0), authkey=authkey)
+        host, port = self.listener.address
+
+        command = [sys.executable, os.path.abspath(__file__), host, str(port), "--length", str(length)]
+        command += ["--lanes", str(lanes), "--fps", str(fps)]
+        if frames is not None:
+            command += ["--frames", str(frames)]
+        if xlim is not None:
+            command += ["--xlim", str(xlim[0]), str(xlim[1])]
+        self.process = subprocess.Popen(command, env={**os.environ, AUTHKEY_VARIABLE: authkey.hex()})
+
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.closed = False
+        self.started = time.monotonic()
+        self.published = 0
+        self.dropped = 0
+
+        self.sender = threading.Thread(target=self.send_loop, name="live-view", daemon=True)
+        self.sender.start()
+
+    def send_loop(self):
+        """Sends the queued snapshots, only this thread waits for the viewer"""
+        try:
+            connection = self.listener.accept()
+        except OSError:
+            self.closed = True
+            return
+        with connection:
+            while True:
+                item = self.queue.get()
+                try:
+                    connection.send(item)
+                except (OSError, EOFError):
+                    break
+                if item is None:
+                    break
+        self.closed = True
+
+    def snapshot(self, frame: int, highway) -> Dict:
+        cars = highway.get_cars()
+        n = len(cars)
+        return {
+            "frame": frame,
+            # A frame is one simulated second, the snapshot is taken at its end
+            "sim_time": frame + 1,
+            "wall_time": time.monotonic() - self.started,
+            "published": time.time(),
+            "x": highway.get_cars_positions().astype(np.float32),
+            "lane": np.fromiter((car.lane for car in cars), dtype=np.int8, count=n),
+            "id": np.fromiter((car.id for car in cars), dtype=np.int64, count=n),
+            "crashed": np.fromiter((car.crashed for car in cars), dtype=bool, count=n),
+            "crashes": highway.get_crash_count(),
+            "all_cars": len(highway.historic_ids),
+            "avg_v": highway.get_avg_v() * 3.6,
+            "dropped": self.dropped,
+        }
+
+    def offer(self, item):
+        """Puts an item without waiting, dropping the oldest one when the queue is full"""
+        while True:
+            try:
+                self.queue.put_nowait(item)
+                return
+            except queue.Full:
+                pass
+            try:
+                self.queue.get_nowait()
+                self.dropped += 1
+            except queue.Empty:
+                pass
+
+    def publish(self, frame: int, highway) -> bool:
+        """Called once per frame, returns False once the viewer is gone"""
+        if self.closed or self.process.poll() is not None:
+            return False
+        self.published += 1
+        self.offer(self.snapshot(frame, highway))
+        return True
+
+    def close(self, wait: bool = True):
+        """Tells the viewer the run finished and, with `wait`, waits until its window is closed"""
+        if not self.closed:
+            self.offer(None)
+        if wait:
+            self.process.wait()
+        elif self.process.poll() is None:
+            self.process.terminate()
+        self.listener.close()
+
+
+def view(
+    connection,
+    length: float,
+    lanes: int = 1,
+    frames: Optional[int] = None,
+    fps: float = 30,
+    xlim: Optional[Tuple[float, float]] = None,
+):
+    """Viewer, draws the newest snapshot at its own rate
+
+    A thread receives the snapshots and keeps the newest one, the animation timer only
+    reads it, so a slow draw never holds back the connection.
+
+    Args:
+        connection (Connection): Connection to the LivePublisher
+        length (float): Length of the highway in meters
+        lanes (int, optional): Number of lanes. Defaults to 1.
+        frames (Optional[int], optional): Frames of the run. Defaults to None.
+        fps (float, optional): Redraws per second. Defaults to 30.
+        xlim (Optional[Tuple[float, float]], optional): Visible stretch in meters. Defaults to None.
+    """
+    from matplotlib import animation, pyplot as plt
+
+    state = {"latest": None, "received": 0, "drawn": None, "stale": 0, "finished": False}
+    lock = threading.Lock()
+
+    def receive():
+        while True:
+            try:
+                item = connection.recv()
+            except (OSError, EOFError):
+                item = None
+            with lock:
+                if item is None:
+                    state["finished"] = True
+                    return
+                state["latest"] = item
+                state["received"] += 1
+
+    threading.Thread(target=receive, name="live-receive", daemon=True).start()
+
+    lw = 4
+    road = lanes * lw / 2
+
+    fig, ax = plt.subplots(figsize=(22, 2 + 0.4 * (lanes - 1)))
+    fig.tight_layout()
+    ax.set_xlim(*(xlim or (0, length)))
+    ax.set_ylim(-road - 1, road + 4)
+    ax.set_yticks([])
+
+    ax.plot([2, length], [road, road], color="black", linewidth=2)
+    ax.plot([2, length], [-road, -road], color="black", linewidth=2)
+    ax.fill_between([2, length], [-road, -road], [road, road], color="lightgrey")
+    for y in [0] if lanes == 1 else [-road + lw * k for k in range(1, lanes)]:
+        ax.plot([2, length], [y, y], color="white", linewidth=2, linestyle="dashed", dashes=(5, 5))
+
+    cars = ax.scatter(np.empty(0), np.empty(0), s=40, marker="s", edgecolors="black", linewidths=0.3, zorder=3)
+    status = ax.text(0.005, 0.82, "Waiting for the simulation", transform=ax.transAxes, fontfamily="monospace")
+
+    palette = np.array(CAR_COLORS + [CRASH_COLOR])
+
+    def tick(_):
+        with lock:
+            latest, received, finished = state["latest"], state["received"], state["finished"]
+            state["received"] = 0
+
+        if latest is not None and latest is not state["drawn"]:
+            # Only the newest snapshot is drawn, the rest are already stale
+            state["stale"] += received - 1
+            state["drawn"] = latest
+
+            y = (latest["lane"].astype(float) - (lanes - 1) / 2) * lw
+            cars.set_offsets(np.column_stack([latest["x"], y]) if len(y) else np.empty((0, 2)))
+            color = np.where(latest["crashed"], len(CAR_COLORS), latest["id"] % len(CAR_COLORS))
+            cars.set_facecolors(palette[color])
+
+        snapshot = state["drawn"]
+        if snapshot is not None:
+            progress = f"{snapshot['frame'] + 1}/{frames}" if frames else f"{snapshot['frame'] + 1}"
+            # lag > 0: the simulation runs slower than real time
+            lag = snapshot["wall_time"] - snapshot["sim_time"]
+            status.set_text(
+                f"F:{progress}  sim {snapshot['sim_time']:.0f} s  wall {snapshot['wall_time']:.1f} s  "
+                f"lag {lag:+.1f} s (x{snapshot['sim_time'] / max(snapshot['wall_time'], 1e-9):.2f})  "
+                f"age {time.time() - snapshot['published']:.2f} s  "
+                f"stale {state['stale']}  dropped {snapshot['dropped']}  "
+                f"cars {len(snapshot['x'])}  crashes {snapshot['crashes']}  avg v {snapshot['avg_v']:.1f} km/h"
+                + ("  (finished)" if finished else "")
+            )
+        return cars, status
+
+    # Keep a reference, the animation stops when it is garbage collected
+    ani = animation.FuncAnimation(fig, tick, interval=1000 / fps, blit=False, cache_frame_data=False)
+    plt.show()
+    return ani
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Live view of a simulation, started by LivePublisher")
+    parser.add_argument("host", type=str)
+    parser.add_argument("port", type=int)
+    parser.add_argument("--length", type=float, help="Length of the highway in meters", default=14000)
+    parser.add_argument("--lanes", type=int, help="Number of lanes", default=1)
+    parser.add_argument("--frames", type=int, help="Frames of the run", default=None)
+    parser.add_argument("--fps", type=float, help="Redraws per second", default=30)
+    parser.add_argument("--xlim", type=float, nargs=2, help="Visible stretch in meters", default=None)
+
+    args = parser.parse_args()
+
+    connection = Client((args.host, args.port), authkey=bytes.fromhex(os.environ[AUTHKEY_VARIABLE]))
+    view(connection, args.length, args.lanes, args.frames, args.fps, args.xlim)
+    connection.close()
@@ -0,0 +1,224 @@
+"""
+* Policies that decide which car rows are written to cars_data.csv
+* A policy is written as a spec string, policies joined with + are intersected
+
+* full                      every car on every frame (default)
+* none                      no car rows (recorded runs, see replay.py)
+* every:k                   every car on every k-th frame
+* sample:fraction[:seed]    a random share of the cars, fixed when they enter
+* window:x_min:x_max        cars with a position inside [x_min, x_max]
+* crash:before:after        only the frames around a crash, the last `before`
+                            frames are kept in a ring buffer and written when
+                            a car crashes, then `after` more frames are written
+
+* e.g. every:5+window:3000:6000
+"""
+
+import json
+from collections import deque
+from typing import Callable, Dict, List, Optional
+
+import numpy as np
+
+
+class LogPolicy:
+    name = "full"
+
+    def params(self) -> Dict:
+        return {}
+
+    def describe(self) -> Dict:
+        return {"name": self.name, **self.params()}
+
+    def select(self, frame: int, cars: List) -> List:
+        """Cars to log in this frame"""
+        return cars
+
+    def rows(self, frame: int, cars: List, make_row: Callable) -> List:
+        """Rows to write in this frame
+
+        Args:
+            frame (int): Current frame
+            cars (List): Cars in the highway
+            make_row (Callable): make_row(car, frame) builds the row of a car
+
+        Returns:
+            List: Rows to write
+        """
+        return [make_row(car, frame) for car in self.select(frame, cars)]
+
+
+class NoCars(LogPolicy):
+    name = "none"
+
+    def select(self, frame, cars):
+        return []
+
+
+class EveryKFrames(LogPolicy):
+    name = "every"
+
+    def __init__(self, k: int):
+        if k < 1:
+            raise ValueError("k must be at least 1")
+        self.k = k
+
+    def params(self):
+        return {"k": self.k}
+
+    def select(self, frame, cars):
+        return cars if frame % self.k == 0 else []
+
+
+class CarSample(LogPolicy):
+    """Keeps a random share of the cars
+
+    The draw is made the first frame a car is seen and uses its own random
+    state, so it does not change the simulation random numbers.
+    """
+
+    name = "sample"
+
+    def __init__(self, fraction: float, seed: Optional[int] = None):
+        if not 0 <= fraction <= 1:
+            raise ValueError("fraction must be between 0 and 1")
+        self.fraction = fraction
+        self.seed = seed
+        self.random = np.random.RandomState(seed)
+        self.sampled = {}
+
+    def params(self):
+        return {"fraction": self.fraction, "seed": self.seed}
+
+    def is_sampled(self, car) -> bool:
+        if car.id not in self.sampled:
+            self.sampled[car.id] = self.random.uniform() < self.fraction
+        return self.sampled[car.id]
+
+    def select(self, frame, cars):
+        return [car for car in cars if self.is_sampled(car)]
+
+
+class PositionWindow(LogPolicy):
+    name = "window"
+
+    def __init__(self, x_min: float, x_max: float):
+        if x_max < x_min:
+            raise ValueError("x_max must be greater than x_min")
+        self.x_min = x_min
+        self.x_max = x_max
+
+    def params(self):
+        return {"x_min": self.x_min, "x_max": self.x_max}
+
+    def select(self, frame, cars):
+        return [car for car in cars if self.x_min <= car.x <= self.x_max]
+
+
+class CrashWindow(LogPolicy):
+    """Full resolution only around crashes
+
+    The rows of the last `before` frames are kept in a ring buffer. When a
+    car that was not crashed before shows up crashed, the buffer is written
+    and every row is written for `after` more frames.
+    """
+
+    name = "crash"
+
+    def __init__(self, before: int, after: int):
+        self.before = before
+        self.after = after
+        self.buffer = deque(maxlen=max(before, 1))
+        self.seen_crashes = set()
+        self.record_until = -1
+
+    def params(self):
+        return {"before": self.before, "after": self.after}
+
+    def rows(self, frame, cars, make_row):
+        rows = [make_row(car, frame) for car in cars]
+
+        crashed = {car.id for car in cars if car.crashed}
+        new_crashes = crashed - self.seen_crashes
+        self.seen_crashes |= crashed
+
+        if new_crashes:
+            self.record_until = frame + self.after
+            buffered = [row for frame_rows in self.buffer for row in frame_rows]
+            self.buffer.clear()
+            return buffered + rows
+
+        if frame <= self.record_until:
+            return rows
+
+        if self.before > 0:
+            self.buffer.append(rows)
+        return []
+
+
+class AllOf(LogPolicy):
+    """Intersection of policies, a crash window (if any) is applied last"""
+
+    name = "all"
+
+    def __init__(self, policies: List[LogPolicy]):
+        crash_windows = [p for p in policies if isinstance(p, CrashWindow)]
+        if len(crash_windows) > 1:
+            raise ValueError("Only one crash window can be combined")
+        self.crash_window = crash_windows[0] if crash_windows else None
+        self.filters = [p for p in policies if not isinstance(p, CrashWindow)]
+        self.policies = policies
+
+    def describe(self):
+        return {"name": self.name, "policies": [p.describe() for p in self.policies]}
+
+    def select(self, frame, cars):
+        for policy in self.filters:
+            cars = policy.select(frame, cars)
+        return cars
+
+    def rows(self, frame, cars, make_row):
+        cars = self.select(frame, cars)
+        if self.crash_window is not None:
+            return self.crash_window.rows(frame, cars, make_row)
+        return [make_row(car, frame) for car in cars]
+
+
+def parse_policy(spec: str, seed: Optional[int] = None) -> LogPolicy:
+    """Builds a policy from its spec string
+
+    Args:
+        spec (str): Policy spec, e.g. "every:10+sample:0.1"
+        seed (Optional[int], optional): Default seed of the car sample. Defaults to None.
+
+    Returns:
+        LogPolicy: Policy
+    """
+    policies = []
+    for part in spec.split("+"):
+        name, *values = part.strip().split(":")
+        if name == "full":
+            policies.append(LogPolicy())
+        elif name == "none":
+            policies.append(NoCars())
+        elif name == "every":
+            policies.append(EveryKFrames(int(values[0])))
+        elif name == "sample":
+            policies.append(
+                CarSample(float(values[0]), int(values[1]) if len(values) > 1 else seed)
+            )
+        elif name == "window":
+            policies.append(PositionWindow(float(values[0]), float(values[1])))
+        elif name == "crash":
+            policies.append(CrashWindow(int(values[0]), int(values[1])))
+        else:
+            raise ValueError(f"Unknown log policy: {name}")
+
+    if len(policies) == 1:
+        return policies[0]
+    return AllOf(policies)
+
+
+def save_policy(policy: LogPolicy, spec: str, path: str):
+    with open(path, "w") as f:
+        json.dump({"spec": spec, "policy": policy.describe()}, f, indent=4)
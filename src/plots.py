@@ -0,0 +1,346 @@
+"""
+* Standard plots of observations.ipynb for a set of runs
+* Every (run, plot) pair is a task for a pool of worker processes
+* A worker keeps the last runs it loaded, so each dataset is read once per worker
+
+* Plots are saved to <out>/<name>/<plot>.png with the notebook file names
+* run: python plots.py logs/2023-09-10_20-58-50 logs/2023-09-11_00-58-16 --names default 20 --workers 4
+"""
+
+import argparse
+import os
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, List, Optional
+
+import matplotlib
+
+matplotlib.use("Agg")
+
+import numpy as np
+import pandas as pd
+from matplotlib import pyplot as plt
+
+from density import density_from_frame
+from runlog import load_run
+
+# Runs kept in memory by each worker
+WORKER_CACHE_SIZE = 2
+
+_runs = OrderedDict()
+
+
+def load(log_dir: str) -> Dict[str, pd.DataFrame]:
+    """Loads a run, once per worker"""
+    if log_dir in _runs:
+        _runs.move_to_end(log_dir)
+        return _runs[log_dir]
+
+    agp_df, cars_df, exits_df, crashes_df = load_run(log_dir)
+    run = {"agp": agp_df, "cars": cars_df, "exits": exits_df, "crashes": crashes_df}
+    run["precision"] = run_precision(exits_df)
+
+    _runs[log_dir] = run
+    while len(_runs) > WORKER_CACHE_SIZE:
+        _runs.popitem(last=False)
+    return run
+
+
+def run_precision(exits_df: pd.DataFrame, default: int = 100) -> int:
+    """Sub-steps per frame, from the exits (frame and init_frame are sub-step indexes)"""
+    exits = exits_df.dropna(subset=["init_frame"])
+    exits = exits[exits["t_d"] > 0]
+    if len(exits) == 0:
+        return default
+    return max(1, int(round(np.median((exits["frame"] - exits["init_frame"]) / exits["t_d"]))))
+
+
+# Helpers
+
+
+def regression(ax, x, y, color: str, label: str):
+    """Least squares line, like sns.regplot(scatter=False)"""
+    x, y = np.asarray(x, dtype=float), np.asarray(y, dtype=float)
+    if len(x) < 2:
+        return
+    slope, intercept = np.polyfit(x, y, 1)
+    xs = np.array([x.min(), x.max()])
+    ax.plot(xs, slope * xs + intercept, color=color, label=label, linewidth=3, linestyle="--")
+
+
+def histogram(ax, values, bins: int, color: Optional[str] = None):
+    """Density histogram with a Gaussian KDE, like sns.histplot(kde=True, stat="density")"""
+    values = np.asarray(values, dtype=float)
+    values = values[np.isfinite(values)]
+    if len(values) == 0:
+        return
+    _, _, patches = ax.hist(values, bins=bins, density=True, alpha=0.5, color=color, edgecolor="white")
+
+    std = values.std()
+    if len(values) < 2 or std == 0:
+        return
+    # Scott's rule, evaluated on a sample to bound the cost
+    sample = values if len(values) <= 20000 else np.random.default_rng(0).choice(values, 20000)
+    bandwidth = 1.06 * std * len(values) ** (-1 / 5)
+    xs = np.linspace(values.min(), values.max(), 200)
+    density = np.exp(-0.5 * ((xs[:, None] - sample[None, :]) / bandwidth) ** 2).mean(axis=1)
+    density /= bandwidth * np.sqrt(2 * np.pi)
+    ax.plot(xs, density, color=patches[0].get_facecolor()[:3], linewidth=2)
+
+
+def reference_frame(agp_df: pd.DataFrame, cut_frame: int) -> int:
+    frames = agp_df["frame"].to_numpy()
+    if cut_frame in frames:
+        return cut_frame
+    return int(frames[np.argmin(np.abs(frames - frames.mean()))])
+
+
+def exit_seconds(run: Dict) -> pd.Series:
+    return run["exits"]["frame"] / run["precision"]
+
+
+# Plots, each one draws on a new figure
+
+
+def car_count(run: Dict, ax, cut_frame: int):
+    agp_df = run["agp"]
+    after = agp_df[agp_df["frame"] > cut_frame]
+    ax.plot(agp_df["frame"], agp_df["current_car_count"], label="AGP Car Count", linewidth=2)
+    regression(ax, after["frame"], after["current_car_count"], "C1", "Regression Line")
+    ax.axhline(100, color="r", linestyle="--", label="100 Autos", linewidth=2)
+    ax.axvline(cut_frame, color="g", linestyle="--", label=f"Frame {cut_frame}", linewidth=2)
+    ax.set_xlabel("Frame")
+    ax.set_ylabel("Car count")
+    ax.set_title("Car count over time")
+    ax.legend()
+
+
+def car_count_distribution(run: Dict, ax, cut_frame: int):
+    agp_df = run["agp"]
+    histogram(ax, agp_df[agp_df["frame"] > cut_frame]["current_car_count"], bins=20)
+    ax.set_xlabel("Car count")
+    ax.set_ylabel("Frequency")
+    ax.set_title(f"Car count distribution | Frames > {cut_frame}")
+
+
+def car_speed_over_time(run: Dict, ax, cut_frame: int):
+    speeds = run["cars"].groupby("frame")["car_v"].agg(["mean", "max", "min"]) * 3.6
+    after = speeds[speeds.index > cut_frame]
+    ax.axhline(100, color="r", linestyle="--", label="Speed Limit (100 km/h)", linewidth=2)
+    for column, color, line_color in (
+        ("mean", "b", "teal"),
+        ("max", "orange", "yellow"),
+        ("min", "purple", "pink"),
+    ):
+        name = column.capitalize()
+        ax.plot(speeds.index, speeds[column], label=f"{name} car speed", linewidth=2, color=color)
+        regression(ax, after.index, after[column], line_color, f"{name} car speed regresion line")
+    ax.axvline(cut_frame, color="g", linestyle="--", label=f"Frame {cut_frame}", linewidth=2)
+    ax.set_xlabel("Frame", fontsize=15)
+    ax.set_ylabel("Speed (km/h)", fontsize=15)
+    ax.set_title("Car speed over time", fontsize=16)
+    ax.legend()
+
+
+def frame_distribution(run: Dict, ax, cut_frame: int, column: str, scale: float, label: str):
+    frame = reference_frame(run["agp"], cut_frame)
+    count = int(run["agp"].loc[run["agp"]["frame"] == frame, "current_car_count"].iloc[0])
+    cars_df = run["cars"]
+    histogram(ax, cars_df[cars_df["frame"] == frame][column] * scale, bins=30, color="red")
+    ax.set_xlabel(label, fontsize=15)
+    ax.set_ylabel("Count", fontsize=15)
+    ax.set_title(f"Car {label.split(' ')[0].lower()} distribution in frame {frame} | Car count: {count}", fontsize=16)
+
+
+def averaged_distribution(run: Dict, ax, cut_frame: int, column: str, scale: float, label: str):
+    cars_df = run["cars"]
+    histogram(ax, cars_df[cars_df["frame"] > cut_frame][column] * scale, bins=30)
+    ax.set_xlabel(label, fontsize=15)
+    ax.set_ylabel("Frequency (%)", fontsize=15)
+    ax.set_title(f"Car {label.split(' ')[0].lower()} distribution averaged over time", fontsize=16)
+
+
+def car_speed_distribution(run: Dict, ax, cut_frame: int):
+    frame_distribution(run, ax, cut_frame, "car_v", 3.6, "Speed (km/h)")
+
+
+def car_speed_distribution_averaged(run: Dict, ax, cut_frame: int):
+    averaged_distribution(run, ax, cut_frame, "car_v", 3.6, "Speed (km/h)")
+
+
+def car_acceleration_distribution(run: Dict, ax, cut_frame: int):
+    frame_distribution(run, ax, cut_frame, "car_a", 1, "Acceleration (m/s²)")
+
+
+def car_acceleration_distribution_averaged(run: Dict, ax, cut_frame: int):
+    averaged_distribution(run, ax, -1, "car_a", 1, "Acceleration (m/s²)")
+
+
+def trajectories(run: Dict, ax, mode: str):
+    # Density image of all the (time, position) samples, one line per car is too slow
+    density_from_frame(run["cars"], mode).draw(ax, "count")
+    ax.set_ylabel("Distance (m)", fontsize=15)
+    ax.set_title("Car trajectories", fontsize=16)
+
+
+def car_trajectories_relative(run: Dict, ax, cut_frame: int):
+    trajectories(run, ax, "relative")
+    ax.set_xlabel("Time (s)", fontsize=15)
+
+
+def car_trajectories_absolute(run: Dict, ax, cut_frame: int):
+    trajectories(run, ax, "absolute")
+    ax.set_xlabel("Frame (s)", fontsize=15)
+
+
+def car_exit_time_avg_over_car_count(run: Dict, ax, cut_frame: int):
+    exits_df = run["exits"]
+    agp_counts = run["agp"].set_index("frame")["current_car_count"]
+    exit_frame = exit_seconds(run)
+    after = exits_df[exit_frame > cut_frame]
+    # Car count when the car entered
+    entry = (exit_frame[after.index] - after["t_d"]).round()
+    counts = agp_counts.reindex(entry.to_numpy()).to_numpy()
+    known = ~np.isnan(counts)
+    means = pd.Series(after["t_d"].to_numpy()[known]).groupby(counts[known]).mean()
+    ax.bar(means.index, means.to_numpy(), color="blue", alpha=0.3)
+    regression(ax, means.index, means.to_numpy(), "teal", "Mean car time regresion line")
+    ax.set_xlabel("Car count", fontsize=15)
+    ax.set_ylabel("Time (s)", fontsize=15)
+    ax.set_title("Car exit time avg. over initial car count", fontsize=16)
+
+
+def exit_time_distribution(run: Dict, ax, cut_frame: int):
+    histogram(ax, run["exits"][exit_seconds(run) > cut_frame]["t_d"], bins=40)
+    ax.set_xlabel("Exit time (s)", fontsize=15)
+    ax.set_ylabel("Frequency (%)", fontsize=15)
+    ax.set_title("Exit time distribution", fontsize=16)
+
+
+def exit_time_distribution_sampled_20(run: Dict, ax, cut_frame: int):
+    histogram(ax, run["exits"][exit_seconds(run) > cut_frame]["t_d"].to_numpy()[::50], bins=20)
+    ax.set_xlabel("Exit time (s)", fontsize=15)
+    ax.set_ylabel("Frequency (%)", fontsize=15)
+    ax.set_title("Exit time distribution | Sampled every 20", fontsize=16)
+
+
+# Name: (function, figure size)
+PLOTS = {
+    "car_count": (car_count, (15, 5)),
+    "car_count_distribution": (car_count_distribution, (15, 5)),
+    "car_speed_over_time": (car_speed_over_time, (15, 5)),
+    "car_speed_distribution": (car_speed_distribution, (10, 5)),
+    "car_speed_distribution_averaged": (car_speed_distribution_averaged, (10, 5)),
+    "car_acceleration_distribution": (car_acceleration_distribution, (10, 5)),
+    "car_acceleration_distribution_averaged": (car_acceleration_distribution_averaged, (10, 5)),
+    "car_trajectories_relative": (car_trajectories_relative, (20, 10)),
+    "car_trajectories_absolute": (car_trajectories_absolute, (20, 10)),
+    "car_exit_time_avg_over_car_count": (car_exit_time_avg_over_car_count, (15, 5)),
+    "exit_time_distribution": (exit_time_distribution, (10, 5)),
+    "exit_time_distribution_sampled_20": (exit_time_distribution_sampled_20, (10, 5)),
+}
+
+
+def render(log_dir: str, plot: str, out_dir: str, cut_frame: int = 1000, dpi: int = 300) -> str:
+    """Draws one plot of a run
+
+    Args:
+        log_dir (str): Run directory
+        plot (str): Plot name, see PLOTS
+        out_dir (str): Directory of the run plots
+        cut_frame (int, optional): Warm-up frames left out of the distributions. Defaults to 1000.
+        dpi (int, optional): Resolution. Defaults to 300.
+
+    Returns:
+        str: Path of the image
+    """
+    draw, figsize = PLOTS[plot]
+    run = load(log_dir)
+
+    fig, ax = plt.subplots(figsize=figsize)
+    draw(run, ax, cut_frame)
+    fig.tight_layout()
+    # Transparent background
+    fig.patch.set_alpha(0)
+
+    path = os.path.join(out_dir, f"{plot}.png")
+    fig.savefig(path, dpi=dpi, transparent=True)
+    plt.close(fig)
+    return path
+
+
+def render_all(
+    runs: Dict[str, str],
+    out: str = "plots",
+    plots: Optional[List[str]] = None,
+    workers: int = 1,
+    cut_frame: int = 1000,
+    dpi: int = 300,
+) -> List[str]:
+    """Draws the plots of several runs in parallel
+
+    Args:
+        runs (Dict[str, str]): Name of each run and its directory
+        out (str, optional): Plots directory, one folder per run. Defaults to "plots".
+        plots (Optional[List[str]], optional): Plots to draw. Defaults to None (all of PLOTS).
+        workers (int, optional): Worker processes. Defaults to 1.
+        cut_frame (int, optional): Warm-up frames left out of the distributions. Defaults to 1000.
+        dpi (int, optional): Resolution. Defaults to 300.
+
+    Returns:
+        List[str]: Paths of the images
+    """
+    plots = list(PLOTS) if plots is None else plots
+    unknown = [plot for plot in plots if plot not in PLOTS]
+    if unknown:
+        raise ValueError(f"Unknown plots: {', '.join(unknown)}")
+
+    # Tasks in run order, so the workers mostly reuse the run they have loaded
+    tasks = []
+    for name, log_dir in runs.items():
+        out_dir = os.path.join(out, name)
+        os.makedirs(out_dir, exist_ok=True)
+        tasks += [(log_dir, plot, out_dir) for plot in plots]
+
+    if workers <= 1:
+        return [render(log_dir, plot, out_dir, cut_frame, dpi) for log_dir, plot, out_dir in tasks]
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = [
+            executor.submit(render, log_dir, plot, out_dir, cut_frame, dpi)
+            for log_dir, plot, out_dir in tasks
+        ]
+        return [future.result() for future in futures]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Draw the standard plots of several runs")
+    parser.add_argument("runs", type=str, nargs="+", help="Run directories or timestamps in logs/")
+    parser.add_argument("--names", type=str, nargs="+", help="Folder name of each run", default=None)
+    parser.add_argument("--out", type=str, help="Plots directory", default="plots")
+    parser.add_argument(
+        "--plots", type=str, help="Comma separated plots to draw. Defaults to all", default=None
+    )
+    parser.add_argument("--workers", type=int, help="Worker processes", default=os.cpu_count())
+    parser.add_argument(
+        "--cut_frame", type=int, help="Warm-up frames left out of the distributions", default=1000
+    )
+    parser.add_argument("--dpi", type=int, help="Resolution of the images", default=300)
+
+    args = parser.parse_args()
+
+    if args.names is not None and len(args.names) != len(args.runs):
+        parser.error("--names needs one name per run")
+
+    log_dirs = [run if os.path.isdir(run) else os.path.join("logs", run) for run in args.runs]
+    names = args.names or [os.path.basename(os.path.normpath(log_dir)) for log_dir in log_dirs]
+
+    paths = render_all(
+        dict(zip(names, log_dirs)),
+        out=args.out,
+        plots=args.plots.split(",") if args.plots else None,
+        workers=args.workers,
+        cut_frame=args.cut_frame,
+        dpi=args.dpi,
+    )
+    print(f"{len(paths)} plots saved to {args.out}/")
@@ -0,0 +1,328 @@
+"""
+* Log-light recording and deterministic replay of a run
+* A recorded run (simulation.py --record True) writes no car rows. It keeps the seed and the
+* configuration (record.json), the spawn, exit and crash events, the agp rows and a checkpoint
+* every `checkpoint_interval` frames: the highway with its cars, the inflow with its random
+* streams and the position of the global random generators, pickled and compressed
+* Given that state the run is deterministic, so cars_data of any frame range (and set of cars)
+* is rebuilt by loading the last checkpoint at or before the start and running the sub-steps
+* from there, at most checkpoint_interval - 1 frames are simulated before the first row
+* The replayed spawns, exits, crashes and agp rows are checked against the recorded ones
+
+* run: python simulation.py --record True --checkpoint_interval 100 --frames 3000 --log_dir logs/rec
+* run: python replay.py logs/rec --frames 1200 1300 --cars 5 9 --output logs/rec/cars_replay
+"""
+
+import argparse
+import glob
+import json
+import os
+import pickle
+import random
+import time
+import zlib
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+
+from events import event_kind
+from runlog import CARS_SCHEMA, ColumnarWriter, read_table, resolve_format, table_format
+
+RECORD_FILE = "record.json"
+CHECKPOINTS_DIR = "checkpoints"
+
+
+def checkpoint_path(log_dir: str, frame: int) -> str:
+    return os.path.join(log_dir, CHECKPOINTS_DIR, f"frame_{frame:08d}.pkl.z")
+
+
+class Recorder:
+    """Writes the record and the checkpoints of a run
+
+    Args:
+        log_dir (str): Run directory
+        precision (int): Sub-steps per frame
+        interval (int, optional): Frames between checkpoints. Defaults to 100.
+        config (Optional[Dict], optional): Arguments of the run. Defaults to None.
+    """
+
+    def __init__(self, log_dir: str, precision: int, interval: int = 100, config: Optional[Dict] = None):
+        if interval < 1:
+            raise ValueError("The checkpoint interval must be at least 1 frame")
+        self.log_dir = log_dir
+        self.precision = precision
+        self.interval = interval
+        self.config = config or {}
+        self.frames = []
+        self.frame = None
+        self.last_frame = None
+        self.size = 0
+        os.makedirs(os.path.join(log_dir, CHECKPOINTS_DIR), exist_ok=True)
+        self.save()
+
+    def save(self):
+        record = {
+            "seed": self.config.get("seed"),
+            "precision": self.precision,
+            "checkpoint_interval": self.interval,
+            "checkpoints": self.frames,
+            "last_frame": self.last_frame,
+            "config": self.config,
+        }
+        with open(os.path.join(self.log_dir, RECORD_FILE), "w") as f:
+            json.dump(record, f, indent=4)
+
+    def checkpoint(self, frame: int, highway, inflow):
+        """Called at the start of every frame, before its sub-steps"""
+        self.frame = frame
+        if frame % self.interval != 0:
+            return
+        state = {
+            "frame": frame,
+            "highway": highway,
+            "inflow": inflow,
+            "numpy": np.random.get_state(),
+            "random": random.getstate(),
+        }
+        data = zlib.compress(pickle.dumps(state, protocol=pickle.HIGHEST_PROTOCOL), 6)
+        with open(checkpoint_path(self.log_dir, frame), "wb") as f:
+            f.write(data)
+        self.size += len(data)
+        self.frames.append(frame)
+        # Kept up to date, an interrupted run can be replayed up to its last checkpoint
+        self.save()
+
+    def close(self):
+        """Saves the last frame simulated"""
+        self.last_frame = self.frame
+        self.save()
+
+
+def load_record(log_dir: str) -> Dict:
+    path = os.path.join(log_dir, RECORD_FILE)
+    if not os.path.exists(path):
+        raise FileNotFoundError(f"{log_dir} is not a recorded run (no {RECORD_FILE})")
+    with open(path) as f:
+        record = json.load(f)
+    # The checkpoints on disk, in case the record was written before the last one
+    on_disk = sorted(
+        int(os.path.basename(name)[len("frame_") : -len(".pkl.z")])
+        for name in glob.glob(os.path.join(log_dir, CHECKPOINTS_DIR, "frame_*.pkl.z"))
+    )
+    record["checkpoints"] = on_disk
+    return record
+
+
+def restore(log_dir: str, frame: int) -> Tuple[int, object, object]:
+    """Loads the last checkpoint at or before a frame and sets the global random generators
+
+    Args:
+        log_dir (str): Run directory
+        frame (int): Frame to start from
+
+    Returns:
+        Tuple[int, object, object]: Frame of the checkpoint, highway and inflow
+    """
+    frames = [f for f in load_record(log_dir)["checkpoints"] if f <= frame]
+    if not frames:
+        raise ValueError(f"No checkpoint at or before frame {frame} in {log_dir}")
+    with open(checkpoint_path(log_dir, frames[-1]), "rb") as f:
+        state = pickle.loads(zlib.decompress(f.read()))
+    np.random.set_state(state["numpy"])
+    random.setstate(state["random"])
+    return state["frame"], state["highway"], state["inflow"]
+
+
+class EventLog:
+    """Stands in for the event bus during a replay, keeps the events in a list"""
+
+    def __init__(self):
+        self.events = []
+        # Cars already on the highway at the checkpoint, their spawns are not replayed
+        self.initial_ids = set()
+
+    def emit(self, event):
+        self.events.append(event)
+
+
+def replay_frames(log_dir: str, start: int, end: int, events: Optional[EventLog] = None) -> Iterator[Tuple[int, object]]:
+    """Runs a recorded run again from the checkpoint before `start`
+
+    Args:
+        log_dir (str): Run directory
+        start (int): First frame to yield
+        end (int): Last frame to yield
+        events (Optional[EventLog], optional): Gets the events of the replay. Defaults to None.
+
+    Yields:
+        Tuple[int, object]: Frame and highway at the end of the frame, from start to end
+    """
+    precision = load_record(log_dir)["precision"]
+    frame, highway, inflow = restore(log_dir, start)
+    highway.set_event_bus(events)
+    if events is not None:
+        events.initial_ids = {car.id for car in highway.get_cars()}
+
+    # Same sub-steps as simulation.py
+    for frame in range(frame, end + 1):
+        for sub_t in range(precision):
+            highway.update(frame * precision + sub_t)
+            inflow.step(frame * precision + sub_t)
+        if frame >= start:
+            yield frame, highway
+
+
+def car_row(car, frame: int, precision: int) -> List:
+    """Row of cars_data, like simulation.py"""
+    return [
+        frame,
+        car.id,
+        car.x,
+        car.v,
+        car.a,
+        car.time_ellapsed / precision,
+        car.f_car.id if car.f_car is not None else -1,
+        car.b_car.id if car.b_car is not None else -1,
+    ]
+
+
+def agp_row(highway, frame: int) -> List:
+    """Row of agp_data, like simulation.py"""
+    return [
+        frame,
+        len(highway.get_cars()),
+        len(highway.historic_ids),
+        highway.get_crash_count(),
+        highway.historic_crash_count,
+        highway.get_avg_v(),
+        highway.get_avg_a(),
+        highway.get_avg_trip_duration(),
+    ]
+
+
+def recorded_events(log_dir: str, table: str) -> Optional[pd.DataFrame]:
+    return read_table(log_dir, table) if table_format(log_dir, table) is not None else None
+
+
+def compare_events(recorded: Optional[pd.DataFrame], replayed: List, first: int, last: int) -> Optional[Dict]:
+    """Compares the (frame, car) pairs of one kind of event between two sub-steps"""
+    if recorded is None:
+        return None
+    in_range = recorded[(recorded["frame"] >= first) & (recorded["frame"] <= last)]
+    expected = sorted(zip(in_range["frame"].astype(int), in_range["car_id"].astype(int)))
+    got = sorted((int(event.frame), int(event.car_id)) for event in replayed if first <= event.frame <= last)
+    return {"recorded": len(expected), "replayed": len(got), "ok": expected == got}
+
+
+def replay(
+    log_dir: str,
+    start: int,
+    end: int,
+    cars: Optional[Iterable[int]] = None,
+    verify: bool = True,
+) -> Tuple[pd.DataFrame, Dict]:
+    """Rebuilds the cars_data rows of a recorded run
+
+    Args:
+        log_dir (str): Run directory
+        start (int): First frame
+        end (int): Last frame
+        cars (Optional[Iterable[int]], optional): Car ids to keep. Defaults to None (all).
+        verify (bool, optional): Check the replay against the recorded events and agp rows. Defaults to True.
+
+    Returns:
+        Tuple[pd.DataFrame, Dict]: cars_data rows and the checks
+    """
+    record = load_record(log_dir)
+    precision = record["precision"]
+    if record["last_frame"] is not None:
+        end = min(end, record["last_frame"])
+    if start < 0 or end < start:
+        raise ValueError(f"Empty frame range {start}..{end}")
+    cars = set(cars) if cars is not None else None
+
+    events = EventLog()
+    rows, agp_rows = [], []
+    started = time.perf_counter()
+    for frame, highway in replay_frames(log_dir, start, end, events):
+        for car in highway.get_cars():
+            if cars is None or car.id in cars:
+                rows.append(car_row(car, frame, precision))
+        agp_rows.append(agp_row(highway, frame))
+
+    df = pd.DataFrame(rows, columns=list(CARS_SCHEMA))
+    checks = {
+        "start": start,
+        "end": end,
+        "checkpoint": max(f for f in record["checkpoints"] if f <= start),
+        "rows": len(df),
+        "seconds": time.perf_counter() - started,
+    }
+    if not verify:
+        return df, checks
+
+    # Events carry the sub-step, the frames start..end are these sub-steps
+    first, last = start * precision, (end + 1) * precision - 1
+    for kind, table in [("spawn", "spawns_data"), ("exit", "exits_data"), ("crash", "crashes_data")]:
+        replayed = [event for event in events.events if event_kind(event) == kind]
+        recorded = recorded_events(log_dir, table)
+        if kind == "spawn" and recorded is not None:
+            recorded = recorded[~recorded["car_id"].isin(events.initial_ids)]
+        checks[kind] = compare_events(recorded, replayed, first, last)
+
+    agp = recorded_events(log_dir, "agp_data")
+    if agp is not None:
+        expected = agp[(agp["frame"] >= start) & (agp["frame"] <= end)].to_numpy(dtype=float)
+        got = np.array(agp_rows, dtype=float)
+        checks["agp"] = {
+            "recorded": len(expected),
+            "replayed": len(got),
+            "ok": expected.shape == got.shape and bool(np.allclose(expected, got, rtol=1e-9, atol=0, equal_nan=True)),
+        }
+    checks["ok"] = all(check["ok"] for check in checks.values() if isinstance(check, dict))
+    return df, checks
+
+
+def save_rows(df: pd.DataFrame, path: str, format: str = "csv"):
+    """Writes the rows like the cars_data of simulation.py"""
+    format = resolve_format(format)
+    if format == "csv":
+        df.to_csv(f"{path}.csv")
+        return
+    writer = ColumnarWriter(path, CARS_SCHEMA, format)
+    writer.write_frame(df)
+    writer.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Rebuild cars_data of a recorded run")
+    parser.add_argument("log_dir", type=str, help="Run recorded with simulation.py --record True")
+    parser.add_argument("--frames", type=int, nargs=2, help="First and last frame. Defaults to the whole run", default=None)
+    parser.add_argument("--cars", type=int, nargs="+", help="Car ids to keep. Defaults to every car", default=None)
+    parser.add_argument("--output", type=str, help="Table path without extension. Defaults to <log_dir>/cars_replay", default=None)
+    parser.add_argument("--format", type=str, help="csv, npz, parquet or auto", default="csv")
+    parser.add_argument("--verify", type=bool, help="Check the replay against the recorded events", default=True)
+
+    args = parser.parse_args()
+
+    record = load_record(args.log_dir)
+    if args.frames is not None:
+        start, end = args.frames
+    else:
+        start, end = 0, record["last_frame"] if record["last_frame"] is not None else record["checkpoints"][-1]
+
+    df, checks = replay(args.log_dir, start, end, args.cars, verify=args.verify)
+    output = args.output if args.output is not None else os.path.join(args.log_dir, "cars_replay")
+    save_rows(df, output, args.format)
+
+    print(
+        f"Frames {checks['start']}..{checks['end']} from the checkpoint of frame {checks['checkpoint']}: "
+        f"{checks['rows']} rows in {checks['seconds']:.2f} s -> {output}"
+    )
+    for kind in ["spawn", "exit", "crash", "agp"]:
+        check = checks.get(kind)
+        if check is not None:
+            print(f"{kind:>6}: recorded {check['recorded']:>6}  replayed {check['replayed']:>6}  {'ok' if check['ok'] else 'MISMATCH'}")
+    if args.verify and not checks["ok"]:
+        raise SystemExit(1)
@@ -0,0 +1,191 @@
+"""
+* Content-addressed store of simulation results
+* A run is keyed by the hash of its full configuration and of the simulation source code
+* Each entry holds the summary metrics and where its raw logs are
+* Raw logs are evicted least recently used first when they go over a size limit, metrics are kept
+"""
+
+import ast
+import hashlib
+import json
+import os
+import shutil
+import time
+from typing import Dict, List, Optional
+
+import numpy as np
+
+from runlog import load_run
+
+SOURCE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+def module_sources(entry: str) -> List[str]:
+    """Source files of src that a module imports, directly or through other modules of src
+
+    Args:
+        entry (str): File name of the module, e.g. "simulation.py"
+
+    Returns:
+        List[str]: File names, sorted, the entry included
+    """
+    found = set()
+    stack = [entry]
+    while stack:
+        source = stack.pop()
+        path = os.path.join(SOURCE_DIR, source)
+        if source in found or not os.path.exists(path):
+            continue
+        found.add(source)
+        with open(path) as f:
+            tree = ast.parse(f.read())
+        # Imports inside functions count too, simulation.py imports some modules lazily
+        for node in ast.walk(tree):
+            if isinstance(node, ast.Import):
+                names = [alias.name for alias in node.names]
+            elif isinstance(node, ast.ImportFrom) and node.level == 0 and node.module:
+                names = [node.module]
+            else:
+                continue
+            stack += [f"{name.split('.')[0]}.py" for name in names]
+    return sorted(found)
+
+
+# Source files whose changes invalidate cached results
+SIMULATION_SOURCES = module_sources("simulation.py")
+
+
+def code_version(sources=SIMULATION_SOURCES) -> str:
+    digest = hashlib.sha256()
+    for source in sources:
+        path = os.path.join(SOURCE_DIR, source)
+        if os.path.exists(path):
+            digest.update(source.encode())
+            with open(path, "rb") as f:
+                digest.update(f.read())
+    return digest.hexdigest()[:16]
+
+
+def config_key(config: Dict, version: Optional[str] = None) -> str:
+    """Hash of a run configuration
+
+    Args:
+        config (Dict): Simulation arguments
+        version (Optional[str], optional): Code version. Defaults to the current one.
+
+    Returns:
+        str: Hex digest
+    """
+    payload = {
+        "config": config,
+        "code_version": version if version is not None else code_version(),
+    }
+    encoded = json.dumps(payload, sort_keys=True, default=str).encode()
+    return hashlib.sha256(encoded).hexdigest()
+
+
+def directory_size(path: str) -> int:
+    size = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            size += os.path.getsize(os.path.join(root, name))
+    return size
+
+
+def summarize_logs(log_dir: str) -> Dict:
+    """Summary metrics of a run from its log directory"""
+    agp_df, exits_df, crashes_df = load_run(
+        log_dir, tables=["agp_data", "exits_data", "crashes_data"]
+    )
+
+    last = agp_df.iloc[-1] if len(agp_df) > 0 else None
+
+    return {
+        "frames": int(len(agp_df)),
+        "avg_car_count": float(agp_df["current_car_count"].mean()) if last is not None else 0.0,
+        "historic_car_count": int(last["historic_car_count"]) if last is not None else 0,
+        "avg_v": float(last["avg_v"] * 3.6) if last is not None else 0.0,
+        "avg_a": float(last["avg_a"]) if last is not None else 0.0,
+        "exits": int(len(exits_df)),
+        "avg_exit_time": float(exits_df["t_d"].mean()) if len(exits_df) > 0 else float(np.nan),
+        "crashes": int(len(crashes_df)),
+    }
+
+
+class ResultCache:
+    """Result store kept in <root>/index.json with the raw logs in <root>/logs/<key>
+
+    Args:
+        root (str, optional): Cache directory. Defaults to "cache".
+        max_log_bytes (Optional[int], optional): Size limit of the raw logs. Defaults to None (no limit).
+    """
+
+    def __init__(self, root: str = "cache", max_log_bytes: Optional[int] = None):
+        self.root = root
+        self.max_log_bytes = max_log_bytes
+        self.index_file = os.path.join(root, "index.json")
+
+        os.makedirs(os.path.join(root, "logs"), exist_ok=True)
+
+        self.entries = {}
+        if os.path.exists(self.index_file):
+            with open(self.index_file) as f:
+                self.entries = json.load(f)
+
+    def __contains__(self, key: str) -> bool:
+        return key in self.entries
+
+    def __len__(self):
+        return len(self.entries)
+
+    def log_dir(self, key: str) -> str:
+        return os.path.join(self.root, "logs", key)
+
+    def get(self, key: str) -> Optional[Dict]:
+        """Entry of a key, its use is recorded in memory until the next save"""
+        entry = self.entries.get(key)
+        if entry is not None:
+            entry["last_used"] = time.time()
+        return entry
+
+    def put(self, key: str, config: Dict, metrics: Dict, log_dir: Optional[str] = None):
+        log_bytes = directory_size(log_dir) if log_dir is not None else 0
+        self.entries[key] = {
+            "config": config,
+            "metrics": metrics,
+            "log_dir": log_dir,
+            "log_bytes": log_bytes,
+            "created": time.time(),
+            "last_used": time.time(),
+        }
+        self.evict()
+        self.save()
+
+    def log_bytes(self) -> int:
+        return sum(
+            entry["log_bytes"] for entry in self.entries.values() if entry["log_dir"]
+        )
+
+    def evict(self):
+        """Deletes raw logs, least recently used first, until they fit the limit"""
+        if self.max_log_bytes is None:
+            return
+
+        total = self.log_bytes()
+        with_logs = sorted(
+            (entry for entry in self.entries.values() if entry["log_dir"]),
+            key=lambda entry: entry["last_used"],
+        )
+        for entry in with_logs:
+            if total <= self.max_log_bytes:
+                break
+            shutil.rmtree(entry["log_dir"], ignore_errors=True)
+            total -= entry["log_bytes"]
+            entry["log_dir"] = None
+            entry["log_bytes"] = 0
+
+    def save(self):
+        tmp_file = self.index_file + ".tmp"
+        with open(tmp_file, "w") as f:
+            json.dump(self.entries, f, indent=4)
+        os.replace(tmp_file, self.index_file)
@@ -0,0 +1,360 @@
+"""
+* Compressed columnar logs
+* Each table of a run (agp_data, cars_data, exits_data, crashes_data) is written in chunks
+* with a fixed dtype per column, without the pandas index column of the CSVs
+* Parquet (zstd) when pyarrow is installed, otherwise a directory of compressed .npz chunks
+
+* load_run reads any run, columnar or CSV, as the same four DataFrames (the floats are
+* float64 in every format, the columnar logs are lossless)
+* iter_table streams a table chunk by chunk
+* run: python runlog.py logs/<ts> [logs/<ts> ...] --format auto --remove_csv False (converts CSV runs)
+"""
+
+import argparse
+import glob
+import os
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+
+from events import CrashEvent, ExitEvent, Sink, SpawnEvent
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    PYARROW_AVAILABLE = True
+except ImportError:
+    PYARROW_AVAILABLE = False
+
+FORMATS = ["csv", "npz", "parquet", "auto"]
+
+AGP_SCHEMA = {
+    "frame": np.int32,
+    "current_car_count": np.int32,
+    "historic_car_count": np.int32,
+    "current_crash_count": np.int32,
+    "historic_crash_count": np.int32,
+    "avg_v": np.float64,
+    "avg_a": np.float64,
+    "avg_t_d": np.float64,
+}
+
+# float64 like the CSV, float32 only resolves about 1e-3 m at 14 km
+CARS_SCHEMA = {
+    "frame": np.int32,
+    "car_id": np.int32,
+    "car_x": np.float64,
+    "car_v": np.float64,
+    "car_a": np.float64,
+    "car_t_d": np.float64,
+    "f_car_id": np.int32,
+    "b_car_id": np.int32,
+}
+
+# init_frame is None for the first car, stored as NaN like in the CSV
+EXITS_SCHEMA = dict(
+    zip(
+        ExitEvent._fields,
+        [np.int64, np.int32, np.float64, np.float64, np.float64, np.float64],
+    )
+)
+
+CRASHES_SCHEMA = dict(
+    zip(
+        CrashEvent._fields,
+        [np.int64, np.int32, np.float64, np.float64, np.float64, np.float64, np.int32, np.int32],
+    )
+)
+
+SPAWNS_SCHEMA = dict(zip(SpawnEvent._fields, [np.int64, np.int32, np.float64, np.float64]))
+
+TABLES = {
+    "agp_data": AGP_SCHEMA,
+    "cars_data": CARS_SCHEMA,
+    "exits_data": EXITS_SCHEMA,
+    "crashes_data": CRASHES_SCHEMA,
+}
+
+# Every table a run can have, spawns_data only in recorded runs (see replay.py)
+SCHEMAS = {**TABLES, "spawns_data": SPAWNS_SCHEMA}
+
+
+def resolve_format(format: str) -> str:
+    if format not in FORMATS:
+        raise ValueError(f"Unknown log format {format}, use one of {', '.join(FORMATS)}")
+    if format == "auto":
+        return "parquet" if PYARROW_AVAILABLE else "npz"
+    if format == "parquet" and not PYARROW_AVAILABLE:
+        raise ValueError("The parquet log format needs pyarrow (pip install pyarrow)")
+    return format
+
+
+class ColumnarWriter:
+    """Buffers rows and writes them as typed column chunks
+
+    Args:
+        path (str): Table path without extension (<log_dir>/<table>)
+        schema (Dict[str, type]): dtype of each column, in row order
+        format (str, optional): npz, parquet or auto. Defaults to "auto".
+        chunk_rows (int, optional): Rows per chunk. Defaults to 65536.
+    """
+
+    def __init__(self, path: str, schema: Dict, format: str = "auto", chunk_rows: int = 65536):
+        self.format = resolve_format(format)
+        if self.format == "csv":
+            raise ValueError("ColumnarWriter does not write CSV")
+
+        self.path = path
+        self.schema = schema
+        self.chunk_rows = chunk_rows
+
+        self.buffer = {name: [] for name in schema}
+        self.rows = 0
+        self.chunks = 0
+        self.parquet_writer = None
+
+        if self.format == "npz":
+            os.makedirs(path, exist_ok=True)
+            for old in glob.glob(os.path.join(path, "*.npz")):
+                os.remove(old)
+
+    def append(self, row: Iterable):
+        for column, value in zip(self.buffer.values(), row):
+            column.append(value)
+        self.rows += 1
+        if self.rows >= self.chunk_rows:
+            self.flush()
+
+    def extend(self, rows: Iterable[Iterable]):
+        for row in rows:
+            self.append(row)
+
+    def write_frame(self, df: pd.DataFrame):
+        """Writes a DataFrame with the schema columns as one chunk"""
+        self.flush()
+        self._write({name: df[name].to_numpy() for name in self.schema})
+
+    def flush(self):
+        if self.rows == 0:
+            return
+        columns = self.buffer
+        self.buffer = {name: [] for name in self.schema}
+        self.rows = 0
+        self._write(columns)
+
+    def _write(self, columns: Dict):
+        arrays = {name: np.asarray(columns[name], dtype=dtype) for name, dtype in self.schema.items()}
+        if len(next(iter(arrays.values()))) == 0:
+            return
+
+        if self.format == "npz":
+            np.savez_compressed(os.path.join(self.path, f"{self.chunks:05d}.npz"), **arrays)
+        else:
+            table = pa.table(arrays)
+            if self.parquet_writer is None:
+                self.parquet_writer = pq.ParquetWriter(
+                    f"{self.path}.parquet", table.schema, compression="zstd"
+                )
+            self.parquet_writer.write_table(table)
+        self.chunks += 1
+
+    def close(self):
+        self.flush()
+        if self.format == "parquet":
+            if self.parquet_writer is None:
+                # Empty table, still written so the run has all its tables
+                pq.write_table(
+                    pa.table({name: np.empty(0, dtype=dtype) for name, dtype in self.schema.items()}),
+                    f"{self.path}.parquet",
+                )
+            else:
+                self.parquet_writer.close()
+
+
+class ColumnarSink(Sink):
+    """Writes one kind of event as a columnar table, like CsvSink
+
+    Args:
+        path (str): Table path without extension
+        kind (str): Event kind to write, exit, crash or spawn
+        format (str, optional): npz, parquet or auto. Defaults to "auto".
+    """
+
+    SCHEMAS = {"exit": EXITS_SCHEMA, "crash": CRASHES_SCHEMA, "spawn": SPAWNS_SCHEMA}
+
+    def __init__(self, path: str, kind: str, format: str = "auto"):
+        super().__init__([kind])
+        self.writer = ColumnarWriter(path, self.SCHEMAS[kind], format)
+
+    def write_event(self, event):
+        self.writer.append(event)
+
+    def close(self):
+        self.writer.close()
+
+
+def table_format(log_dir: str, table: str) -> Optional[str]:
+    """Format a table of a run was written in, None if it is missing"""
+    path = os.path.join(log_dir, table)
+    if os.path.exists(f"{path}.parquet"):
+        return "parquet"
+    if os.path.isdir(path):
+        return "npz"
+    if os.path.exists(f"{path}.csv"):
+        return "csv"
+    return None
+
+
+def read_table(log_dir: str, table: str, columns: Optional[List[str]] = None) -> pd.DataFrame:
+    """Reads a table of a run in any format
+
+    Args:
+        log_dir (str): Run directory
+        table (str): Table name, see SCHEMAS
+        columns (Optional[List[str]], optional): Columns to read. Defaults to None (all).
+
+    Returns:
+        pd.DataFrame: The table, agp_data indexed by frame like the CSV
+    """
+    path = os.path.join(log_dir, table)
+    format = table_format(log_dir, table)
+    if format is None:
+        raise FileNotFoundError(f"No {table} in {log_dir}")
+
+    if format == "csv":
+        df = pd.read_csv(f"{path}.csv", index_col=0, float_precision="round_trip")
+        return df[columns] if columns is not None else df
+
+    names = list(SCHEMAS[table]) if columns is None else columns
+    if format == "parquet":
+        if not PYARROW_AVAILABLE:
+            raise ValueError(f"{path}.parquet needs pyarrow (pip install pyarrow)")
+        df = pq.read_table(f"{path}.parquet", columns=names).to_pandas()
+    else:
+        chunks = sorted(glob.glob(os.path.join(path, "*.npz")))
+        parts = {name: [] for name in names}
+        for chunk in chunks:
+            with np.load(chunk) as data:
+                for name in names:
+                    parts[name].append(data[name])
+        df = pd.DataFrame(
+            {
+                name: np.concatenate(parts[name]) if parts[name] else np.empty(0, SCHEMAS[table][name])
+                for name in names
+            }
+        )
+
+    if table == "agp_data" and "frame" in df:
+        df.index = df["frame"].to_numpy()
+    return df
+
+
+def iter_table(
+    log_dir: str, table: str, columns: Optional[List[str]] = None, chunk_rows: int = 1 << 20
+) -> Iterator[pd.DataFrame]:
+    """Reads a table of a run chunk by chunk, without the whole table in memory
+
+    Args:
+        log_dir (str): Run directory
+        table (str): Table name, see SCHEMAS
+        columns (Optional[List[str]], optional): Columns to read. Defaults to None (all).
+        chunk_rows (int, optional): Rows per chunk of CSV and Parquet tables (npz keeps its chunks). Defaults to 1 << 20.
+
+    Yields:
+        pd.DataFrame: Consecutive rows of the table
+    """
+    path = os.path.join(log_dir, table)
+    format = table_format(log_dir, table)
+    if format is None:
+        raise FileNotFoundError(f"No {table} in {log_dir}")
+
+    names = list(SCHEMAS[table]) if columns is None else columns
+    if format == "csv":
+        yield from pd.read_csv(f"{path}.csv", usecols=names, chunksize=chunk_rows, float_precision="round_trip")
+    elif format == "parquet":
+        if not PYARROW_AVAILABLE:
+            raise ValueError(f"{path}.parquet needs pyarrow (pip install pyarrow)")
+        for batch in pq.ParquetFile(f"{path}.parquet").iter_batches(chunk_rows, columns=names):
+            yield batch.to_pandas()
+    else:
+        for chunk in sorted(glob.glob(os.path.join(path, "*.npz"))):
+            with np.load(chunk) as data:
+                yield pd.DataFrame({name: data[name] for name in names})
+
+
+def load_run(
+    ts: str, logs_dir: str = "logs", tables: Iterable[str] = TABLES
+) -> Tuple[pd.DataFrame, ...]:
+    """Loads the tables of a run
+
+    Args:
+        ts (str): Timestamp of the run in `logs_dir`, or the path of its directory
+        logs_dir (str, optional): Directory of the runs. Defaults to "logs".
+        tables (Iterable[str], optional): Tables to load, in order. Defaults to the four of TABLES.
+
+    Returns:
+        Tuple[pd.DataFrame, ...]: agp_df, cars_df, exits_df, crashes_df
+    """
+    log_dir = ts if os.path.isdir(ts) else os.path.join(logs_dir, ts)
+    return tuple(read_table(log_dir, table) for table in tables)
+
+
+def convert_run(
+    log_dir: str, format: str = "auto", chunk_rows: int = 65536, remove_csv: bool = False
+) -> List[str]:
+    """Rewrites the CSV tables of a run in a columnar format
+
+    Args:
+        log_dir (str): Run directory
+        format (str, optional): npz, parquet or auto. Defaults to "auto".
+        chunk_rows (int, optional): Rows per chunk. Defaults to 65536.
+        remove_csv (bool, optional): Delete the CSVs once converted. Defaults to False.
+
+    Returns:
+        List[str]: Tables converted
+    """
+    converted = []
+    for table, schema in SCHEMAS.items():
+        csv_path = os.path.join(log_dir, f"{table}.csv")
+        if not os.path.exists(csv_path):
+            continue
+
+        writer = ColumnarWriter(os.path.join(log_dir, table), schema, format, chunk_rows)
+        for chunk in pd.read_csv(csv_path, index_col=0, chunksize=chunk_rows, float_precision="round_trip"):
+            for name, dtype in schema.items():
+                if np.issubdtype(dtype, np.integer):
+                    chunk[name] = chunk[name].fillna(-1)
+            writer.write_frame(chunk)
+        writer.close()
+
+        if remove_csv:
+            os.remove(csv_path)
+        converted.append(table)
+    return converted
+
+
+def log_size(log_dir: str) -> int:
+    size = 0
+    for root, _, files in os.walk(log_dir):
+        size += sum(os.path.getsize(os.path.join(root, name)) for name in files)
+    return size
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Convert CSV runs to the columnar log format")
+    parser.add_argument("runs", type=str, nargs="+", help="Run directories")
+    parser.add_argument("--format", type=str, help="npz, parquet or auto", default="auto")
+    parser.add_argument("--chunk_rows", type=int, help="Rows per chunk", default=65536)
+    parser.add_argument("--remove_csv", type=bool, help="Delete the CSVs once converted", default=False)
+
+    args = parser.parse_args()
+
+    for run in args.runs:
+        before = log_size(run)
+        converted = convert_run(run, args.format, args.chunk_rows, args.remove_csv)
+        print(
+            f"{run}: {', '.join(converted) or 'nothing to convert'} "
+            f"({before / 1e6:.1f} MB -> {log_size(run) / 1e6:.1f} MB)"
+        )
@@ -0,0 +1,1037 @@
+"""
+* Spatial domain decomposition of a long highway across processes
+* The road is split into contiguous segments, each owned by a worker process
+* Same car model as BatchedHighway, on flat arrays ordered from front (index 0) to back
+
+* Every sub-step has three phases separated by barriers:
+* A: tows, physics, then each segment publishes its boundary (halo) cars
+* B: collisions with the halo cars, then each segment publishes its crash flags
+* C: decisions and actions, crashes, exits and the hand-off of the front cars that
+*    passed the segment end. Then the entrance segment adds the new cars.
+* Halos, counters and hand-offs go through shared memory.
+
+* Random numbers are counter based: each draw is a hash of (seed, car id, sub-step, stream),
+* so a run gives the same cars, crashes and exits for any number of segments.
+
+* run: python segments.py --segments 4 --frames 1200 --precision 10 --length 14000
+"""
+
+import argparse
+import multiprocessing as mp
+import os
+from datetime import datetime
+from multiprocessing import shared_memory
+from typing import Dict, List, Optional
+
+import numpy as np
+import pandas as pd
+from tqdm import tqdm
+
+from batched import (
+    ACTION_COUNT,
+    AGP_COLUMNS,
+    CAR_FIELDS,
+    CRASHES_COLUMNS,
+    EXITS_COLUMNS,
+    first_car_parameters,
+)
+from car import (
+    ACCELERATE,
+    DECELERATE,
+    DEFAULT_ATTENTION,
+    INCREASE_ATTENTION,
+    RECENT_SAMPLES,
+    STOP,
+)
+from inflow import DriverPopulation
+from variance import random_streams
+
+# Streams of the counter based generator
+SLUGISH_STREAM = 1
+SLEEPY_STREAM = 2  # and 3
+ATTENTION_STREAM = 4
+ERROR_STREAM = 5
+NOISE_STREAM = 6  # and 7
+RESOLVE_STREAM = 8  # one per action, 8 to 13
+ENTRANCE_STREAM = 14
+
+# Cars behind a car that the slugish rule looks at
+SLUGISH_CARS = 11
+
+HALO_FIELDS = ["id", "x_before", "x", "v", "a", "stopping", "length"]
+
+BOARD_FIELDS = (
+    # Phase A
+    ["n", "tows", "induced", "spawned"]
+    + [f"back_{name}" for name in HALO_FIELDS]
+    + ["front_id", "front_x", "front_length"]
+    + [f"front_xs_{k}" for k in range(SLUGISH_CARS)]
+    # Phase B
+    + ["back_crashed", "crashed_count", "candidate"]
+    # Phase C
+    + ["registered_count", "tail_present", "tail_x", "tail_registered", "tail_attached"]
+    + ["handoff_count"]
+)
+BOARD = {name: k for k, name in enumerate(BOARD_FIELDS)}
+
+# Per frame totals of a segment, summed over segments for agp_data
+STAT_FIELDS = [
+    "n",
+    "tows",
+    "induced",
+    "spawned",
+    "v_total",
+    "a_total",
+    "samples_total",
+    "trip_total",
+    "trip_count",
+]
+
+MASK64 = np.uint64(0xFFFFFFFFFFFFFFFF)
+
+
+def splitmix64(z: np.ndarray) -> np.ndarray:
+    z = (z + np.uint64(0x9E3779B97F4A7C15)) & MASK64
+    z = ((z ^ (z >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)) & MASK64
+    z = ((z ^ (z >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)) & MASK64
+    return z ^ (z >> np.uint64(31))
+
+
+def counter_uniform(seed: int, ids: np.ndarray, t: int, stream: int) -> np.ndarray:
+    """Uniform numbers in [0, 1) that only depend on (seed, car id, sub-step, stream)"""
+    with np.errstate(over="ignore"):
+        key = splitmix64(np.full(np.shape(ids), seed, dtype=np.uint64))
+        key = splitmix64(key ^ np.asarray(ids, dtype=np.uint64))
+        key = splitmix64(key ^ np.uint64(t))
+        key = splitmix64(key ^ np.uint64(stream))
+    return (key >> np.uint64(11)).astype(float) * 2.0**-53
+
+
+def counter_normal(seed: int, ids: np.ndarray, t: int, stream: int) -> np.ndarray:
+    """Standard normal numbers from two counter streams (Box-Muller)"""
+    u1 = counter_uniform(seed, ids, t, stream)
+    u2 = counter_uniform(seed, ids, t, stream + 1)
+    return np.sqrt(-2 * np.log1p(-u1)) * np.cos(2 * np.pi * u2)
+
+
+class Segment:
+    """Cars of the highway with position in [start, end)
+
+    Args:
+        index (int): Segment index, 0 is the entrance
+        count (int): Number of segments
+        start (float): Start of the segment in meters
+        end (float): End of the segment in meters (inf for the last one)
+        board (np.ndarray): (segments x BOARD_FIELDS) halo and counter board
+        inboxes (np.ndarray): (segments x handoff_capacity x row) hand-off buffers
+        config (Dict): Highway parameters, see SegmentedHighway
+    """
+
+    def __init__(
+        self,
+        index: int,
+        count: int,
+        start: float,
+        end: float,
+        board: np.ndarray,
+        inboxes: np.ndarray,
+        config: Dict,
+    ):
+        self.index = index
+        self.count = count
+        self.start = start
+        self.end = end
+        self.board = board
+        self.inboxes = inboxes
+
+        self.seed = config["seed"]
+        self.length = config["length"]
+        self.precision = config["precision"]
+        self.crash_remove_delay = config["crash_remove_delay"]
+        self.delay_slots = config["delay_slots"]
+        self.min_gap = config["min_gap"]
+        self.max_reaction_time = config["max_reaction_time"]
+
+        self.time = 0
+        self.capacity = 0
+        self.n = 0
+        self.allocate(64)
+
+        self.tows = 0
+        self.induced = 0
+        self.spawned = 0
+        self.v_total = 0.0
+        self.a_total = 0.0
+        self.samples_total = 0
+        self.trip_total = 0.0
+        self.trip_count = 0
+
+        self.stats = []
+        self.exits_rows = []
+        self.crashes_rows = []
+
+        # Only the entrance samples drivers
+        self.population = None
+        if index == 0:
+            # The drivers of simulation.py with the same seed
+            self.population = DriverPopulation(
+                random_streams(self.seed)["population"],
+                max_v=config["max_v"],
+                smart_car_probability=config["smart_car_probability"],
+            )
+            if config["first_car"]:
+                # Same distribution as the first car of simulation.py, from its own stream
+                rng = np.random.default_rng(np.random.SeedSequence([self.seed, 1]))
+                self.place_car(first_car_parameters(rng, config["max_v"]), x=100, attached=True, frame=0)
+
+    # Storage
+
+    def allocate(self, capacity: int):
+        old = self.capacity
+
+        def grow(array, shape, dtype):
+            new = np.zeros(shape, dtype=dtype)
+            if array is not None:
+                new[:old] = array
+            return new
+
+        for name, dtype in CAR_FIELDS.items():
+            setattr(self, name, grow(getattr(self, name, None), (capacity,), dtype))
+        self.recent_v = grow(getattr(self, "recent_v", None), (capacity, RECENT_SAMPLES), float)
+        self.recent_a = grow(getattr(self, "recent_a", None), (capacity, RECENT_SAMPLES), float)
+        self.pending = grow(
+            getattr(self, "pending", None), (capacity, ACTION_COUNT, self.delay_slots), np.int16
+        )
+        self.active = grow(getattr(self, "active", None), (capacity, ACTION_COUNT), np.int32)
+        self.enqueued_at = grow(
+            getattr(self, "enqueued_at", None), (capacity, ACTION_COUNT), np.int64
+        )
+        self.capacity = capacity
+
+    def arrays(self):
+        return [getattr(self, name) for name in CAR_FIELDS] + [
+            self.recent_v,
+            self.recent_a,
+            self.pending,
+            self.active,
+            self.enqueued_at,
+        ]
+
+    def remove(self, removed: np.ndarray):
+        """Drops the cars in the mask (over the first n) keeping the order of the rest"""
+        keep = np.flatnonzero(~removed)
+        for array in self.arrays():
+            array[: len(keep)] = array[keep]
+            array[len(keep) : self.n] = 0
+        self.n = len(keep)
+
+    def pack(self, i: int) -> np.ndarray:
+        return np.concatenate([np.asarray(array[i], dtype=float).ravel() for array in self.arrays()])
+
+    def unpack(self, row: np.ndarray):
+        if self.n == self.capacity:
+            self.allocate(self.capacity * 2)
+        i = self.n
+        self.n += 1
+        offset = 0
+        for array in self.arrays():
+            size = int(np.prod(array.shape[1:]))
+            array[i] = row[offset : offset + size].reshape(array.shape[1:])
+            offset += size
+
+    def place_car(self, parameters: Dict, x: float, attached: bool, frame: int):
+        if self.n == self.capacity:
+            self.allocate(self.capacity * 2)
+        i = self.n
+        self.n += 1
+        self.spawned += 1
+
+        vmax = parameters["vmax"] / 3.6
+        self.id[i] = self.spawned
+        self.x[i] = x
+        self.v[i] = parameters["v"] / 3.6
+        self.a[i] = parameters["a"]
+        self.vmax[i] = vmax
+        self.vd[i] = min(parameters["vd"] / 3.6, vmax)
+        self.amax[i] = parameters["amax"]
+        self.brake[i] = parameters["break_max"]
+        self.throttle[i] = parameters["acc_throttle"]
+        self.stopping_acc[i] = parameters["acc_stopping"]
+        self.car_length[i] = parameters["length"]
+        self.tr[i] = min(parameters["tr"], self.max_reaction_time)
+        self.random_behavior[i] = parameters["has_random_behavior"]
+        self.attached[i] = attached
+        self.init_frame[i] = frame
+        self.crash_frame[i] = -1
+
+    # Board
+
+    def publish(self, name: str, value: float):
+        self.board[self.index, BOARD[name]] = value
+
+    def read(self, k: int, name: str) -> float:
+        return self.board[k, BOARD[name]]
+
+    def segments_ahead(self):
+        return range(self.index + 1, self.count)
+
+    def segments_behind(self):
+        return range(self.index - 1, -1, -1)
+
+    def leader_segment(self) -> Optional[int]:
+        """Nearest segment ahead with cars, its back car leads our front car"""
+        for k in self.segments_ahead():
+            if self.read(k, "n") > 0:
+                return k
+        return None
+
+    def follower_segment(self) -> Optional[int]:
+        for k in self.segments_behind():
+            if self.read(k, "n") > 0:
+                return k
+        return None
+
+    # Actions
+
+    def reaction_delay(self) -> np.ndarray:
+        n = self.n
+        factor = np.where(
+            self.increased_attention[:n], 0.5, np.where(self.decreased_attention[:n], 1.8, 1.0)
+        )
+        return self.tr[:n] * self.precision * factor
+
+    def enqueue(self, mask: np.ndarray, action: int, due):
+        i = np.flatnonzero(mask)
+        if len(i) == 0:
+            return
+        due = np.asarray(due)
+        if due.ndim > 0:
+            due = due[i]
+        t = self.time
+        last = np.clip(np.floor(due).astype(np.int64), t, t + self.delay_slots - 1)
+        self.pending[i, action, last % self.delay_slots] += 1
+        self.active[i, action] += 1
+        self.enqueued_at[i, action] = t
+
+    def keep_only(self, mask: np.ndarray, action: int):
+        n = self.n
+        for code in range(ACTION_COUNT):
+            if code != action:
+                self.pending[:n, code][mask] = 0
+                self.active[:n, code][mask] = 0
+
+    def uniform(self, stream: int) -> np.ndarray:
+        return counter_uniform(self.seed, self.id[: self.n], self.time, stream)
+
+    # Phase A
+
+    def phase_a(self):
+        t = self.time
+        self.receive()
+        n = self.n
+
+        towed = self.registered[:n] & (self.crash_frame[:n] + self.crash_remove_delay <= t)
+        if towed.any():
+            self.tows += int(towed.sum())
+            self.remove(towed)
+            n = self.n
+
+        slot = (t - 1) % self.delay_slots
+        self.active[:n] -= self.pending[:n, :, slot]
+        self.pending[:n, :, slot] = 0
+
+        self.x_before = self.x[:n].copy()
+        self.x[:n] = self.x[:n] + self.v[:n] / self.precision
+        v = self.v[:n] + self.a[:n] / self.precision
+        v = np.where(self.stopping[:n], v - self.stopping_acc[:n], v)
+        self.v[:n] = np.maximum(0, np.minimum(v, self.vmax[:n]))
+        self.stopping[:n] &= self.v[:n] != 0
+
+        self.publish("n", n)
+        self.publish("tows", self.tows)
+        self.publish("induced", self.induced)
+        self.publish("spawned", self.spawned)
+        if n > 0:
+            back = n - 1
+            self.publish("back_id", self.id[back])
+            self.publish("back_x_before", self.x_before[back])
+            self.publish("back_x", self.x[back])
+            self.publish("back_v", self.v[back])
+            self.publish("back_a", self.a[back])
+            self.publish("back_stopping", self.stopping[back])
+            self.publish("back_length", self.car_length[back])
+            self.publish("front_id", self.id[0])
+            self.publish("front_x", self.x[0])
+            self.publish("front_length", self.car_length[0])
+        xs = np.full(SLUGISH_CARS, np.nan)
+        xs[: min(n, SLUGISH_CARS)] = self.x[: min(n, SLUGISH_CARS)]
+        for k in range(SLUGISH_CARS):
+            self.publish(f"front_xs_{k}", xs[k])
+
+    def receive(self):
+        """Appends the cars handed off by the segment behind in the last sub-step"""
+        if self.index == 0:
+            return
+        count = int(self.read(self.index - 1, "handoff_count"))
+        for row in self.inboxes[self.index][:count]:
+            self.unpack(row)
+
+    # Phase B
+
+    def phase_b(self):
+        n = self.n
+        x = self.x[:n]
+        length = self.car_length[:n]
+
+        self.leader = self.leader_segment()
+        self.follower = self.follower_segment()
+
+        front_gap = np.full(n, np.nan)
+        back_gap = np.full(n, np.nan)
+        if n > 0:
+            front_gap[1:] = self.x_before[:-1] - (x[1:] + length[1:])
+            back_gap[:-1] = x[:-1] - (x[1:] + length[1:])
+            if self.leader is not None:
+                front_gap[0] = self.read(self.leader, "back_x_before") - (x[0] + length[0])
+            if self.follower is not None:
+                back_gap[-1] = x[-1] - (
+                    self.read(self.follower, "front_x") + self.read(self.follower, "front_length")
+                )
+
+        with np.errstate(invalid="ignore"):
+            self.crashed[:n] |= (front_gap < 0) | (back_gap < 0)
+        self.front_gap = front_gap
+
+        # Candidates of the induced crash (the crash count is checked in phase C)
+        self.driving = ~self.crashed[:n]
+        candidates = self.driving & self.random_behavior[:n] & self.attached[:n]
+
+        self.publish("back_crashed", self.crashed[n - 1] if n > 0 else 0)
+        self.publish("crashed_count", int(self.crashed[:n].sum()))
+        self.publish("candidate", candidates.any())
+        self.candidates = candidates
+
+    # Phase C
+
+    def global_crash_count(self) -> int:
+        return int(
+            sum(self.read(k, "tows") + self.read(k, "induced") for k in range(self.count))
+        )
+
+    def phase_c(self):
+        t = self.time
+        n = self.n
+        v = self.v[:n]
+        ids = self.id[:n]
+
+        has_leader = np.ones(n, dtype=bool)
+        leader_v = np.zeros(n)
+        leader_a = np.zeros(n)
+        leader_stopping = np.zeros(n, dtype=bool)
+        leader_crashed = np.zeros(n, dtype=bool)
+        if n > 0:
+            leader_v[1:] = v[:-1]
+            leader_a[1:] = self.a[: n - 1]
+            leader_stopping[1:] = self.stopping[: n - 1]
+            leader_crashed[1:] = self.crashed[: n - 1]
+            if self.leader is None:
+                has_leader[0] = False
+            else:
+                leader_v[0] = self.read(self.leader, "back_v")
+                leader_a[0] = self.read(self.leader, "back_a")
+                leader_stopping[0] = bool(self.read(self.leader, "back_stopping"))
+                leader_crashed[0] = bool(self.read(self.leader, "back_crashed"))
+
+        crashed_ahead = sum(self.read(k, "crashed_count") for k in self.segments_ahead())
+        crashed_before = np.cumsum(self.crashed[:n]) - self.crashed[:n] + crashed_ahead
+        crash_ahead = self.attached[:n] & (crashed_before > 0)
+
+        crashed = self.crashed[:n].copy()
+        self.keep_only(crashed, STOP)
+        self.enqueue(crashed, DECELERATE, t)
+
+        driving = self.driving
+        self.record_samples(driving)
+
+        self.custom_behavior()
+        self.slugish_behavior(driving, has_leader)
+        self.sleepy_behavior(driving)
+        self.behaviour(
+            driving, has_leader, crash_ahead, leader_v, leader_a, leader_stopping, leader_crashed
+        )
+        self.resolve()
+
+        self.time_ellapsed[:n] += 1
+        self.v_total += float(self.v[:n].sum())
+        self.a_total += float(self.a[:n].sum())
+        self.samples_total += n
+
+        new_crashes = self.crashed[:n] & ~self.registered[:n]
+        if new_crashes.any():
+            self.registered[:n] |= new_crashes
+            self.crash_frame[:n][new_crashes] = t
+            self.log_crashes(new_crashes)
+
+        exits = self.x[:n] > self.length
+        if exits.any():
+            self.trip_total += float(self.time_ellapsed[:n][exits].sum())
+            self.trip_count += int(exits.sum())
+            self.log_exits(exits)
+            self.remove(exits)
+
+        self.publish_tail()
+        self.hand_off()
+
+    def publish_tail(self):
+        n = self.n
+        self.publish("registered_count", int(self.registered[:n].sum()))
+        self.publish("tail_present", n > 0)
+        if n > 0:
+            self.publish("tail_x", self.x[n - 1])
+            self.publish("tail_registered", self.registered[n - 1])
+            self.publish("tail_attached", self.attached[n - 1])
+
+    def hand_off(self):
+        """Front cars that passed the segment end move to the next segment, in order"""
+        if self.index == self.count - 1:
+            self.publish("handoff_count", 0)
+            return
+        n = self.n
+        passed = self.x[:n] >= self.end
+        count = int(np.argmin(passed)) if not passed.all() else n
+        count = min(count, self.inboxes.shape[1])
+        inbox = self.inboxes[self.index + 1]
+        for i in range(count):
+            inbox[i] = self.pack(i)
+        self.publish("handoff_count", count)
+        if count > 0:
+            removed = np.zeros(n, dtype=bool)
+            removed[:count] = True
+            self.remove(removed)
+
+    def record_samples(self, driving: np.ndarray):
+        n = self.n
+        i = np.flatnonzero(driving)
+        slot = self.samples[i] % RECENT_SAMPLES
+        self.recent_v[i, slot] = self.v[i]
+        self.recent_a[i, slot] = self.a[i]
+        self.samples[:n] += driving
+        self.v_sum[:n] += np.where(driving, self.v[:n], 0)
+        self.a_sum[:n] += np.where(driving, self.a[:n], 0)
+
+    def custom_behavior(self):
+        # Induced crash: the back-most candidate of the whole highway
+        t = self.time
+        if t <= 3000 or self.global_crash_count() != 0 or self.read(0, "spawned") <= 100:
+            return
+        if not self.candidates.any():
+            return
+        for k in range(self.index):
+            if self.read(k, "candidate"):
+                return
+        i = np.flatnonzero(self.candidates)[-1]
+        mask = np.zeros(self.n, dtype=bool)
+        mask[i] = True
+        self.enqueue(mask, STOP, t + self.reaction_delay())
+        self.crashed[i] = True
+        self.induced += 1
+
+    def cars_behind(self, i: int) -> np.ndarray:
+        """Positions of the SLUGISH_CARS cars that follow car i"""
+        xs = list(self.x[i + 1 : min(self.n, i + 1 + SLUGISH_CARS)])
+        for k in self.segments_behind():
+            if len(xs) >= SLUGISH_CARS:
+                break
+            for j in range(SLUGISH_CARS):
+                x = self.read(k, f"front_xs_{j}")
+                if np.isnan(x) or len(xs) >= SLUGISH_CARS:
+                    break
+                xs.append(x)
+        return np.array(xs)
+
+    def slugish_behavior(self, driving, has_leader):
+        t = self.time
+        candidates = driving & self.attached[: self.n] & (self.uniform(SLUGISH_STREAM) < 0.01)
+        if not candidates.any():
+            return
+        delay = self.reaction_delay()
+        for i in np.flatnonzero(candidates):
+            x = self.x[i]
+            behind = self.cars_behind(i)
+            close = (behind < x) & (behind > x - 10 * self.v[i])
+            if (
+                close.sum() > 10
+                and x > 3000
+                and has_leader[i]
+                and self.front_gap[i] > 20 * self.v[i]
+            ):
+                mask = np.zeros(self.n, dtype=bool)
+                mask[i] = True
+                for k in range(10):
+                    self.enqueue(mask, ACCELERATE, t + delay + k)
+
+    def sleepy_behavior(self, driving):
+        n = self.n
+        enough = driving & (self.samples[:n] > RECENT_SAMPLES)
+        calm = ~self.increased_attention[:n]
+        sleepy = enough & calm & (
+            ((self.recent_a[:n].std(axis=1) < 0.1) & (self.uniform(SLEEPY_STREAM) < 0.2))
+            | ((self.recent_v[:n].std(axis=1) < 0.1) & (self.uniform(SLEEPY_STREAM + 1) < 0.2))
+        )
+        self.decreased_attention[:n] = np.where(driving, sleepy, self.decreased_attention[:n])
+
+    def behaviour(
+        self, driving, has_leader, crash_ahead, leader_v, leader_a, leader_stopping, leader_crashed
+    ):
+        t = self.time
+        n = self.n
+        v = self.v[:n]
+        gap = np.where(has_leader, self.front_gap, np.inf)
+        u = self.uniform(ATTENTION_STREAM)
+        noise = counter_normal(self.seed, self.id[:n], t, NOISE_STREAM)
+        inc = self.increased_attention[:n]
+        dec = self.decreased_attention[:n]
+
+        alert = crash_ahead | (has_leader & leader_stopping & (gap <= 5 * v) & (u < 0.5))
+        self.enqueue(driving & alert & ~inc, INCREASE_ATTENTION, t + 1)
+        self.enqueue(driving & ~alert & inc, DEFAULT_ATTENTION, t + 1)
+
+        delay = t + self.reaction_delay()
+        acting = driving & ~self.stopping[:n]
+        reacts = self.tr[:n] > 0
+
+        front_crash = acting & has_leader & leader_crashed
+        stop = front_crash & (gap <= 8 * v)
+        self.enqueue(stop, STOP, delay)
+        self.keep_only(stop, STOP)
+
+        threshold = np.where(reacts, noise * (0.1 - 0.05 * inc + 0.5 * dec), 0)
+        close = (
+            acting
+            & has_leader
+            & ~leader_crashed
+            & ((gap <= 2 * v) | ((gap <= 10 * v) & (leader_a < threshold)))
+        )
+        self.enqueue(close, DECELERATE, delay)
+
+        error = np.where(reacts, self.uniform(ERROR_STREAM) * (5 - 2 * inc + 2 * dec), 0)
+        follow = (
+            acting
+            & has_leader
+            & ~leader_crashed
+            & ~close
+            & (v < leader_v + error)
+            & (v < self.vd[:n])
+        )
+        self.enqueue(follow, ACCELERATE, delay)
+
+        free = acting & ~front_crash & ~close & ~follow & (v < self.vd[:n])
+        self.enqueue(free, ACCELERATE, delay)
+
+    def resolve(self):
+        n = self.n
+        u = np.column_stack([self.uniform(RESOLVE_STREAM + code) for code in range(ACTION_COUNT)])
+        fires = u.reshape(n, ACTION_COUNT) < 1 - 0.9 ** self.active[:n]
+
+        amax = self.amax[:n]
+        throttle = self.throttle[:n]
+        brake = self.brake[:n]
+        stopping_acc = self.stopping_acc[:n]
+
+        def accelerate(a):
+            return np.minimum(amax, np.maximum(a, 0) + 100 * throttle)
+
+        def decelerate(a):
+            return np.maximum(-brake, a - 100 * stopping_acc / 5)
+
+        acc = fires[:, ACCELERATE]
+        dec = fires[:, DECELERATE]
+        acc_last = self.enqueued_at[:n, ACCELERATE] > self.enqueued_at[:n, DECELERATE]
+        a = self.a[:n]
+        self.a[:n] = np.select(
+            [acc & ~dec, dec & ~acc, acc & dec & acc_last, acc & dec],
+            [accelerate(a), decelerate(a), accelerate(decelerate(a)), decelerate(accelerate(a))],
+            a,
+        )
+
+        self.stopping[:n] |= fires[:, STOP]
+        self.increased_attention[:n] |= fires[:, INCREASE_ATTENTION]
+        default = fires[:, DEFAULT_ATTENTION]
+        self.increased_attention[:n] &= ~default
+        self.decreased_attention[:n] &= ~default
+
+    # Entrance
+
+    def spawn(self):
+        """Called on the entrance segment after phase C"""
+        t = self.time
+        tail = None
+        for k in range(self.count):
+            if self.read(k, "tail_present"):
+                tail = k
+                break
+
+        if tail is not None:
+            if self.read(tail, "tail_x") <= self.min_gap:
+                return
+            # Only a back car attached to the highway looks for crashes ahead, like Inflow
+            registered = sum(self.read(k, "registered_count") for k in range(self.count))
+            if self.read(tail, "tail_attached") and registered - self.read(tail, "tail_registered") > 0:
+                escape = counter_uniform(self.seed, np.zeros(1), t, ENTRANCE_STREAM)[0]
+                if escape >= 1 - (1 - np.exp(-1)) ** (1 / self.precision):
+                    return
+
+        self.place_car(self.population.next_parameters(), x=0, attached=False, frame=t)
+
+    def end_substep(self):
+        if self.index == 0:
+            self.spawn()
+        self.time += 1
+
+    def end_frame(self):
+        # Cars handed off are counted by this segment until they are received
+        in_transit = int(self.read(self.index, "handoff_count"))
+        self.stats.append(
+            [
+                self.n + in_transit,
+                self.tows,
+                self.induced,
+                self.spawned,
+                self.v_total,
+                self.a_total,
+                self.samples_total,
+                self.trip_total,
+                self.trip_count,
+            ]
+        )
+
+    # Logs
+
+    def neighbour_ids(self):
+        n = self.n
+        f_ids = np.full(n, -1)
+        b_ids = np.full(n, -1)
+        if n > 0:
+            f_ids[1:] = self.id[: n - 1]
+            b_ids[:-1] = self.id[1:n]
+            if self.leader is not None:
+                f_ids[0] = self.read(self.leader, "back_id")
+            if self.follower is not None:
+                b_ids[-1] = self.read(self.follower, "front_id")
+        return f_ids, b_ids
+
+    def log_crashes(self, mask: np.ndarray):
+        f_ids, b_ids = self.neighbour_ids()
+        for i in np.flatnonzero(mask):
+            self.crashes_rows.append(
+                [
+                    self.time,
+                    self.id[i],
+                    self.x[i],
+                    self.v[i],
+                    self.a[i],
+                    self.time_ellapsed[i] / self.precision,
+                    f_ids[i],
+                    b_ids[i],
+                ]
+            )
+
+    def log_exits(self, mask: np.ndarray):
+        for i in np.flatnonzero(mask):
+            samples = self.samples[i]
+            self.exits_rows.append(
+                [
+                    self.time,
+                    self.id[i],
+                    self.v_sum[i] / samples if samples > 0 else 0,
+                    self.a_sum[i] / samples if samples > 0 else 0,
+                    self.time_ellapsed[i] / self.precision,
+                    self.init_frame[i],
+                ]
+            )
+
+    def results(self) -> Dict:
+        return {
+            "stats": np.array(self.stats, dtype=float).reshape(-1, len(STAT_FIELDS)),
+            "exits": self.exits_rows,
+            "crashes": self.crashes_rows,
+        }
+
+
+def run_segment(segment: Segment, frames: int, barrier=None, progress: bool = False):
+    """Runs a segment alone, the other segments run in other processes"""
+    for _ in tqdm(range(frames), desc="Frames", unit="frame", disable=not progress):
+        for _ in range(segment.precision):
+            segment.phase_a()
+            barrier.wait()
+            segment.phase_b()
+            barrier.wait()
+            segment.phase_c()
+            barrier.wait()
+            segment.end_substep()
+        segment.end_frame()
+
+
+def worker(index, count, bounds, board_name, inbox_name, inbox_shape, config, frames, barrier, results):
+    board_memory = shared_memory.SharedMemory(name=board_name)
+    inbox_memory = shared_memory.SharedMemory(name=inbox_name)
+    try:
+        board = np.ndarray((count, len(BOARD_FIELDS)), dtype=float, buffer=board_memory.buf)
+        inboxes = np.ndarray(inbox_shape, dtype=float, buffer=inbox_memory.buf)
+        segment = Segment(index, count, bounds[index], bounds[index + 1], board, inboxes, config)
+        run_segment(segment, frames, barrier, progress=index == 0)
+        results.put((index, segment.results()))
+    finally:
+        board_memory.close()
+        inbox_memory.close()
+
+
+class SegmentedHighway:
+    """Highway split into `segments` contiguous segments
+
+    Args:
+        length (float): Length of the highway in meters
+        segments (int, optional): Number of segments. Defaults to 1.
+        precision (int, optional): Sub-steps per frame. Defaults to 1.
+        crash_remove_delay (int, optional): Sub-steps until a crashed car is towed. Defaults to 5000.
+        seed (int, optional): Seed. Defaults to 42.
+        max_v (float, optional): Speed limit in km/h. Defaults to 100.
+        smart_car_probability (float, optional): Share of smart cars. Defaults to 0.
+        first_car (bool, optional): Start with a car at 100 m like simulation.py. Defaults to True.
+        handoff_capacity (int, optional): Cars handed off per segment and sub-step. Defaults to 32.
+    """
+
+    MAX_REACTION_TIME = 2.0
+    MIN_GAP = 80
+
+    def __init__(
+        self,
+        length: float,
+        segments: int = 1,
+        precision: int = 1,
+        crash_remove_delay: int = 5000,
+        seed: int = 42,
+        max_v: float = 100,
+        smart_car_probability: float = 0,
+        first_car: bool = True,
+        handoff_capacity: int = 32,
+    ):
+        if segments < 1:
+            raise ValueError("At least one segment is needed")
+        if segments > 1 and length / segments <= 100:
+            raise ValueError("Segments must be longer than 100 m")
+
+        self.length = length
+        self.segments = segments
+        self.precision = precision
+        self.handoff_capacity = handoff_capacity
+
+        self.bounds = [k * length / segments for k in range(segments)] + [np.inf]
+        self.config = {
+            "seed": seed,
+            "length": length,
+            "precision": precision,
+            "crash_remove_delay": crash_remove_delay,
+            "delay_slots": int(np.ceil(self.MAX_REACTION_TIME * 1.8 * precision)) + 16,
+            "min_gap": self.MIN_GAP,
+            "max_reaction_time": self.MAX_REACTION_TIME,
+            "max_v": max_v,
+            "smart_car_probability": smart_car_probability,
+            "first_car": first_car,
+        }
+
+        self.row_size = (
+            len(CAR_FIELDS)
+            + 2 * RECENT_SAMPLES
+            + ACTION_COUNT * self.config["delay_slots"]
+            + 2 * ACTION_COUNT
+        )
+        self.inbox_shape = (segments, handoff_capacity, self.row_size)
+
+        self.results = None
+
+    def make_segments(self, board, inboxes) -> List[Segment]:
+        return [
+            Segment(k, self.segments, self.bounds[k], self.bounds[k + 1], board, inboxes, self.config)
+            for k in range(self.segments)
+        ]
+
+    def run(self, frames: int, processes: bool = True, progress: bool = True):
+        """Runs the simulation
+
+        Args:
+            frames (int): Frames to simulate
+            processes (bool, optional): One worker process per segment, otherwise the
+                segments take turns in this process. Defaults to True.
+            progress (bool, optional): Show a progress bar. Defaults to True.
+        """
+        if processes and self.segments > 1:
+            self.results = self.run_processes(frames, progress)
+        else:
+            self.results = self.run_serial(frames, progress)
+
+    def run_serial(self, frames: int, progress: bool) -> List[Dict]:
+        board = np.zeros((self.segments, len(BOARD_FIELDS)))
+        inboxes = np.zeros(self.inbox_shape)
+        segments = self.make_segments(board, inboxes)
+        for _ in tqdm(range(frames), desc="Frames", unit="frame", disable=not progress):
+            for _ in range(self.precision):
+                for phase in (Segment.phase_a, Segment.phase_b, Segment.phase_c, Segment.end_substep):
+                    for segment in segments:
+                        phase(segment)
+            for segment in segments:
+                segment.end_frame()
+        return [segment.results() for segment in segments]
+
+    def run_processes(self, frames: int, progress: bool) -> List[Dict]:
+        context = mp.get_context("fork")
+        board_size = self.segments * len(BOARD_FIELDS) * 8
+        inbox_size = int(np.prod(self.inbox_shape)) * 8
+        board_memory = shared_memory.SharedMemory(create=True, size=board_size)
+        inbox_memory = shared_memory.SharedMemory(create=True, size=inbox_size)
+        try:
+            np.ndarray((self.segments, len(BOARD_FIELDS)), dtype=float, buffer=board_memory.buf)[:] = 0
+
+            barrier = context.Barrier(self.segments)
+            results = context.Queue()
+            workers = [
+                context.Process(
+                    target=worker,
+                    args=(
+                        k,
+                        self.segments,
+                        self.bounds,
+                        board_memory.name,
+                        inbox_memory.name,
+                        self.inbox_shape,
+                        self.config,
+                        frames,
+                        barrier,
+                        results,
+                    ),
+                )
+                for k in range(self.segments)
+            ]
+            for process in workers:
+                process.start()
+
+            collected = dict(results.get() for _ in workers)
+            for process in workers:
+                process.join()
+        finally:
+            board_memory.close()
+            board_memory.unlink()
+            inbox_memory.close()
+            inbox_memory.unlink()
+
+        return [collected[k] for k in range(self.segments)]
+
+    def logs(self) -> Dict[str, pd.DataFrame]:
+        """agp_data, exits_data and crashes_data as simulation.py writes them"""
+        stats = sum(result["stats"] for result in self.results)
+        stats = pd.DataFrame(stats, columns=STAT_FIELDS)
+        # Only the entrance segment spawns
+        stats["spawned"] = self.results[0]["stats"][:, STAT_FIELDS.index("spawned")]
+
+        crash_count = stats["tows"] + stats["induced"]
+        agp_df = pd.DataFrame(
+            {
+                "frame": np.arange(len(stats)),
+                "current_car_count": stats["n"].astype(int),
+                "historic_car_count": stats["spawned"].astype(int),
+                "current_crash_count": crash_count.astype(int),
+                "historic_crash_count": crash_count.astype(int),
+                "avg_v": stats["v_total"] / stats["samples_total"].clip(lower=1),
+                "avg_a": stats["a_total"] / stats["samples_total"].clip(lower=1),
+                "avg_t_d": stats["trip_total"] / stats["trip_count"].clip(lower=1),
+            },
+            columns=AGP_COLUMNS,
+        )
+
+        def events(key, columns):
+            rows = [row for result in self.results for row in result[key]]
+            df = pd.DataFrame(rows, columns=columns)
+            return df.sort_values(["frame", "car_id"]).reset_index(drop=True)
+
+        return {
+            "agp_data": agp_df,
+            "exits_data": events("exits", EXITS_COLUMNS),
+            "crashes_data": events("crashes", CRASHES_COLUMNS),
+        }
+
+    def export_logs(self, log_dir: str):
+        os.makedirs(log_dir, exist_ok=True)
+        for name, df in self.logs().items():
+            df.to_csv(f"{log_dir}/{name}.csv")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Simulate a highway split across processes")
+    parser.add_argument("--segments", type=int, help="Number of segments", default=4)
+    parser.add_argument("--precision", type=int, help="Precision of the simulation", default=100)
+    parser.add_argument("--frames", type=int, help="Number of frames to simulate", default=12000)
+    parser.add_argument("--length", type=int, help="Length of the highway in meters", default=14 * 1000)
+    parser.add_argument("--max_v", type=int, help="Maximum velocity of the cars in km/h", default=100)
+    parser.add_argument("--seed", type=int, help="Seed for the random number generator", default=42)
+    parser.add_argument(
+        "--smart_car_probability", type=float, help="Probability of a smart car", default=0
+    )
+    parser.add_argument(
+        "--check",
+        type=bool,
+        help="Also run the same seed in a single process and compare the results, then compare the engine "
+        "with the reference simulation (equivalence.py, default scenario)",
+        default=False,
+    )
+    parser.add_argument("--log", type=bool, help="Log the simulation", default=True)
+
+    args = parser.parse_args()
+
+    def make(segments):
+        return SegmentedHighway(
+            length=args.length,
+            segments=segments,
+            precision=args.precision,
+            seed=args.seed,
+            max_v=args.max_v,
+            smart_car_probability=args.smart_car_probability,
+        )
+
+    highway = make(args.segments)
+    highway.run(args.frames)
+
+    if args.log:
+        ts = datetime.now().strftime("%Y-%m-%d_%H-%M-%S")
+        highway.export_logs(f"logs/{ts}")
+        print(f"Logs saved to logs/{ts}")
+
+    if args.check:
+        single = make(1)
+        single.run(args.frames, processes=False)
+        split_logs, single_logs = highway.logs(), single.logs()
+        same = all(
+            split_logs[name].equals(single_logs[name]) for name in ("exits_data", "crashes_data")
+        ) and np.allclose(
+            split_logs["agp_data"].to_numpy(dtype=float),
+            single_logs["agp_data"].to_numpy(dtype=float),
+            rtol=1e-9,
+        )
+        print("OK: same results as a single process" if same else "FAIL: results differ")
+
+        # Same cars as one process is not enough, the engine must also behave like simulation.py
+        from equivalence import CONTROL, DEFAULT_SCENARIO, DEFAULT_SEEDS, report, verify
+        from result_cache import ResultCache
+
+        scenario = {
+            **DEFAULT_SCENARIO,
+            "max_v": args.max_v,
+            "smart_car_probability": args.smart_car_probability,
+            "segments": args.segments,
+        }
+        result = verify("segments", scenario, DEFAULT_SEEDS, cache=ResultCache(), control=CONTROL)
+        print(report(result["metrics"]))
+        if not result["control"]["failed"]:
+            print("The negative control passed, the margins are too wide to tell it apart")
+        print("OK: equivalent to the reference" if result["passed"] else "FAIL: differs from the reference")
+        if not (same and result["passed"]):
+            raise SystemExit(1)
@@ -17,6 +17,24 @@
 
 from car import Car
 from highway import Highway
+from lanes import MultiLaneHighway
+from live import LivePublisher
+from events import ConsoleSink, CsvSink, EventBus, JsonlSink
+from log_policies import parse_policy, save_policy
+from convergence import ConvergenceMonitor
+from variance import random_streams
+from telemetry import highway_telemetry
+from statefeed import StateFeed
+from replay import Recorder
+from runlog import AGP_SCHEMA, CARS_SCHEMA, ColumnarSink, ColumnarWriter, resolve_format
+from inflow import (
+    DemandProfile,
+    DriverPopulation,
+    GapArrivals,
+    Inflow,
+    PoissonArrivals,
+    RingInflow,
+)
 
 from matplotlib import animation, pyplot as plt
 from matplotlib.offsetbox import AnnotationBbox, OffsetImage
@@ -71,8 +89,174 @@ parser.add_argument(
     "--smart_car_probability", type=float, help="Probability of a smart car", default=0
 )
 
+# Driver parameters searched by calibrate.py
+parser.add_argument(
+    "--tr_mean",
+    type=float,
+    help="Mean reaction time in seconds",
+    default=DriverPopulation.DEFAULT_PARAMETERS["tr_mean"],
+)
+parser.add_argument(
+    "--tr_std",
+    type=float,
+    help="Standard deviation of the reaction time in seconds",
+    default=DriverPopulation.DEFAULT_PARAMETERS["tr_std"],
+)
+parser.add_argument(
+    "--acc_stopping",
+    type=float,
+    help="Mean delta acceleration when stopping in m/s²",
+    default=DriverPopulation.DEFAULT_PARAMETERS["acc_stopping"],
+)
+parser.add_argument(
+    "--random_behavior_share",
+    type=float,
+    help="Share of drivers with random behavior",
+    default=DriverPopulation.DEFAULT_PARAMETERS["random_behavior_share"],
+)
+parser.add_argument(
+    "--increased_attention_factor",
+    type=float,
+    help="Reaction time multiplier of an attentive driver",
+    default=Car.INCREASED_ATTENTION_FACTOR,
+)
+parser.add_argument(
+    "--decreased_attention_factor",
+    type=float,
+    help="Reaction time multiplier of a distracted driver",
+    default=Car.DECREASED_ATTENTION_FACTOR,
+)
+
+parser.add_argument(
+    "--event_sinks",
+    type=str,
+    help="Comma separated event sinks: console, csv, jsonl",
+    default="console,csv",
+)
+
+parser.add_argument(
+    "--log_policy",
+    type=str,
+    help="Which car rows to log, e.g. full, every:10, sample:0.1, window:3000:6000, crash:30:60 (join with +)",
+    default="full",
+)
+
+parser.add_argument(
+    "--log_dir",
+    type=str,
+    help="Directory for the logs. Defaults to logs/<timestamp>",
+    default=None,
+)
+
+parser.add_argument(
+    "--log_format",
+    type=str,
+    choices=["csv", "npz", "parquet", "auto"],
+    help="Format of the log tables: csv, npz (compressed chunks), parquet (needs pyarrow) or auto",
+    default="csv",
+)
+
+parser.add_argument(
+    "--inflow",
+    type=str,
+    choices=["gap", "poisson", "profile"],
+    help="Arrival process: gap (enter when the back car is 80 m in), poisson or profile",
+    default="gap",
+)
+parser.add_argument(
+    "--arrival_rate", type=float, help="Poisson arrival rate in cars per hour", default=1800
+)
+parser.add_argument(
+    "--demand_profile",
+    type=str,
+    help="CSV with time (s) and rate (cars per hour) columns for the profile inflow",
+    default=None,
+)
+
+parser.add_argument(
+    "--ring",
+    type=bool,
+    help="Ring road: the highway wraps around and keeps a fixed number of cars",
+    default=False,
+)
+parser.add_argument(
+    "--density", type=float, help="Cars per km on the ring road", default=20
+)
+parser.add_argument(
+    "--lanes", type=int, help="Number of lanes, more than one uses lanes.MultiLaneHighway", default=1
+)
+
+parser.add_argument(
+    "--stop_precision",
+    type=float,
+    help="Stop when the confidence interval of every stop metric is within this relative half width (e.g. 0.05)",
+    default=None,
+)
+parser.add_argument(
+    "--stop_metrics",
+    type=str,
+    help="Comma separated metrics for the early stop: v, t_d, crash_rate",
+    default="v,t_d",
+)
+parser.add_argument(
+    "--stop_rate_tolerance",
+    type=float,
+    help="Absolute half width of the rate metrics of the early stop (crash_rate, crashes per frame)",
+    default=0.001,
+)
+parser.add_argument(
+    "--stop_confidence", type=float, help="Confidence level of the early stop", default=0.95
+)
+parser.add_argument(
+    "--telemetry_interval",
+    type=float,
+    help="Seconds between telemetry publications",
+    default=5,
+)
+parser.add_argument(
+    "--telemetry_file",
+    type=str,
+    help="Metrics file (Prometheus text format) rewritten every telemetry interval",
+    default=None,
+)
+parser.add_argument(
+    "--telemetry_port",
+    type=int,
+    help="Serve the metrics on http://127.0.0.1:<port>/metrics",
+    default=None,
+)
+parser.add_argument(
+    "--state_feed",
+    type=str,
+    help="Publish the cars of every frame in a shared memory block with this name (see statefeed.py)",
+    default=None,
+)
+parser.add_argument(
+    "--record",
+    type=bool,
+    help="Log-light run: no car rows, only events and checkpoints, cars_data is rebuilt with replay.py",
+    default=False,
+)
+parser.add_argument(
+    "--checkpoint_interval",
+    type=int,
+    help="Frames between the checkpoints of a recorded run",
+    default=100,
+)
+parser.add_argument(
+    "--antithetic",
+    type=bool,
+    help="Antithetic twin of the run: the driver population, arrivals and entrance use 1 - u",
+    default=False,
+)
+
 args = parser.parse_args()
 
+if args.lanes > 1 and args.ring:
+    parser.error("The ring road has a single lane")
+if args.inflow == "profile" and args.demand_profile is None:
+    parser.error("--inflow profile needs --demand_profile")
+
 # run: python simulation.py --precision 100 --frames 12000 --interval 0 --fps 30 --length 14000 --max_v 100 --plot False --live False --short_scale False --log True --seed 42
 
 # Interval (Delay between frames in milliseconds) = 0
@@ -93,52 +277,78 @@ MAX_V = args.max_v  # km/h => Car converts to m/s
 PLOT = args.plot
 PLOT_TEXT = args.text and PLOT
 
+LANES = args.lanes
+
 LIVE = args.live and PLOT
 SHORT_SCALE = args.short_scale and PLOT
 
+# The live view draws in its own process, only the video is drawn by update()
+DRAW = PLOT and not LIVE
+
 LOG = args.log
 ts = datetime.now().strftime("%Y-%m-%d_%H-%M-%S")
-AGP_LOG_FILE = f"logs/{ts}/agp_data.csv"
-CARS_LOG_FILE = f"logs/{ts}/cars_data.csv"
-EXITS_LOG_FILE = f"logs/{ts}/exits_data.csv"
-CRASHES_LOG_FILE = f"logs/{ts}/crashes_data.csv"
+LOG_DIR = args.log_dir if args.log_dir is not None else f"logs/{ts}"
+AGP_LOG_FILE = f"{LOG_DIR}/agp_data.csv"
+CARS_LOG_FILE = f"{LOG_DIR}/cars_data.csv"
+EXITS_LOG_FILE = f"{LOG_DIR}/exits_data.csv"
+CRASHES_LOG_FILE = f"{LOG_DIR}/crashes_data.csv"
+EVENTS_LOG_FILE = f"{LOG_DIR}/events.jsonl"
+LOG_POLICY_FILE = f"{LOG_DIR}/log_policy.json"
+LOG_FORMAT = resolve_format(args.log_format)
+CONVERGENCE_LOG_FILE = f"{LOG_DIR}/convergence.json"
+
+EVENT_SINKS = [sink.strip() for sink in args.event_sinks.split(",") if sink.strip()]
 
 SEED = args.seed
 
+# A recorded run keeps the events and checkpoints instead of the car rows
+RECORD = args.record and LOG
+LOG_POLICY = "none" if RECORD else args.log_policy
+SPAWNS_LOG_FILE = f"{LOG_DIR}/spawns_data.csv"
+
 
 random.seed(SEED)
 np.random.seed(SEED)
 
 SMART_CAR_PROBABILITY = args.smart_car_probability
 
+DRIVER_PARAMETERS = {name: getattr(args, name) for name in DriverPopulation.DEFAULT_PARAMETERS}
+Car.INCREASED_ATTENTION_FACTOR = args.increased_attention_factor
+Car.DECREASED_ATTENTION_FACTOR = args.decreased_attention_factor
 
-def SmartCar():
-    return Car(
-        x=None,
-        v=60,
-        vmax=120,
-        vd=MAX_V,
-        a=2,
-        amax=3,
-        break_max=3.5,
-        acc_throttle=0.1,
-        acc_stopping=0.4,
-        length=4.5,
-        tr=0,
-        fc=None,
-        bc=None,
-        will_measure=True,
-        has_random_behavior=False,
-    )
+
+# Independent random streams for the driver population, the arrivals and the entrance
+# (common random numbers: the same seed gives the same drivers in every scenario)
+streams = random_streams(SEED, antithetic=args.antithetic)
+population_rng, arrivals_rng, entrance_rng = (
+    streams["population"],
+    streams["arrivals"],
+    streams["entrance"],
+)
+
+population = DriverPopulation(
+    population_rng,
+    max_v=MAX_V,
+    smart_car_probability=SMART_CAR_PROBABILITY,
+    parameters=DRIVER_PARAMETERS,
+)
+
+if args.inflow == "poisson":
+    arrivals = PoissonArrivals(arrivals_rng, args.arrival_rate)
+elif args.inflow == "profile":
+    arrivals = DemandProfile.from_csv(arrivals_rng, args.demand_profile)
+else:
+    arrivals = GapArrivals()
 
 
 if LOG:
 
     # Check if log directory exists
-    if not os.path.exists("logs"):
-        os.makedirs("logs")
-    if not os.path.exists(f"logs/{ts}"):
-        os.makedirs(f"logs/{ts}")
+    if not os.path.exists(LOG_DIR):
+        os.makedirs(LOG_DIR)
+
+    log_policy = parse_policy(LOG_POLICY, seed=SEED)
+    save_policy(log_policy, LOG_POLICY, LOG_POLICY_FILE)
 
     agp_df = pd.DataFrame(
         columns=[
@@ -166,30 +376,6 @@ if LOG:
         ]
     )
 
-    exits_df = pd.DataFrame(
-        columns=[
-            "frame",
-            "car_id",
-            "avg_v",
-            "avg_a",
-            "t_d",
-            "init_frame",
-        ]
-    )
-
-    crashes_df = pd.DataFrame(
-        columns=[
-            "frame",
-            "car_id",
-            "car_x",
-            "car_v",
-            "car_a",
-            "car_t_d",
-            "f_car_id",
-            "b_car_id",
-        ]
-    )
-
     def log_agp_data(agp: Highway, frame: int):
         agp_df.loc[frame] = [
             frame,
@@ -202,8 +388,8 @@ if LOG:
             agp.get_avg_trip_duration(),
         ]
 
-    def log_car_data(car: Car, frame: int):
-        cars_df.loc[len(cars_df)] = [
+    def car_row(car: Car, frame: int):
+        return [
             frame,
             car.id,
             car.x,
@@ -214,34 +400,105 @@ if LOG:
             car.b_car.id if car.b_car is not None else -1,
         ]
 
-    def log_exits(car: Car, frame: int):
-        exits_df.loc[len(exits_df)] = [
-            frame,
-            car.id,
-            np.mean(car.historic_velocities) if len(car.historic_velocities) > 0 else 0,
-            np.mean(car.historic_accelerations)
-            if len(car.historic_accelerations) > 0
-            else 0,
-            car.time_ellapsed / PRECISION,
-            car.init_frame,
-        ]
+    def log_car_data(row: list):
+        cars_df.loc[len(cars_df)] = row
+
+    # Columnar tables are written in chunks instead of rewriting the CSVs
+    if LOG_FORMAT != "csv":
+        agp_writer = ColumnarWriter(f"{LOG_DIR}/agp_data", AGP_SCHEMA, LOG_FORMAT)
+        cars_writer = ColumnarWriter(f"{LOG_DIR}/cars_data", CARS_SCHEMA, LOG_FORMAT)
+
+        def log_agp_data(agp: Highway, frame: int):
+            agp_writer.append(
+                [
+                    frame,
+                    len(agp.get_cars()),
+                    len(agp.historic_ids),
+                    agp.get_crash_count(),
+                    agp.historic_crash_count,
+                    agp.get_avg_v(),
+                    agp.get_avg_a(),
+                    agp.get_avg_trip_duration(),
+                ]
+            )
 
-    def log_crash(car: Car, frame: int):
-        crashes_df.loc[len(crashes_df)] = [
-            frame,
-            car.id,
-            car.x,
-            car.v,
-            car.a,
-            car.time_ellapsed / PRECISION,
-            car.f_car.id if car.f_car is not None else -1,
-            car.b_car.id if car.b_car is not None else -1,
-        ]
+        log_car_data = cars_writer.append
+
+
+# Exits, crashes and tows are written by the event bus writer thread
+event_bus = EventBus()
+if "console" in EVENT_SINKS:
+    event_bus.add_sink(ConsoleSink())
+# The replay checks its events against these tables, a recorded run always writes them
+EVENT_TABLES = LOG and ("csv" in EVENT_SINKS or RECORD)
+if EVENT_TABLES and LOG_FORMAT == "csv":
+    event_bus.add_sink(CsvSink(EXITS_LOG_FILE, "exit"))
+    event_bus.add_sink(CsvSink(CRASHES_LOG_FILE, "crash"))
+    if RECORD:
+        event_bus.add_sink(CsvSink(SPAWNS_LOG_FILE, "spawn"))
+elif EVENT_TABLES:
+    event_bus.add_sink(ColumnarSink(f"{LOG_DIR}/exits_data", "exit", LOG_FORMAT))
+    event_bus.add_sink(ColumnarSink(f"{LOG_DIR}/crashes_data", "crash", LOG_FORMAT))
+    if RECORD:
+        event_bus.add_sink(ColumnarSink(f"{LOG_DIR}/spawns_data", "spawn", LOG_FORMAT))
+if LOG and "jsonl" in EVENT_SINKS:
+    event_bus.add_sink(JsonlSink(EVENTS_LOG_FILE))
+event_bus.start()
+
+# Early stop once the chosen metrics converge
+monitor = None
+if args.stop_precision is not None:
+    monitor = ConvergenceMonitor(
+        [metric.strip() for metric in args.stop_metrics.split(",") if metric.strip()],
+        rel_precision=args.stop_precision,
+        confidence=args.stop_confidence,
+        rate_tolerance=args.stop_rate_tolerance,
+    )
 
 
 car_colors = ["car_b", "car_y", "car_k", "car_w", "car_g", "car_o", "car_p", "car_v"]
 
-agp = Highway(length=HIGHWAY_LENGTH, crash_remove_delay=5000, precision=PRECISION)
+if LANES > 1:
+    agp = MultiLaneHighway(
+        length=HIGHWAY_LENGTH,
+        lanes=LANES,
+        crash_remove_delay=5000,
+        precision=PRECISION,
+        event_bus=event_bus,
+    )
+else:
+    agp = Highway(
+        length=HIGHWAY_LENGTH,
+        crash_remove_delay=5000,
+        precision=PRECISION,
+        event_bus=event_bus,
+        ring=args.ring,
+    )
+
+# Live metrics for long headless runs, published from O(1) state
+telemetry = None
+if args.telemetry_file is not None or args.telemetry_port is not None:
+    telemetry = highway_telemetry(
+        agp,
+        interval=args.telemetry_interval,
+        path=args.telemetry_file,
+        port=args.telemetry_port,
+    ).start()
+
+# Per-frame state for local readers, through shared memory
+state_feed = StateFeed(args.state_feed) if args.state_feed is not None else None
+
+if args.ring:
+    # Fixed number of cars, laps are logged as exits
+    inflow = RingInflow(agp, population, args.density)
+    inflow.populate()
+else:
+    inflow = Inflow(agp, population, arrivals, entrance_rng, min_gap=80)
+
+# Seed, arguments and a checkpoint every checkpoint_interval frames, see replay.py
+recorder = None
+if RECORD:
+    recorder = Recorder(LOG_DIR, PRECISION, args.checkpoint_interval, config=vars(args))
 
 avg_v = 80
 avg_trip_time = HIGHWAY_LENGTH / avg_v
@@ -249,26 +506,38 @@ avg_trip_time = HIGHWAY_LENGTH / avg_v
 with tqdm(total=FRAMES, desc="Frames", unit="frame") as pbar:
 
     # Add a first car
-    agp.add_car(
-        Car(
-            x=100,
-            v=int(np.random.uniform(50, 80)),
-            vmax=int(np.random.normal(140, 20)),
-            vd=int(np.random.normal(MAX_V, 10)),
-            a=max(0, int(np.random.normal(2, 1))),
-            amax=np.random.uniform(1.5, 3),
-            break_max=np.random.uniform(2, 4),
-            acc_throttle=np.random.normal(0.1, 0.01),
-            acc_stopping=np.random.normal(0.3, 0.01),
-            length=np.random.normal(4.5, 0.5),
-            tr=np.random.normal(0.732, 0.163),
-            fc=None,
-            bc=None,
-            will_measure=True,
+    if not args.ring:
+        agp.add_car(
+            Car(
+                x=100,
+                v=int(np.random.uniform(50, 80)),
+                vmax=int(np.random.normal(140, 20)),
+                vd=int(np.random.normal(MAX_V, 10)),
+                a=max(0, int(np.random.normal(2, 1))),
+                amax=np.random.uniform(1.5, 3),
+                break_max=np.random.uniform(2, 4),
+                acc_throttle=np.random.normal(0.1, 0.01),
+                acc_stopping=np.random.normal(0.3, 0.01),
+                length=np.random.normal(4.5, 0.5),
+                tr=np.random.normal(DRIVER_PARAMETERS["tr_mean"], DRIVER_PARAMETERS["tr_std"]),
+                fc=None,
+                bc=None,
+                will_measure=True,
+            )
+        )
+
+    # Live view in its own process, it gets a snapshot per frame and never holds the run back
+    live_view = None
+    if LIVE:
+        live_view = LivePublisher(
+            agp.length,
+            lanes=LANES,
+            frames=FRAMES,
+            fps=FPS,
+            xlim=(1000, 1200) if SHORT_SCALE else None,
         )
-    )
 
-    if PLOT:
+    if DRAW:
         # Create figure and axes
         fig, ax = plt.subplots(figsize=(22, 2))
 
@@ -276,7 +545,10 @@ with tqdm(total=FRAMES, desc="Frames", unit="frame") as pbar:
         fig.tight_layout()
 
         ax.set_xlim(0, agp.length)
-        ax.set_ylim(-3, 20)
+        lw = 4
+        # Half width of the road, one lane is lw wide
+        road = LANES * lw / 2
+        ax.set_ylim(-road - 1, max(20, road + 1))
 
         # ax hide y axis
         ax.set_yticks([])
@@ -286,25 +558,25 @@ with tqdm(total=FRAMES, desc="Frames", unit="frame") as pbar:
         # ax.spines['top'].set_visible(False)
         # ax.spines['bottom'].set_visible(False)
 
-        lw = 4
         # Plot lane lines
-        ax.plot([2, agp.length], [lw / 2, lw / 2], color="black", linewidth=2)
-        ax.plot([2, agp.length], [-lw / 2, -lw / 2], color="black", linewidth=2)
+        ax.plot([2, agp.length], [road, road], color="black", linewidth=2)
+        ax.plot([2, agp.length], [-road, -road], color="black", linewidth=2)
 
         # Plot asphalt area
         ax.fill_between(
-            [2, agp.length], [-lw / 2, -lw / 2], [lw / 2, lw / 2], color="lightgrey"
+            [2, agp.length], [-road, -road], [road, road], color="lightgrey"
         )
 
-        # Plot dashed center line
-        ax.plot(
-            [2, agp.length],
-            [0, 0],
-            color="white",
-            linewidth=2,
-            linestyle="dashed",
-            dashes=(5, 5),
-        )
+        # Plot dashed center line, or the lines between lanes
+        for y in [0] if LANES == 1 else [-road + lw * k for k in range(1, LANES)]:
+            ax.plot(
+                [2, agp.length],
+                [y, y],
+                color="white",
+                linewidth=2,
+                linestyle="dashed",
+                dashes=(5, 5),
+            )
 
         car_ims = [
             OffsetImage(plt.imread(f"assets/{car_color}.png", format="png"), zoom=0.4)
@@ -319,60 +591,49 @@ with tqdm(total=FRAMES, desc="Frames", unit="frame") as pbar:
 
         pbar.update(1)
 
+        # State at the start of the frame, after the cars added by the previous one
+        if recorder is not None:
+            recorder.checkpoint(frame, agp, inflow)
+
         # Once per frame
         # One frame is 1 second
         # In each frame the AGP is updated PRECISION times
         # The AGP updates faster than the animation
 
         # Update AGP PRECISION times each frame
+        # Cars are added to the AGP after every sub-step
         for sub_t in range(PRECISION):
-            agp.update(
-                frame * PRECISION + sub_t, exit_logger=log_exits, crash_logger=log_crash
-            )
-
-        # Add cars to the AGP
-
-        if (len(agp.get_cars()) == 0 or agp.get_back_car().get_position() > 80) and (
-            not agp.get_back_car().crashes_upfront() or np.random.poisson() == 1
-        ):
-            if np.random.uniform() < SMART_CAR_PROBABILITY:
-                agp.add_car(SmartCar())
-            else:
-                agp.add_car(
-                    Car(
-                        x=None,
-                        v=int(np.random.uniform(50, 80)),
-                        vmax=int(np.random.normal(120, 10)),
-                        a=max(0, int(np.random.normal(2, 1))),
-                        amax=np.random.uniform(1.5, 3),
-                        break_max=np.random.normal(3.5, 0.5),
-                        acc_throttle=np.random.normal(0.1, 0.01),
-                        acc_stopping=np.random.normal(0.4, 0.001),
-                        length=np.random.normal(4.5, 0.5),
-                        tr=np.random.normal(0.732, 0.163)
-                        if np.random.uniform() > 0.001
-                        else 0,
-                        vd=int(np.random.normal(100, 5)),
-                        fc=None,
-                        bc=None,
-                        will_measure=True,
-                        has_random_behavior=np.random.uniform() > 0.4,
-                    )
+            if monitor is not None:
+                agp.update(
+                    frame * PRECISION + sub_t,
+                    exit_logger=monitor.record_exit,
+                    crash_logger=monitor.record_crash,
                 )
+            else:
+                agp.update(frame * PRECISION + sub_t)
+            inflow.step(frame * PRECISION + sub_t)
+
+        if monitor is not None:
+            monitor.end_frame(frame, agp.get_cars())
 
         # Log AGP current data
         if LOG:
             log_agp_data(agp, frame)
-            for car in agp.get_cars():
-                log_car_data(car, frame)
+            for row in log_policy.rows(frame, agp.get_cars(), car_row):
+                log_car_data(row)
 
-            if frame % 100 == 0:
+            if frame % 100 == 0 and LOG_FORMAT == "csv":
                 # Save data to CSV
                 agp_df.to_csv(AGP_LOG_FILE)
                 cars_df.to_csv(CARS_LOG_FILE)
-                exits_df.to_csv(EXITS_LOG_FILE)
-                crashes_df.to_csv(CRASHES_LOG_FILE)
 
+        if telemetry is not None:
+            telemetry.frame(PRECISION)
+
+        if state_feed is not None:
+            state_feed.publish(frame, agp)
+
+        # Running averages, the bar redraws at its own pace
         pbar.set_postfix(
             cars=f"{len(agp.get_cars())}",
             crashes=f"{agp.get_crash_count()}",
@@ -380,12 +641,13 @@ with tqdm(total=FRAMES, desc="Frames", unit="frame") as pbar:
             avg_v=f"{agp.get_avg_v()*3.6:.2f}",
             avg_a=f"{agp.get_avg_a():.2f}",
             avg_t_d=f"{agp.get_avg_trip_duration():.2f}",
-            avg_h_v=f"{agp.get_avg_v()*3.6:.2f}",
-            avg_h_a=f"{agp.get_avg_a():.2f}",
-            avg_h_t_d=f"{agp.get_avg_trip_duration():.2f}",
+            refresh=False,
         )
 
-        if PLOT:
+        if live_view is not None:
+            live_view.publish(frame, agp)
+
+        if DRAW:
             # Gather AGP current data
             xdata = agp.get_cars_positions()
             vdata = agp.get_cars_velocities()
@@ -421,7 +683,8 @@ with tqdm(total=FRAMES, desc="Frames", unit="frame") as pbar:
                 )
                 car_im = plt.imread(f"assets/{car_color}.png", format="png")
                 car_oi = OffsetImage(car_im, zoom=0.4)
-                ab = AnnotationBbox(car_oi, (x, 0), frameon=False)
+                y = (car.lane - (LANES - 1) / 2) * lw
+                ab = AnnotationBbox(car_oi, (x, y), frameon=False)
                 artists.append(ax.add_artist(ab))
 
             if PLOT_TEXT:
@@ -565,30 +828,54 @@ with tqdm(total=FRAMES, desc="Frames", unit="frame") as pbar:
 
         return None
 
-    if PLOT:
+    if DRAW:
 
         if SHORT_SCALE:
             ax.set_xlim(1000, 1200)
             FPS = 5
 
-        if LIVE:
-            ani = animation.FuncAnimation(
-                fig, update, frames=FRAMES, init_func=init, blit=True, interval=1
-            )
-            plt.show()
-
-        else:
-
-            ani = animation.FuncAnimation(
-                fig, update, frames=FRAMES, init_func=init, blit=True, interval=INTERVAL
-            )
+        ani = animation.FuncAnimation(
+            fig, update, frames=FRAMES, init_func=init, blit=True, interval=INTERVAL
+        )
 
-            ani.save(
-                f"animation_{ts}.mp4",
-                fps=FPS,
-                extra_args=["-vcodec", "libx264", "-pix_fmt", "yuv420p"],
-            )
+        ani.save(
+            f"animation_{ts}.mp4",
+            fps=FPS,
+            extra_args=["-vcodec", "libx264", "-pix_fmt", "yuv420p"],
+        )
 
     else:
         for frame in tqdm(range(FRAMES)):
             update(frame)
+            if monitor is not None and monitor.check(frame):
+                break
+
+# The early stop only applies without the video
+if monitor is not None:
+    monitor.finish(FRAMES - 1)
+    print(monitor.summary())
+    if LOG:
+        monitor.save(CONVERGENCE_LOG_FILE)
+
+if LOG and LOG_FORMAT == "csv":
+    # Save the frames after the last checkpoint
+    agp_df.to_csv(AGP_LOG_FILE)
+    cars_df.to_csv(CARS_LOG_FILE)
+elif LOG:
+    agp_writer.close()
+    cars_writer.close()
+
+if recorder is not None:
+    recorder.close()
+
+if telemetry is not None:
+    telemetry.close()
+
+if state_feed is not None:
+    state_feed.close()
+
+event_bus.close()
+
+if live_view is not None:
+    # The window stays open until it is closed, like plt.show()
+    live_view.close()
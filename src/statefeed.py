@@ -0,0 +1,393 @@
+"""
+* Shared-memory feed of the state of the highway, one record per frame
+* Local processes (dashboards, detectors, experiment controllers) map the same block and
+* read the cars as NumPy arrays, without copies or serialization
+
+* Layout of the block:
+* header   int64 fields: magic, version, slots, capacity, slot size, latest sequence, closed, writer pid
+* slots    ring of `slots` records. Each one has an int64 meta (sequence, frame, cars,
+*          truncated) and the columns id, x, v, a (8 bytes) and lane, flags (1 byte), each with
+*          room for `capacity` cars
+
+* Frames are numbered 1, 2, 3... and frame k goes to slot (k - 1) % slots. The slot sequence
+* works as a seqlock: 2k - 1 while the writer fills it, 2k when it is complete. The writer
+* never waits for anyone. A reader checks the sequence after using the views (FrameView.valid)
+* or copies the arrays (FrameView.copy), a reader that falls `slots` frames behind skips
+* the frames it missed
+
+* flags: bit 0 crashed, bit 1 stopping, bit 2 increased attention, bit 3 decreased attention
+
+* run: python simulation.py --state_feed agp_state ... then python statefeed.py agp_state
+"""
+
+import argparse
+import os
+import time
+from multiprocessing import shared_memory
+from typing import Dict, Iterator, Optional
+
+import numpy as np
+
+MAGIC = 0x41475053544154  # "AGPSTAT"
+VERSION = 1
+
+HEADER_FIELDS = ["magic", "version", "slots", "capacity", "slot_bytes", "latest", "closed", "writer_pid"]
+HEADER_BYTES = 64
+META_FIELDS = ["sequence", "frame", "cars", "truncated"]
+META_BYTES = 32
+
+# Columns of a slot, 8 byte columns first so every column stays aligned
+COLUMNS = [("id", np.int64), ("x", np.float64), ("v", np.float64), ("a", np.float64), ("lane", np.int8), ("flags", np.uint8)]
+
+CRASHED = 1
+STOPPING = 2
+INCREASED_ATTENTION = 4
+DECREASED_ATTENTION = 8
+
+
+def slot_bytes(capacity: int) -> int:
+    size = META_BYTES + sum(np.dtype(dtype).itemsize * capacity for _, dtype in COLUMNS)
+    # Slots start on a cache line
+    return (size + 63) // 64 * 64
+
+
+def attach(name: str) -> shared_memory.SharedMemory:
+    """Maps an existing block without registering it, so a reader never unlinks it at exit"""
+    try:
+        return shared_memory.SharedMemory(name=name, track=False)
+    except TypeError:
+        # Before Python 3.13 every attached block is registered to be unlinked at exit, and
+        # unregistering it afterwards would also drop the writer's entry when the tracker is shared
+        from multiprocessing import resource_tracker
+
+        register = resource_tracker.register
+        resource_tracker.register = lambda name, rtype: None
+        try:
+            return shared_memory.SharedMemory(name=name)
+        finally:
+            resource_tracker.register = register
+
+
+class Ring:
+    """Views over the header and the slots of a block"""
+
+    def __init__(self, memory: shared_memory.SharedMemory, slots: int, capacity: int):
+        self.memory = memory
+        self.slots = slots
+        self.capacity = capacity
+        self.slot_bytes = slot_bytes(capacity)
+
+        self.header = np.ndarray(len(HEADER_FIELDS), dtype=np.int64, buffer=memory.buf)
+        self.meta = []
+        self.columns = []
+        for k in range(slots):
+            offset = HEADER_BYTES + k * self.slot_bytes
+            self.meta.append(np.ndarray(len(META_FIELDS), dtype=np.int64, buffer=memory.buf, offset=offset))
+            offset += META_BYTES
+            columns = {}
+            for name, dtype in COLUMNS:
+                columns[name] = np.ndarray(capacity, dtype=dtype, buffer=memory.buf, offset=offset)
+                offset += np.dtype(dtype).itemsize * capacity
+            self.columns.append(columns)
+
+    def field(self, name: str) -> int:
+        return int(self.header[HEADER_FIELDS.index(name)])
+
+    def release(self):
+        # The views hold the buffer, they go before the block is closed
+        self.header = None
+        self.meta = []
+        self.columns = []
+
+
+class StateFeed:
+    """Writer of the feed, owned by the simulation
+
+    Args:
+        name (Optional[str], optional): Name of the shared memory block. Defaults to None (random).
+        slots (int, optional): Frames kept in the ring. Defaults to 8.
+        capacity (int, optional): Cars per frame, the rest are left out (counted in truncated). Defaults to 16384.
+    """
+
+    def __init__(self, name: Optional[str] = None, slots: int = 8, capacity: int = 16384):
+        if slots < 2:
+            raise ValueError("The ring needs at least two slots")
+        size = HEADER_BYTES + slots * slot_bytes(capacity)
+        self.memory = shared_memory.SharedMemory(name=name, create=True, size=size)
+        self.name = self.memory.name
+        self.ring = Ring(self.memory, slots, capacity)
+        self.sequence = 0
+
+        header = self.ring.header
+        header[:] = 0
+        header[HEADER_FIELDS.index("slots")] = slots
+        header[HEADER_FIELDS.index("capacity")] = capacity
+        header[HEADER_FIELDS.index("slot_bytes")] = self.ring.slot_bytes
+        header[HEADER_FIELDS.index("writer_pid")] = os.getpid()
+        header[HEADER_FIELDS.index("version")] = VERSION
+        # Readers check the magic last, the header is complete by then
+        header[HEADER_FIELDS.index("magic")] = MAGIC
+
+    def publish(self, frame: int, highway) -> int:
+        """Writes the cars of the highway as the next frame
+
+        Args:
+            frame (int): Frame of the run
+            highway (Highway): Highway or MultiLaneHighway
+
+        Returns:
+            int: Sequence number of the frame
+        """
+        cars = highway.get_cars()
+        total = len(cars)
+        n = min(total, self.ring.capacity)
+        if n < total:
+            cars = cars[:n]
+
+        self.sequence += 1
+        k = (self.sequence - 1) % self.ring.slots
+        meta = self.ring.meta[k]
+        columns = self.ring.columns[k]
+
+        # Odd while the slot is being written
+        meta[0] = 2 * self.sequence - 1
+
+        columns["id"][:n] = np.fromiter((car.id for car in cars), dtype=np.int64, count=n)
+        columns["x"][:n] = np.fromiter((car.x for car in cars), dtype=np.float64, count=n)
+        columns["v"][:n] = np.fromiter((car.v for car in cars), dtype=np.float64, count=n)
+        columns["a"][:n] = np.fromiter((car.a for car in cars), dtype=np.float64, count=n)
+        columns["lane"][:n] = np.fromiter((car.lane for car in cars), dtype=np.int8, count=n)
+        columns["flags"][:n] = np.fromiter(
+            (
+                car.crashed * CRASHED
+                + car.stopping * STOPPING
+                + car.increased_attention * INCREASED_ATTENTION
+                + car.decresed_attention * DECREASED_ATTENTION
+                for car in cars
+            ),
+            dtype=np.uint8,
+            count=n,
+        )
+        meta[1] = frame
+        meta[2] = n
+        meta[3] = total - n
+
+        meta[0] = 2 * self.sequence
+        self.ring.header[HEADER_FIELDS.index("latest")] = self.sequence
+        return self.sequence
+
+    def close(self, unlink: bool = True):
+        """Marks the feed as closed, readers see it in StateReader.closed"""
+        if self.ring.header is not None:
+            self.ring.header[HEADER_FIELDS.index("closed")] = 1
+        self.ring.release()
+        self.memory.close()
+        if unlink:
+            self.memory.unlink()
+
+
+class FrameView:
+    """Cars of one frame as views into the shared block
+
+    The arrays are not copied, the writer overwrites the slot `slots` frames later. Check
+    valid() after using them, or use copy().
+    """
+
+    def __init__(self, ring: Ring, sequence: int):
+        self.ring = ring
+        self.sequence = sequence
+        self.meta = ring.meta[(sequence - 1) % ring.slots]
+        self.frame = int(self.meta[1])
+        self.count = int(self.meta[2])
+        self.truncated = int(self.meta[3])
+        columns = ring.columns[(sequence - 1) % ring.slots]
+        for name, _ in COLUMNS:
+            setattr(self, name, columns[name][: self.count])
+
+    def valid(self) -> bool:
+        """Whether the slot still holds this frame"""
+        return int(self.meta[0]) == 2 * self.sequence
+
+    def copy(self) -> Optional[Dict[str, np.ndarray]]:
+        """Copies of the columns, None if the writer overwrote the slot meanwhile"""
+        data = {name: getattr(self, name).copy() for name, _ in COLUMNS}
+        return data if self.valid() else None
+
+
+class StateReader:
+    """Reader of the feed, any number of them can map the same block
+
+    Args:
+        name (str): Name of the shared memory block
+        timeout (float, optional): Seconds to wait for the writer to create the block. Defaults to 10.
+    """
+
+    def __init__(self, name: str, timeout: float = 10):
+        deadline = time.monotonic() + timeout
+        while True:
+            try:
+                self.memory = attach(name)
+                header = np.ndarray(len(HEADER_FIELDS), dtype=np.int64, buffer=self.memory.buf)
+                if int(header[0]) == MAGIC:
+                    break
+                del header
+                self.memory.close()
+            except FileNotFoundError:
+                pass
+            if time.monotonic() > deadline:
+                raise TimeoutError(f"No state feed named {name}")
+            time.sleep(0.05)
+
+        version = int(header[HEADER_FIELDS.index("version")])
+        if version != VERSION:
+            raise ValueError(f"State feed version {version}, this reader knows {VERSION}")
+        self.ring = Ring(self.memory, int(header[2]), int(header[3]))
+        del header
+
+        self.last = 0
+        self.missed = 0
+
+    @property
+    def latest_sequence(self) -> int:
+        return self.ring.field("latest")
+
+    @property
+    def closed(self) -> bool:
+        return self.ring.field("closed") == 1
+
+    def frame(self, sequence: int) -> Optional[FrameView]:
+        """Frame with that sequence number, None if it is not complete or already overwritten"""
+        if sequence < 1:
+            return None
+        view = FrameView(self.ring, sequence)
+        return view if view.valid() else None
+
+    def latest(self) -> Optional[FrameView]:
+        """Newest complete frame"""
+        for _ in range(self.ring.slots):
+            view = self.frame(self.latest_sequence)
+            if view is not None:
+                self.last = max(self.last, view.sequence)
+                return view
+        return None
+
+    def new_frames(self) -> Iterator[FrameView]:
+        """Frames published since the last call, the ones already overwritten are counted in missed"""
+        latest = self.latest_sequence
+        start = max(self.last + 1, latest - self.ring.slots + 1)
+        self.missed += max(0, start - self.last - 1)
+        for sequence in range(start, latest + 1):
+            view = self.frame(sequence)
+            self.last = sequence
+            if view is None:
+                self.missed += 1
+                continue
+            yield view
+
+    def close(self):
+        self.ring.release()
+        self.memory.close()
+
+
+def check_reader(name: str, results):
+    """Reader process of --check: reads as fast as it can and validates every frame"""
+    reader = StateReader(name)
+    frames, torn, checked = 0, 0, 0
+    while not reader.closed:
+        for view in reader.new_frames():
+            # Every car of frame f has x = f + id, a torn frame mixes two frames
+            data = view.copy()
+            frames += 1
+            if data is None:
+                torn += 1
+                continue
+            if not np.array_equal(data["x"], view.frame + data["id"]):
+                results.put(("corrupt", view.sequence))
+            checked += 1
+    results.put(("done", frames, checked, torn, reader.missed))
+    reader.close()
+
+
+class FakeCar:
+    __slots__ = ("id", "x", "v", "a", "lane", "crashed", "stopping", "increased_attention", "decresed_attention")
+
+    def __init__(self, car_id: int):
+        self.id = car_id
+        self.x = 0.0
+        self.v = self.a = 0.0
+        self.lane = 0
+        self.crashed = self.stopping = self.increased_attention = self.decresed_attention = False
+
+
+class FakeHighway:
+    def __init__(self, cars):
+        self.cars = cars
+
+    def get_cars(self):
+        return self.cars
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Reader of the shared-memory state feed")
+    parser.add_argument("name", type=str, nargs="?", help="Name of the feed (--state_feed of simulation.py)")
+    parser.add_argument("--interval", type=float, help="Seconds between polls", default=0.5)
+    parser.add_argument(
+        "--check",
+        type=int,
+        help="Publish this many synthetic frames while reader processes validate them",
+        default=None,
+    )
+    parser.add_argument("--readers", type=int, help="Reader processes of --check", default=2)
+
+    args = parser.parse_args()
+
+    if args.check is not None:
+        import multiprocessing as mp
+
+        feed = StateFeed(slots=4, capacity=2048)
+        context = mp.get_context("spawn")
+        results = context.Queue()
+        readers = [context.Process(target=check_reader, args=(feed.name, results)) for _ in range(args.readers)]
+        for process in readers:
+            process.start()
+        time.sleep(1)
+
+        highway = FakeHighway([FakeCar(i) for i in range(2000)])
+        elapsed = 0.0
+        for f in range(args.check):
+            for car in highway.cars:
+                car.x = float(f + car.id)
+            start = time.perf_counter()
+            feed.publish(f, highway)
+            elapsed += time.perf_counter() - start
+        feed.ring.header[HEADER_FIELDS.index("closed")] = 1
+
+        for _ in readers:
+            result = results.get()
+            while result[0] == "corrupt":
+                print(f"Corrupt frame {result[1]} passed validation")
+                result = results.get()
+            _, frames, checked, torn, missed = result
+            print(f"Reader: {frames} frames read, {checked} checked, {torn} overwritten while read, {missed} missed")
+        for process in readers:
+            process.join()
+        print(f"Writer: {args.check} frames of 2000 cars published in {elapsed:.2f} s ({1e3 * elapsed / args.check:.2f} ms per frame)")
+        feed.close()
+        raise SystemExit(0)
+
+    if args.name is None:
+        parser.error("A feed name is needed")
+
+    reader = StateReader(args.name)
+    print(f"Attached to {args.name}: {reader.ring.slots} slots of {reader.ring.capacity} cars")
+    while not reader.closed:
+        view = reader.latest()
+        if view is not None:
+            v = view.v.mean() * 3.6 if view.count else 0
+            crashed = int(np.count_nonzero(view.flags & CRASHED))
+            line = f"frame {view.frame}  seq {view.sequence}  cars {view.count}  crashed {crashed}  avg v {v:.1f} km/h"
+            if view.valid():
+                print(line)
+        time.sleep(args.interval)
+    print("Feed closed")
+    reader.close()
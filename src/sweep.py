@@ -0,0 +1,201 @@
+"""
+* Runs simulation.py over a grid of parameters
+* Configurations already in the result cache are skipped
+
+* run: python sweep.py --seed 1 2 3 --smart_car_probability 0 0.2 --frames 1200 --workers 2 --max_log_mb 2000
+* fundamental diagram: python sweep.py --ring True --density 10 20 40 60 --length 2000 --frames 600
+* paired comparison: python sweep.py --seed 1 2 3 4 5 --smart_car_probability 0 0.2 --antithetic False True --compare smart_car_probability
+"""
+
+import argparse
+import itertools
+import os
+import shutil
+import subprocess
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List
+
+import pandas as pd
+
+from result_cache import ResultCache, code_version, config_key, summarize_logs
+from variance import merge_antithetic, paired_differences, summary
+
+
+def boolean(value: str) -> bool:
+    return value.lower() in ("1", "true", "yes")
+
+# Parameters of simulation.py that can be swept, with its defaults
+SWEEP_PARAMETERS = {
+    "seed": (int, 42),
+    "precision": (int, 100),
+    "frames": (int, 12000),
+    "length": (int, 14 * 1000),
+    "max_v": (int, 100),
+    "smart_car_probability": (float, 0),
+    "log_policy": (str, "full"),
+    "inflow": (str, "gap"),
+    "arrival_rate": (float, 1800),
+    "ring": (boolean, False),
+    "density": (float, 20),
+    "antithetic": (boolean, False),
+    "tr_mean": (float, 0.732),
+    "tr_std": (float, 0.163),
+    "acc_stopping": (float, 0.4),
+    "random_behavior_share": (float, 0.6),
+    "increased_attention_factor": (float, 0.5),
+    "decreased_attention_factor": (float, 1.8),
+}
+
+
+def grid(values: Dict[str, List]) -> List[Dict]:
+    names = list(values)
+    return [dict(zip(names, combo)) for combo in itertools.product(*values.values())]
+
+
+def run_simulation(config: Dict, log_dir: str, log_format: str = "csv") -> int:
+    command = [
+        sys.executable,
+        "simulation.py",
+        "--log_dir",
+        log_dir,
+        "--event_sinks",
+        "csv",
+        "--log_format",
+        log_format,
+    ]
+    for name, value in config.items():
+        # simulation.py reads any non empty string as True
+        if isinstance(value, bool):
+            if value:
+                command += [f"--{name}", "True"]
+            continue
+        command += [f"--{name}", str(value)]
+
+    stdout_path, stderr_path = os.path.join(log_dir, "stdout.txt"), os.path.join(log_dir, "stderr.txt")
+    with open(stdout_path, "w") as out, open(stderr_path, "w") as err:
+        return subprocess.run(
+            command,
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            stdout=out,
+            stderr=err,
+        ).returncode
+
+
+def error_tail(log_dir: str, lines: int = 5) -> str:
+    """Last lines of the stderr of a run"""
+    path = os.path.join(log_dir, "stderr.txt")
+    if not os.path.exists(path):
+        return ""
+    with open(path) as f:
+        return "".join(f.readlines()[-lines:])
+
+
+def sweep(
+    values: Dict[str, List], cache: ResultCache, workers: int = 1, log_format: str = "csv"
+) -> pd.DataFrame:
+    """Runs every configuration of the grid that is not cached yet
+
+    Args:
+        values (Dict[str, List]): Values of each parameter
+        cache (ResultCache): Result cache
+        workers (int, optional): Simulations run at the same time. Defaults to 1.
+        log_format (str, optional): Format of the raw logs, see runlog. Defaults to "csv".
+
+    Returns:
+        pd.DataFrame: One row per configuration with its metrics
+    """
+    version = code_version()
+    configs = grid(values)
+    keys = [config_key(config, version) for config in configs]
+
+    pending = [(key, config) for key, config in zip(keys, configs) if key not in cache]
+    print(f"{len(configs) - len(pending)} cached, {len(pending)} to run")
+
+    def run(item):
+        key, config = item
+        log_dir = os.path.abspath(cache.log_dir(key))
+        os.makedirs(log_dir, exist_ok=True)
+        return key, config, log_dir, run_simulation(config, log_dir, log_format)
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for key, config, log_dir, returncode in executor.map(run, pending):
+            if returncode != 0:
+                # The cache does not know the directory, it would never be evicted
+                print(f"Run {key[:12]} failed with code {returncode}: {config}\n{error_tail(log_dir)}")
+                shutil.rmtree(log_dir, ignore_errors=True)
+                continue
+            cache.put(key, config, summarize_logs(log_dir), log_dir)
+            print(f"Run {key[:12]} done: {config}")
+
+    rows = []
+    for key, config in zip(keys, configs):
+        entry = cache.get(key)
+        if entry is not None:
+            rows.append({**config, **entry["metrics"], "key": key, "log_dir": entry["log_dir"]})
+    # The last use of every entry, once
+    cache.save()
+    return pd.DataFrame(rows)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run a parameter sweep")
+
+    for name, (kind, default) in SWEEP_PARAMETERS.items():
+        parser.add_argument(f"--{name}", type=kind, nargs="+", default=[default])
+
+    parser.add_argument("--workers", type=int, help="Parallel simulations", default=1)
+    parser.add_argument("--cache_dir", type=str, help="Result cache directory", default="cache")
+    parser.add_argument(
+        "--max_log_mb", type=float, help="Size limit of the cached raw logs in MB", default=None
+    )
+    parser.add_argument(
+        "--output", type=str, help="CSV with the sweep results", default="sweep_results.csv"
+    )
+    parser.add_argument(
+        "--log_format", type=str, help="Format of the raw logs: csv, npz, parquet or auto", default="csv"
+    )
+    parser.add_argument(
+        "--compare",
+        type=str,
+        help="Parameter whose values are compared with the first one, paired by the other parameters",
+        default=None,
+    )
+    parser.add_argument(
+        "--compare_output",
+        type=str,
+        help="CSV with the paired differences",
+        default="paired_results.csv",
+    )
+
+    args = parser.parse_args()
+
+    cache = ResultCache(
+        args.cache_dir,
+        max_log_bytes=int(args.max_log_mb * 1024 * 1024) if args.max_log_mb is not None else None,
+    )
+
+    results = sweep(
+        {name: getattr(args, name) for name in SWEEP_PARAMETERS},
+        cache,
+        workers=args.workers,
+        log_format=args.log_format,
+    )
+    results.to_csv(args.output)
+    print(results)
+
+    if args.compare is not None:
+        if args.compare not in SWEEP_PARAMETERS:
+            parser.error(f"Unknown parameter to compare: {args.compare}")
+        parameters = list(SWEEP_PARAMETERS)
+        # Each plain run and its antithetic twin count as one replica
+        if len(args.antithetic) > 1:
+            results = merge_antithetic(results, parameters)
+            parameters.remove("antithetic")
+        differences = paired_differences(
+            results,
+            args.compare,
+            pair_by=[name for name in parameters if name != args.compare],
+        )
+        differences.to_csv(args.compare_output)
+        print(summary(differences, args.compare))
@@ -0,0 +1,227 @@
+"""
+* Live telemetry of a run
+* Counters and gauges with O(1) updates, published every few seconds in the Prometheus
+* text format to a metrics file and/or a local HTTP endpoint (GET /metrics)
+* Publishing only reads O(1) state (running sums of the highway, counters), so it does
+* not slow down the simulation loop
+
+* watch a headless run: python simulation.py --telemetry_port 9100 ... then curl localhost:9100/metrics
+"""
+
+import os
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable, Dict, List, Optional
+
+
+class RunningStats:
+    """Count, sum, min and max of a stream of samples, in constant memory"""
+
+    __slots__ = ("count", "total", "min", "max")
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.min = None
+        self.max = None
+
+    def add(self, value: float):
+        self.count += 1
+        self.total += value
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+
+    def extend(self, values: List[float]):
+        """Adds a batch of samples, with the builtins over the list"""
+        if len(values) == 0:
+            return
+        self.count += len(values)
+        self.total += sum(values)
+        low, high = min(values), max(values)
+        if self.min is None or low < self.min:
+            self.min = low
+        if self.max is None or high > self.max:
+            self.max = high
+
+    def mean(self) -> float:
+        return self.total / self.count if self.count > 0 else 0
+
+
+class Counter:
+    """Value that only goes up"""
+
+    __slots__ = ("name", "help", "value")
+    kind = "counter"
+
+    def __init__(self, name: str, help: str = ""):
+        self.name = name
+        self.help = help
+        self.value = 0
+
+    def inc(self, amount: float = 1):
+        self.value += amount
+
+
+class Gauge:
+    """Value that is set, or read from a callback when published"""
+
+    __slots__ = ("name", "help", "value", "callback")
+    kind = "gauge"
+
+    def __init__(self, name: str, help: str = "", callback: Optional[Callable[[], float]] = None):
+        self.name = name
+        self.help = help
+        self.value = 0
+        self.callback = callback
+
+    def set(self, value: float):
+        self.value = value
+
+    def read(self) -> float:
+        if self.callback is not None:
+            self.value = self.callback()
+        return self.value
+
+
+def memory_bytes() -> int:
+    """Resident memory of the process (peak resident memory where /proc is missing)"""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        import resource
+
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+class Telemetry:
+    """Registry of the metrics of a run and its publishers
+
+    Args:
+        interval (float, optional): Seconds between publications. Defaults to 5.
+        path (Optional[str], optional): Metrics file, rewritten atomically. Defaults to None.
+        port (Optional[int], optional): Port of the HTTP endpoint on localhost. Defaults to None.
+        prefix (str, optional): Prefix of the metric names. Defaults to "agp_".
+    """
+
+    def __init__(
+        self,
+        interval: float = 5,
+        path: Optional[str] = None,
+        port: Optional[int] = None,
+        prefix: str = "agp_",
+    ):
+        self.interval = interval
+        self.path = path
+        self.port = port
+        self.prefix = prefix
+
+        self.metrics: Dict[str, object] = {}
+        self.text = ""
+        self.server = None
+
+        self.started = time.monotonic()
+        self.last_publish = None
+        self.substeps = self.counter("substeps_total", "Sub-steps simulated")
+        self.frames = self.counter("frames_total", "Frames simulated")
+        self.rate = self.gauge("substeps_per_second", "Sub-steps per second since the last publication")
+        self.gauge("memory_bytes", "Resident memory of the process", memory_bytes)
+        self.gauge("uptime_seconds", "Seconds since the run started", lambda: time.monotonic() - self.started)
+        self.last_substeps = 0
+
+    def counter(self, name: str, help: str = "") -> Counter:
+        metric = Counter(self.prefix + name, help)
+        self.metrics[name] = metric
+        return metric
+
+    def gauge(self, name: str, help: str = "", callback: Optional[Callable[[], float]] = None) -> Gauge:
+        metric = Gauge(self.prefix + name, help, callback)
+        self.metrics[name] = metric
+        return metric
+
+    def start(self):
+        if self.port is not None and self.server is None:
+            telemetry = self
+
+            class Handler(BaseHTTPRequestHandler):
+                def do_GET(self):
+                    if self.path.rstrip("/") not in ("", "/metrics"):
+                        self.send_error(404)
+                        return
+                    body = telemetry.text.encode()
+                    self.send_response(200)
+                    self.send_header("Content-Type", "text/plain; version=0.0.4")
+                    self.send_header("Content-Length", str(len(body)))
+                    self.end_headers()
+                    self.wfile.write(body)
+
+                def log_message(self, format, *args):
+                    pass
+
+            self.server = ThreadingHTTPServer(("127.0.0.1", self.port), Handler)
+            threading.Thread(target=self.server.serve_forever, name="telemetry", daemon=True).start()
+        self.publish()
+        return self
+
+    def frame(self, substeps: int):
+        """Called once per frame, publishes when the interval has passed"""
+        self.frames.inc()
+        self.substeps.inc(substeps)
+        if time.monotonic() - self.last_publish >= self.interval:
+            self.publish()
+
+    def render(self) -> str:
+        lines = []
+        for metric in self.metrics.values():
+            value = metric.read() if isinstance(metric, Gauge) else metric.value
+            if metric.help:
+                lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            lines.append(f"{metric.name} {float(value):.6g}")
+        return "\n".join(lines) + "\n"
+
+    def publish(self):
+        now = time.monotonic()
+        if self.last_publish is not None and now > self.last_publish:
+            self.rate.set((self.substeps.value - self.last_substeps) / (now - self.last_publish))
+        self.last_publish = now
+        self.last_substeps = self.substeps.value
+
+        # The HTTP thread only reads the last rendered text
+        self.text = self.render()
+        if self.path is not None:
+            temporary = f"{self.path}.tmp"
+            with open(temporary, "w") as f:
+                f.write(self.text)
+            os.replace(temporary, self.path)
+
+    def close(self):
+        self.publish()
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
+
+
+def highway_telemetry(highway, **kwargs) -> Telemetry:
+    """Telemetry with the gauges of a Highway, all of them O(1) to read
+
+    Args:
+        highway (Highway): Highway of the run
+        **kwargs: Arguments of Telemetry
+
+    Returns:
+        Telemetry: Registry, not started
+    """
+    telemetry = Telemetry(**kwargs)
+    telemetry.gauge("cars", "Cars on the highway", lambda: len(highway))
+    telemetry.gauge("cars_entered_total", "Cars that entered the highway", lambda: len(highway.historic_ids))
+    telemetry.gauge("crashes_total", "Crashes", lambda: highway.historic_crash_count)
+    telemetry.gauge("exits_total", "Trips completed", lambda: highway.trip_stats.count)
+    telemetry.gauge("mean_speed_kmh", "Mean speed over every car and sub-step", lambda: highway.get_avg_v() * 3.6)
+    telemetry.gauge("mean_acceleration", "Mean acceleration over every car and sub-step", highway.get_avg_a)
+    telemetry.gauge("mean_trip_duration", "Mean trip duration in sub-steps", highway.get_avg_trip_duration)
+    return telemetry
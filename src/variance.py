@@ -0,0 +1,175 @@
+"""
+* Variance reduction for scenario comparisons
+* Common random numbers: the driver population, the arrivals and the entrance draw from
+* their own streams, derived only from the seed, so two scenarios with the same seed see
+* the same drivers arriving at the same times
+* Antithetic replicas: the same streams with every uniform u replaced by 1 - u (and every
+* normal z by -z), the pair average has a lower variance than two independent runs
+* Paired differences: scenario minus baseline per seed, with its confidence interval
+
+* The car dynamics (Car.behaviour, the random actions) use the global NumPy generator,
+* seeded with the seed too, but its draws depend on the traffic so they drift apart
+* between scenarios after a while
+"""
+
+from typing import Dict, Sequence
+
+import numpy as np
+import pandas as pd
+
+from convergence import t_quantile
+
+STREAMS = ["population", "arrivals", "entrance"]
+
+# Metrics of result_cache.summarize_logs
+METRICS = ["avg_car_count", "avg_v", "avg_a", "exits", "avg_exit_time", "crashes"]
+
+
+class StreamGenerator:
+    """Random stream with an antithetic twin
+
+    Only the methods used by the inflow. Every draw is a transform of uniforms (or
+    standard normals), so the plain and the antithetic stream of a seed are paired draw
+    by draw. uniform and normal give the same numbers as np.random.Generator.
+
+    Args:
+        rng (np.random.Generator): Underlying generator
+        antithetic (bool, optional): Reflect the draws. Defaults to False.
+    """
+
+    def __init__(self, rng: np.random.Generator, antithetic: bool = False):
+        self.rng = rng
+        self.antithetic = antithetic
+
+    def uniform(self, low: float = 0.0, high: float = 1.0, size=None):
+        u = self.rng.random(size)
+        if self.antithetic:
+            u = 1 - u
+        return low + (high - low) * u
+
+    def normal(self, loc: float = 0.0, scale: float = 1.0, size=None):
+        z = self.rng.standard_normal(size)
+        if self.antithetic:
+            z = -z
+        return loc + scale * z
+
+    def exponential(self, scale: float = 1.0, size=None):
+        # Inverse transform instead of the ziggurat, so it can be reflected
+        u = self.rng.random(size)
+        if self.antithetic:
+            return -scale * np.log(np.maximum(u, np.finfo(float).tiny))
+        return -scale * np.log1p(-u)
+
+
+def random_streams(seed: int, antithetic: bool = False) -> Dict[str, StreamGenerator]:
+    """Independent stream per purpose, see STREAMS
+
+    Args:
+        seed (int): Seed of the run
+        antithetic (bool, optional): Antithetic twin of the streams. Defaults to False.
+
+    Returns:
+        Dict[str, StreamGenerator]: Stream of each purpose
+    """
+    children = np.random.SeedSequence(seed).spawn(len(STREAMS))
+    return {
+        name: StreamGenerator(np.random.default_rng(child), antithetic)
+        for name, child in zip(STREAMS, children)
+    }
+
+
+def merge_antithetic(
+    results: pd.DataFrame, parameters: Sequence[str], metrics: Sequence[str] = METRICS
+) -> pd.DataFrame:
+    """Averages each plain run with its antithetic twin
+
+    Args:
+        results (pd.DataFrame): Sweep results with an `antithetic` column
+        parameters (Sequence[str]): Columns of the configuration
+        metrics (Sequence[str], optional): Metrics to average. Defaults to METRICS.
+
+    Returns:
+        pd.DataFrame: One row per pair, runs without a twin are dropped
+    """
+    if "antithetic" not in results:
+        return results
+    metrics = [metric for metric in metrics if metric in results]
+    keys = [name for name in parameters if name in results and name != "antithetic"]
+    grouped = results.groupby(keys, dropna=False)
+    pairs = grouped[metrics].mean()[grouped.size() == 2]
+    return pairs.reset_index()
+
+
+def paired_differences(
+    results: pd.DataFrame,
+    factor: str,
+    baseline=None,
+    pair_by: Sequence[str] = ("seed",),
+    metrics: Sequence[str] = METRICS,
+    confidence: float = 0.95,
+) -> pd.DataFrame:
+    """Difference of each scenario with the baseline, paired by seed
+
+    Args:
+        results (pd.DataFrame): Sweep results, one row per run (or per antithetic pair)
+        factor (str): Parameter that defines the scenarios
+        baseline (optional): Value of `factor` of the baseline. Defaults to the first one.
+        pair_by (Sequence[str], optional): Columns that pair two runs. Defaults to ("seed",).
+        metrics (Sequence[str], optional): Metrics to compare. Defaults to METRICS.
+        confidence (float, optional): Confidence level. Defaults to 0.95.
+
+    Returns:
+        pd.DataFrame: One row per scenario and metric with the mean difference, the paired
+        and unpaired half widths, and the variance reduction (unpaired over paired variance)
+    """
+    values = list(pd.unique(results[factor]))
+    if baseline is None:
+        baseline = values[0]
+    if baseline not in values:
+        raise ValueError(f"Baseline {baseline} not in the {factor} values")
+
+    pair_by = list(pair_by)
+    metrics = [metric for metric in metrics if metric in results]
+    base = results[results[factor] == baseline].set_index(pair_by)[metrics]
+
+    rows = []
+    for value in values:
+        if value == baseline:
+            continue
+        scenario = results[results[factor] == value].set_index(pair_by)[metrics]
+        common = base.index.intersection(scenario.index)
+        n = len(common)
+        for metric in metrics:
+            a = base.loc[common, metric].to_numpy(dtype=float)
+            b = scenario.loc[common, metric].to_numpy(dtype=float)
+            row = {factor: value, "baseline": baseline, "metric": metric, "pairs": n}
+            if n < 2:
+                rows.append({**row, "difference": float(np.mean(b - a)) if n else np.nan})
+                continue
+            t = t_quantile(confidence, n - 1)
+            paired_var = np.var(b - a, ddof=1)
+            unpaired_var = np.var(a, ddof=1) + np.var(b, ddof=1)
+            rows.append(
+                {
+                    **row,
+                    "difference": float(np.mean(b - a)),
+                    "half_width": float(t * np.sqrt(paired_var / n)),
+                    "unpaired_half_width": float(t * np.sqrt(unpaired_var / n)),
+                    "variance_reduction": float(unpaired_var / paired_var) if paired_var > 0 else np.inf,
+                }
+            )
+    return pd.DataFrame(rows)
+
+
+def summary(differences: pd.DataFrame, factor: str) -> str:
+    lines = []
+    for _, row in differences.iterrows():
+        if pd.isna(row.get("half_width", np.nan)):
+            lines.append(f"{factor}={row[factor]} {row['metric']}: {row['difference']:.3f} (not enough pairs)")
+            continue
+        lines.append(
+            f"{factor}={row[factor]} vs {row['baseline']} {row['metric']}: "
+            f"{row['difference']:+.3f} ± {row['half_width']:.3f} "
+            f"(unpaired ± {row['unpaired_half_width']:.3f}, {row['pairs']} pairs)"
+        )
+    return "\n".join(lines)